@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compare reading plain and compressed harvest files.
+
+Generates a corpus of `-n` records with `corpus.py`, stores a copy of it with
+every available compression (gzip, xz, zstandard) and streams the records of
+each copy with `utils.iter_xml_records`. Reports the size on disk and the
+read throughput in records/sec and in uncompressed MB/sec.
+
+Example usage:
+    python benchmarks/bench_compressed_read.py -n 100000
+    python benchmarks/bench_compressed_read.py -n 100000 -c /tmp/corpus
+"""
+from __future__ import print_function
+
+import getopt
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fixmarc"))
+
+from compression import open_xml_file
+from corpus import generate_corpus
+from utils import find_local_files, iter_xml_records
+
+
+def compress_corpus(paths, outdir, compression):
+    """Write a compressed copy of the files. Returns the new paths."""
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    compressed = []
+    for path in paths:
+        outfile = os.path.join(outdir, os.path.basename(path) + "." + compression)
+        with open(path, "rb") as f, open_xml_file(outfile, "wb") as out:
+            shutil.copyfileobj(f, out)
+        compressed.append(outfile)
+    return compressed
+
+
+def time_read(paths):
+    """Stream all the records of the files. Returns (records, seconds)."""
+    start = time.time()
+    n_records = sum(1 for _ in iter_xml_records(paths))
+    return n_records, time.time() - start
+
+
+def main(argv):
+    n_records = 10000
+    corpus_dir = None
+    helptext = "USAGE: python bench_compressed_read.py [-n <records> -c <corpus_dir>]"
+    try:
+        opts, _ = getopt.getopt(argv, "hn:c:", ["records=", "corpus_dir="])
+    except getopt.GetoptError as err:
+        print(err)
+        print(helptext)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == "-h":
+            print(helptext)
+            sys.exit()
+        elif opt in ("-n", "--records"):
+            n_records = int(arg)
+        elif opt in ("-c", "--corpus_dir"):
+            corpus_dir = arg
+
+    workdir = tempfile.mkdtemp(prefix="fixmarc_compressed_")
+    try:
+        if corpus_dir is None:
+            corpus_dir = os.path.join(workdir, "xml")
+            generate_corpus(corpus_dir, n_records)
+        raw_paths = find_local_files(corpus_dir)
+        raw_size = sum(os.path.getsize(path) for path in raw_paths)
+
+        print("{:<8} {:>12} {:>8} {:>12} {:>12}".format(
+            "format", "disk MB", "ratio", "records/s", "MB/s"))
+        for compression in (None, "gz", "xz", "zst"):
+            if compression is None:
+                paths = raw_paths
+            else:
+                try:
+                    paths = compress_corpus(
+                        raw_paths, os.path.join(workdir, compression), compression)
+                except ValueError as err:
+                    print("{:<8} skipped: {}".format(compression, err))
+                    continue
+            disk_size = sum(os.path.getsize(path) for path in paths)
+            records, seconds = time_read(paths)
+            print("{:<8} {:>12.1f} {:>8.2f} {:>12.0f} {:>12.1f}".format(
+                compression or "xml",
+                disk_size / 1e6,
+                float(raw_size) / disk_size,
+                records / seconds,
+                raw_size / 1e6 / seconds,
+            ))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
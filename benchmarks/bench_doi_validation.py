@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measure DOI validation throughput against a local stand-in resolver.
+
+Starts an HTTP server that answers like the handle API of doi.org after
+`-l` milliseconds: 200 for the DOIs ending in an even number, 404 for the
+others, and 503 for every `-e`:th request. Validates `-n` DOIs with
+`doi_validator.validate_dois` with every number of workers given with `-w`
+and reports DOIs/sec and the classification.
+
+Example usage:
+    python benchmarks/bench_doi_validation.py -n 500 -l 50 -w 1,4,16,64
+"""
+from __future__ import print_function
+
+import getopt
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fixmarc"))
+
+from doi_validator import validate_dois
+from http_pool import client
+from ratelimit import limiter
+
+
+class Resolver(ThreadingMixIn, HTTPServer):
+    """Threaded stand-in of the handle API."""
+    daemon_threads = True
+    latency = 0.05
+    error_every = 0
+    counter = itertools.count(1)
+
+
+class ResolverHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send the headers and the body in one packet
+    wbufsize = -1
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        n = next(self.server.counter)
+        doi = self.path.split("/api/handles/", 1)[-1]
+        if self.server.error_every and n % self.server.error_every == 0:
+            status, code = 503, 2
+        elif doi[-1:].isdigit() and int(doi[-1]) % 2 == 0:
+            status, code = 200, 1
+        else:
+            status, code = 404, 100
+        body = json.dumps({"responseCode": code, "handle": doi})
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if status == 503:
+            self.send_header("Retry-After", "0")
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+def main(argv):
+    n_dois = 500
+    latency = 50
+    error_every = 0
+    workers_list = [1, 4, 16, 64]
+    helptext = ("USAGE: python bench_doi_validation.py "
+                "[-n <dois> -l <latency_ms> -e <error_every> -w <workers,workers...>]")
+    try:
+        opts, _ = getopt.getopt(argv, "hn:l:e:w:", ["dois=", "latency=", "error_every=", "workers="])
+    except getopt.GetoptError as err:
+        print(err)
+        print(helptext)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == "-h":
+            print(helptext)
+            sys.exit()
+        elif opt in ("-n", "--dois"):
+            n_dois = int(arg)
+        elif opt in ("-l", "--latency"):
+            latency = int(arg)
+        elif opt in ("-e", "--error_every"):
+            error_every = int(arg)
+        elif opt in ("-w", "--workers"):
+            workers_list = [int(n) for n in arg.split(",")]
+
+    server = Resolver(("127.0.0.1", 0), ResolverHandler)
+    server.latency = latency / 1000.0
+    server.error_every = error_every
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    resolver_url = "http://127.0.0.1:{}/api/handles/".format(server.server_address[1])
+    # No backoff for the stand-in
+    limiter.backoff = 0
+
+    print("{:>8} {:>10} {:>8} {:>8} {:>8}".format("workers", "DOIs/s", "valid", "invalid", "error"))
+    for workers in workers_list:
+        dois = ["10.5555/bench.{}.{}".format(workers, i) for i in range(n_dois)]
+        start = time.time()
+        results = validate_dois(dois, workers=workers, resolver_url=resolver_url)
+        seconds = time.time() - start
+        counts = dict((status, 0) for status in ("valid", "invalid", "error"))
+        for status in results.values():
+            counts[status] += 1
+        print("{:>8} {:>10.1f} {:>8} {:>8} {:>8}".format(
+            workers, n_dois / seconds, counts["valid"], counts["invalid"], counts["error"]))
+    # Let the handler threads finish before the interpreter exits
+    client.close()
+    server.shutdown()
+    server.server_close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measure how long importing the fixmarc modules takes.
+
+Imports every module given with `-m` in a fresh interpreter `-r` times and
+reports the median import time, the number of modules loaded, whether the
+network stack (requests) and the INSPIRE client stack (invenio_client,
+splinter, selenium) got loaded, and the peak memory of the interpreter.
+
+Example usage:
+    python benchmarks/bench_import_time.py -r 10
+    python benchmarks/bench_import_time.py -r 10 -m utils,fix_773,pipeline
+"""
+from __future__ import print_function
+
+import getopt
+import json
+import os
+import subprocess
+import sys
+
+FIXMARC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fixmarc")
+
+MODULES = ["utils", "pipeline", "fix_773", "fix_arxiv", "extract_dois", "local_index",
+           "get_inspire_records"]
+
+# Run in the fresh interpreter
+MEASURE = """
+import json, resource, sys, time
+sys.path.insert(0, {fixmarc_dir!r})
+start = time.time()
+import {module}
+seconds = time.time() - start
+print(json.dumps({{
+    "seconds": seconds,
+    "modules": len(sys.modules),
+    "requests": "requests" in sys.modules,
+    "client": any(name in sys.modules for name in ("invenio_client", "splinter", "selenium")),
+    "maxrss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+}}))
+"""
+
+
+def measure(module):
+    """Import a module in a new interpreter. Returns the measurements."""
+    output = subprocess.check_output([
+        sys.executable, "-B", "-c", MEASURE.format(fixmarc_dir=FIXMARC_DIR, module=module)])
+    return json.loads(output.splitlines()[-1])
+
+
+def main(argv):
+    repeat = 5
+    modules = MODULES
+    helptext = "USAGE: python bench_import_time.py [-r <repeat> -m <module,module...>]"
+    try:
+        opts, _ = getopt.getopt(argv, "hr:m:", ["repeat=", "modules="])
+    except getopt.GetoptError as err:
+        print(err)
+        print(helptext)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == "-h":
+            print(helptext)
+            sys.exit()
+        elif opt in ("-r", "--repeat"):
+            repeat = int(arg)
+        elif opt in ("-m", "--modules"):
+            modules = arg.split(",")
+
+    print("{:<20} {:>8} {:>8} {:>9} {:>7} {:>8}".format(
+        "module", "ms", "modules", "requests", "client", "RSS MB"))
+    for module in modules:
+        runs = [measure(module) for _ in range(repeat)]
+        seconds = sorted(run["seconds"] for run in runs)[len(runs) // 2]
+        last = runs[-1]
+        print("{:<20} {:>8.1f} {:>8} {:>9} {:>7} {:>8.1f}".format(
+            module, seconds * 1000, last["modules"], "yes" if last["requests"] else "no",
+            "yes" if last["client"] else "no", last["maxrss"] / 1024.0))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measure how fixing 773__x scales with the number of journal names.
+
+Generates `-n` 773__x strings with journal names picked from `-m` wrong
+names, and matches them both with the combined trie regex of
+`fix_773.get_wrong_name_pattern` and with one regex per name tried one after
+another (what running fix_773 once per name amounts to, without the
+re-parsing). Reports microseconds per 773__x.
+
+Example usage:
+    python benchmarks/bench_journal_mapping.py -n 20000 -m 1,10,100,1000
+"""
+from __future__ import print_function
+
+import getopt
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fixmarc"))
+
+from fix_773 import get_wrong_name_pattern
+
+WORDS = ["Nucl.", "Instrum.", "Methods", "Phys.", "Rev.", "Lett.", "J.", "Conf.",
+         "Ser.", "Proc.", "Suppl.", "Astrophys.", "Eur.", "Mod.", "Int.", "Acta"]
+
+
+def get_names(n_names, rng):
+    """Return `n_names` different journal name like strings."""
+    names = set()
+    while len(names) < n_names:
+        names.add(" ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 5))) +
+                  " " + str(rng.randint(1, 99)))
+    return sorted(names)
+
+
+def main(argv):
+    n_fields = 20000
+    n_names_list = [1, 10, 100, 1000]
+    helptext = "USAGE: python bench_journal_mapping.py [-n <fields> -m <names,names...>]"
+    try:
+        opts, _ = getopt.getopt(argv, "hn:m:", ["fields=", "names="])
+    except getopt.GetoptError as err:
+        print(err)
+        print(helptext)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == "-h":
+            print(helptext)
+            sys.exit()
+        elif opt in ("-n", "--fields"):
+            n_fields = int(arg)
+        elif opt in ("-m", "--names"):
+            n_names_list = [int(n) for n in arg.split(",")]
+
+    print("{:>8} {:>16} {:>16}".format("names", "combined us/x", "one by one us/x"))
+    for n_names in n_names_list:
+        rng = random.Random(0)
+        names = get_names(n_names, rng)
+        xfields = [
+            "{} A{} ({}) {}-{}".format(rng.choice(names), rng.randint(1, 900),
+                                       rng.randint(1970, 2016), 10, 20)
+            for _ in range(n_fields)
+        ]
+
+        combined = get_wrong_name_pattern(names)
+        start = time.time()
+        for xfield in xfields:
+            assert combined.search(xfield)
+        combined_time = time.time() - start
+
+        separate = [
+            (name, re.compile(re.escape(name) + r'\s(.*)\s\((\d*)\)\s(\w+-\w+).*'))
+            for name in names
+        ]
+        start = time.time()
+        for xfield in xfields:
+            for name, pattern in separate:
+                if name in xfield and pattern.search(xfield):
+                    break
+        separate_time = time.time() - start
+
+        print("{:>8} {:>16.2f} {:>16.2f}".format(
+            n_names, combined_time / n_fields * 1e6, separate_time / n_fields * 1e6))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compare the per-record cost of MARC field extraction.
+
+`legacy_marc_to_dict` is the XPath based implementation `utils.marc_to_dict`
+used before `utils.marc_fields` was introduced. It is kept here only as a
+baseline.
+
+Example usage:
+    python benchmarks/bench_marc_fields.py -n 20000
+"""
+from __future__ import print_function
+
+import getopt
+import os
+import sys
+import timeit
+
+from lxml import etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fixmarc"))
+
+from utils import marc_fields, marc_to_dict
+
+
+RECORD = """
+<record xmlns="http://www.loc.gov/MARC21/slim">
+  <controlfield tag="001">1475380</controlfield>
+  <controlfield tag="005">20160810120000.0</controlfield>
+  <datafield tag="035" ind1=" " ind2=" ">
+    <subfield code="a">Gorkavyi:2016bcu</subfield>
+    <subfield code="9">INSPIRETeX</subfield>
+  </datafield>
+  <datafield tag="037" ind1=" " ind2=" ">
+    <subfield code="a">arXiv:1608.01541</subfield>
+    <subfield code="9">arXiv</subfield>
+  </datafield>
+  <datafield tag="100" ind1=" " ind2=" ">
+    <subfield code="a">Gorkavyi, Nick</subfield>
+    <subfield code="u">SSAI, Hampton</subfield>
+  </datafield>
+  <datafield tag="245" ind1=" " ind2=" ">
+    <subfield code="a">A new approach to dark energy problem</subfield>
+  </datafield>
+  <datafield tag="650" ind1="1" ind2="7">
+    <subfield code="a">General Physics</subfield>
+    <subfield code="2">INSPIRE</subfield>
+  </datafield>
+  <datafield tag="773" ind1=" " ind2=" ">
+    <subfield code="x">Nucl. Instrum. Methods A630 (2011) 1-319</subfield>
+  </datafield>
+  <datafield tag="980" ind1=" " ind2=" ">
+    <subfield code="a">HEP</subfield>
+  </datafield>
+</record>
+"""
+
+
+def legacy_marc_to_dict(node, tag):
+    """Convert MARCXML nodes with a given code to a list of dictionaries."""
+    marc_nodes = node.xpath("./*[local-name()='datafield'][@tag='" + tag + "']")
+    marc_dicts = []
+    for node in marc_nodes:
+        marcdict = {}
+        subfields = node.xpath("./*[local-name()='subfield']")
+        for subfield in subfields:
+            try:
+                dkey = subfield.xpath("@code")[0]
+                dvalue = subfield.xpath("text()")[0]
+            except IndexError:
+                continue
+            marcdict[dkey] = dvalue
+        marc_dicts.append({tag: marcdict})
+
+    return marc_dicts
+
+
+def main(argv):
+    number = 20000
+    opts, _ = getopt.getopt(argv, "n:", ["number="])
+    for opt, arg in opts:
+        if opt in ("-n", "--number"):
+            number = int(arg)
+
+    record = etree.fromstring(RECORD)
+    cases = [
+        ("legacy marc_to_dict x2", lambda: (legacy_marc_to_dict(record, "035"),
+                                            legacy_marc_to_dict(record, "037"))),
+        ("marc_to_dict x2", lambda: (marc_to_dict(record, "035"),
+                                     marc_to_dict(record, "037"))),
+        ("marc_fields", lambda: marc_fields(record, ("035", "037"))),
+    ]
+    # Make sure we are comparing like with like
+    legacy = legacy_marc_to_dict(record, "035") + legacy_marc_to_dict(record, "037")
+    fields = marc_fields(record, ("035", "037"))
+    assert legacy == [field.to_dict() for field in fields["035"] + fields["037"]]
+
+    for name, func in cases:
+        seconds = min(timeit.repeat(func, number=number, repeat=3))
+        print("{:<25} {:>8.2f} us/record".format(name, seconds / number * 1e6))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compare the memory used by the MARC field models.
+
+Extracts every datafield of `-n` records both as the old
+`{tag: {code: value}}` dictionaries (`utils.marc_to_dict`) and as
+`marc.DataField` objects, and reports the deep size of each per record.
+Also checks that the DataFields round trip back to the same MARCXML.
+
+Example usage:
+    python benchmarks/bench_record_memory.py -n 10000
+"""
+from __future__ import print_function
+
+import getopt
+import os
+import sys
+
+from lxml import etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fixmarc"))
+
+from bench_marc_fields import RECORD
+from marc import DataField
+from utils import DATAFIELD, marc_fields, marc_to_dict
+
+
+def deep_sizeof(obj, seen=None):
+    """Size of an object and everything it refers to, counting shared objects once."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif hasattr(obj, "__slots__"):
+        size += sum(deep_sizeof(getattr(obj, slot), seen) for slot in obj.__slots__)
+    return size
+
+
+def main(argv):
+    number = 10000
+    opts, _ = getopt.getopt(argv, "n:", ["number="])
+    for opt, arg in opts:
+        if opt in ("-n", "--number"):
+            number = int(arg)
+
+    record = etree.fromstring(RECORD)
+    tags = sorted(set(node.get("tag") for node in record.iterchildren(DATAFIELD)))
+
+    # Parse every record separately, like when streaming a harvest
+    dict_records = [
+        [field for tag in tags for field in marc_to_dict(record, tag)]
+        for _ in range(number)
+    ]
+    slot_records = [
+        [field for fields in marc_fields(record, tags).values() for field in fields]
+        for _ in range(number)
+    ]
+    # Strings are the same in both models, leave them out
+    strings = set()
+    for fields in slot_records:
+        for field in fields:
+            strings.add(id(field.tag))
+            for code, value in field.subfields:
+                strings.update((id(code), id(value)))
+
+    dict_size = deep_sizeof(dict_records, set(strings)) / float(number)
+    slot_size = deep_sizeof(slot_records, set(strings)) / float(number)
+    print("{:<30} {:>8.0f} bytes/record".format("{tag: {code: value}} dicts", dict_size))
+    print("{:<30} {:>8.0f} bytes/record".format("DataField", slot_size))
+    print("{:<30} {:>8.0%}".format("reduction", 1 - slot_size / dict_size))
+
+    # Lossless round trip
+    parser = etree.XMLParser(remove_blank_text=True)
+    plain_record = etree.fromstring(
+        RECORD.replace(' xmlns="http://www.loc.gov/MARC21/slim"', ""), parser)
+    for node in plain_record.iterchildren(DATAFIELD):
+        assert etree.tostring(node) == etree.tostring(DataField.from_node(node).to_node())
+    print("round trip ok")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+"""
+Deterministic generator of INSPIRE-like MARCXML collections.
+
+The records look like what `get_inspire_records.fetch_records` writes: a
+`<collection>` per file with the total number of results in a comment,
+controlfields 001 and 005, and datafields 0247 (DOI), 035, 037 (arXiv),
+100/700 (authors), 245 (title), 773 (pubinfo, with the journal name in
+773__x in different spellings) and 980. The same arguments always produce
+the same files (for a given Python version).
+
+Example usage:
+    python benchmarks/corpus.py -n 100000 -o /tmp/corpus
+    python benchmarks/corpus.py -n 1000 -o /tmp/corpus -f 20 -p 50
+
+    generate_corpus("/tmp/corpus", 1000)
+"""
+from __future__ import print_function
+
+import getopt
+import os
+import random
+import sys
+
+from xml.sax.saxutils import escape
+
+# Journal name spellings for 773__x, (wrong name, correct name)
+JOURNALS = [
+    ("Nucl. Instrum. Methods", "Nucl.Instrum.Meth."),
+    ("Nucl. Instrum. Meth.", "Nucl.Instrum.Meth."),
+    ("Phys. Rev. Lett.", "Phys.Rev.Lett."),
+    ("J. Phys. Conf. Ser.", "J.Phys.Conf.Ser."),
+    ("Nucl. Phys. Proc. Suppl.", "Nucl.Phys.Proc.Suppl."),
+]
+
+ARXIV_CATEGORIES = ["hep-th", "hep-ph", "hep-ex", "astro-ph", "gr-qc", "physics.ins-det"]
+
+SURNAMES = ["Smith", "Virtanen", "Müller", "Rossi", "Tanaka", "Ivanov", "García", "Dubois"]
+
+
+def x773_variants(rng):
+    """Return a 773__x pubinfo string in one of the spellings found in INSPIRE."""
+    wrong_name, _ = rng.choice(JOURNALS)
+    volume = rng.choice(["A", "B", ""]) + str(rng.randint(1, 900))
+    year = rng.randint(1970, 2016)
+    first_page = rng.randint(1, 2000)
+    pages = "{}-{}".format(first_page, first_page + rng.randint(1, 30))
+    return rng.choice([
+        "{} {} ({}) {}".format(wrong_name, volume, year, pages),
+        "{} {} ({}) pp.{}".format(wrong_name, volume, year, pages),
+        "{}, {} ({}) {}".format(wrong_name, volume, year, pages),
+        "{} {} ({}) {}.".format(wrong_name, volume, year, pages),
+    ])
+
+
+def arxiv_037_variants(rng, recid):
+    """Return the subfields of an arXiv 037 field in one of its variants."""
+    if rng.random() < 0.3:
+        report_nr = "{}/{:02d}{:02d}{:03d}".format(
+            rng.choice(["hep-th", "hep-ph", "astro-ph"]),
+            rng.randint(92, 99), rng.randint(1, 12), recid % 1000)
+    else:
+        report_nr = "{:02d}{:02d}.{:05d}".format(
+            rng.randint(7, 16), rng.randint(1, 12), recid % 100000)
+    variant = rng.random()
+    if variant < 0.5:
+        return [("a", "arXiv:" + report_nr), ("9", "arXiv")]
+    elif variant < 0.8:
+        return [("a", "arXiv:" + report_nr), ("9", "arXiv"),
+                ("c", rng.choice(ARXIV_CATEGORIES))]
+    return [("a", report_nr), ("9", "arXiv")]
+
+
+def datafield(tag, subfields, ind1=" ", ind2=" "):
+    """Serialize one datafield."""
+    lines = ['  <datafield tag="{}" ind1="{}" ind2="{}">'.format(tag, ind1, ind2)]
+    for code, value in subfields:
+        lines.append('    <subfield code="{}">{}</subfield>'.format(code, escape(value)))
+    lines.append('  </datafield>')
+    return "\n".join(lines)
+
+
+def generate_record(rng, recid, fields_per_record=10):
+    """Serialize one record with roughly `fields_per_record` datafields."""
+    fields = []
+    if rng.random() < 0.7:
+        fields.append(datafield("024", [
+            ("2", "DOI"), ("a", "10.{}/{}.{}".format(rng.randint(1000, 9999), recid, rng.randint(1, 99)))
+        ], ind1="7"))
+    fields.append(datafield("035", [("a", "Author:{}abc".format(2000 + recid % 17)), ("9", "INSPIRETeX")]))
+    if rng.random() < 0.6:
+        fields.append(datafield("037", arxiv_037_variants(rng, recid)))
+    fields.append(datafield("100", [
+        ("a", "{}, A.".format(rng.choice(SURNAMES))), ("u", "CERN")]))
+    fields.append(datafield("245", [("a", "Measurement number {} of something".format(recid))]))
+    if rng.random() < 0.8:
+        subfields = [("x", x773_variants(rng))]
+        if rng.random() < 0.5:
+            subfields = [("w", "C09-05-13"), ("t", "Prepared for")] + subfields
+        fields.append(datafield("773", subfields))
+    while len(fields) < fields_per_record - 1:
+        fields.append(datafield("700", [
+            ("a", "{}, {}.".format(rng.choice(SURNAMES), chr(65 + rng.randint(0, 25)))),
+            ("u", rng.choice(["CERN", "DESY", "Fermilab", "Helsinki U."]))]))
+    fields.append(datafield("980", [("a", rng.choice(["HEP", "ConferencePaper", "Published"]))]))
+
+    return "\n".join([
+        "<record>",
+        '  <controlfield tag="001">{}</controlfield>'.format(recid),
+        '  <controlfield tag="005">2016{:02d}{:02d}120000.0</controlfield>'.format(
+            rng.randint(1, 12), rng.randint(1, 28)),
+    ] + fields + ["</record>"])
+
+
+def generate_corpus(outdir, n_records, records_per_file=250, fields_per_record=10, seed=0):
+    """Write `n_records` records to files of `records_per_file` records.
+
+    Returns the list of files written.
+    """
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    rng = random.Random(seed)
+    files = []
+    for start in range(0, n_records, records_per_file):
+        outfile = os.path.join(outdir, "records_{:08d}.xml".format(start + 1))
+        with open(outfile, "wb") as f:
+            f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+            f.write("<!-- Search-Engine-Total-Number-Of-Results: {} -->\n".format(
+                n_records).encode("utf-8"))
+            f.write(b'<collection xmlns="http://www.loc.gov/MARC21/slim">\n')
+            for recid in range(start + 1, min(start + records_per_file, n_records) + 1):
+                record = generate_record(rng, recid, fields_per_record)
+                if not isinstance(record, bytes):
+                    record = record.encode("utf-8")
+                f.write(record + b"\n")
+            f.write(b"</collection>\n")
+        files.append(outfile)
+    return files
+
+
+def main(argv):
+    n_records = 1000
+    outdir = "corpus"
+    fields_per_record = 10
+    records_per_file = 250
+    helptext = "USAGE: python corpus.py -n <records> -o <outdir> [-f <fields_per_record> -p <records_per_file>]"
+    try:
+        opts, _ = getopt.getopt(argv, "hn:o:f:p:", ["records=", "outdir=", "fields=", "per_file="])
+    except getopt.GetoptError as err:
+        print(err)
+        print(helptext)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == "-h":
+            print(helptext)
+            sys.exit()
+        elif opt in ("-n", "--records"):
+            n_records = int(arg)
+        elif opt in ("-o", "--outdir"):
+            outdir = arg
+        elif opt in ("-f", "--fields"):
+            fields_per_record = int(arg)
+        elif opt in ("-p", "--per_file"):
+            records_per_file = int(arg)
+
+    files = generate_corpus(outdir, n_records, records_per_file, fields_per_record)
+    print("Wrote " + str(n_records) + " records to " + str(len(files)) + " files in " + outdir)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
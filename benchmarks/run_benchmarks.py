@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks of the hot paths on synthetic corpora.
+
+For every corpus size a deterministic corpus is generated with `corpus.py`
+(and reused if it already exists in the corpus directory), and every
+benchmark is run in a separate process so that its peak memory can be
+measured. Reports records/sec and peak RSS.
+
+Benchmarks:
+    load_xml_files              parse whole files into trees (the old way)
+    iter_xml_records            stream the records with iterparse
+    marc_to_dict                old dictionaries, one call per tag
+    marc_fields                 DataFields of all tags in one pass
+    split_773__x                fix the 773 fields, parsing excluded
+    get_fixed_arxiv_marc_fields fix 035/037 with the arXiv lookup stubbed
+    write_corrected_marcxml     write fixed 773 fields to a file
+
+Example usage:
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py -s 1000,100000,1000000 -c /tmp/corpora -b marc_fields,write_corrected_marcxml
+    python benchmarks/run_benchmarks.py -s 100000 -j results.json
+
+"""
+from __future__ import print_function
+
+import getopt
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "fixmarc"))
+
+
+def bench_load_xml_files(paths):
+    # The whole trees are kept like the removed utils.load_xml_files did
+    from lxml import etree
+    from compression import open_xml_file
+    collections = []
+    for xml_file in paths:
+        with open_xml_file(xml_file) as f:
+            collections.append(etree.parse(f))
+    return sum(len(collection.xpath("//*[local-name()='record']")) for collection in collections)
+
+
+def bench_iter_xml_records(paths):
+    from utils import iter_xml_records
+    return sum(1 for _ in iter_xml_records(paths))
+
+
+def bench_marc_to_dict(paths):
+    from utils import iter_xml_records, marc_to_dict
+    n_records = 0
+    for record in iter_xml_records(paths):
+        for tag in ("024", "035", "037", "773"):
+            marc_to_dict(record, tag)
+        n_records += 1
+    return n_records
+
+
+def bench_marc_fields(paths):
+    from utils import iter_xml_records, marc_fields
+    n_records = 0
+    for record in iter_xml_records(paths):
+        marc_fields(record, ("024", "035", "037", "773"))
+        n_records += 1
+    return n_records
+
+
+def get_773_fields(paths):
+    """Extract the 773 fields and the wrong journal names to fix."""
+    from corpus import JOURNALS
+    from utils import get_recid, iter_xml_records, marc_fields
+    fields = []
+    for record in iter_xml_records(paths):
+        for m773 in marc_fields(record, ("773",))["773"]:
+            if "x" in m773:
+                fields.append((m773, get_recid(record)))
+    return fields, JOURNALS[0]
+
+
+def bench_split_773__x(paths, setup=None):
+    if setup is None:
+        return get_773_fields(paths)
+    from fix_773 import get_wrong_name_pattern, split_773__x
+    fields, (wrong_name, correct_name) = setup
+    pattern = get_wrong_name_pattern(wrong_name)
+    for m773, _ in fields:
+        split_773__x(m773, pattern, {wrong_name: correct_name})
+    return len(fields)
+
+
+def bench_get_fixed_arxiv_marc_fields(paths):
+    import fix_arxiv
+    from utils import iter_xml_records, marc_fields
+    fix_arxiv.get_arxiv_category = lambda report_nr, cache=None: "hep-th"
+    n_records = 0
+    for record in iter_xml_records(paths):
+        # Only the records with an arXiv 037 need the fix
+        if any("arxiv" in m037.get("9", "").lower() and "a" in m037
+               for m037 in marc_fields(record, ("037",))["037"]):
+            fix_arxiv.get_fixed_arxiv_marc_fields(record)
+            n_records += 1
+    return n_records
+
+
+def bench_write_corrected_marcxml(paths, setup=None):
+    if setup is None:
+        return get_773_fields(paths)
+    from utils import write_corrected_marcxml
+    fields, _ = setup
+    outdir = tempfile.mkdtemp()
+    try:
+        write_corrected_marcxml((([m773], recid) for m773, recid in fields), outdir)
+    finally:
+        shutil.rmtree(outdir)
+    return len(fields)
+
+
+BENCHMARKS = [
+    "load_xml_files",
+    "iter_xml_records",
+    "marc_to_dict",
+    "marc_fields",
+    "split_773__x",
+    "get_fixed_arxiv_marc_fields",
+    "write_corrected_marcxml",
+]
+
+# These get their input prepared first, and only the rest is timed
+WITH_SETUP = ("split_773__x", "write_corrected_marcxml")
+
+
+def run_one(name, corpus_dir):
+    """Run a benchmark in this process and return its results."""
+    from utils import find_local_files
+    func = globals()["bench_" + name]
+    paths = find_local_files(corpus_dir)
+    # Keep the prints of the code under test out of the results
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        setup = func(paths) if name in WITH_SETUP else None
+        start = time.time()
+        if name in WITH_SETUP:
+            n_records = func(paths, setup)
+        else:
+            n_records = func(paths)
+        seconds = time.time() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return {
+        "benchmark": name,
+        "records": n_records,
+        "seconds": seconds,
+        "records_per_second": n_records / seconds if seconds else None,
+        # kB on Linux
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run_in_subprocess(name, corpus_dir):
+    """Run a benchmark in a fresh interpreter so that its peak memory is its own."""
+    output = subprocess.check_output([
+        sys.executable, os.path.abspath(__file__), "--run", name, "-c", corpus_dir])
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def main(argv):
+    sizes = [1000]
+    corpus_root = None
+    benchmarks = BENCHMARKS
+    json_file = None
+    run = None
+    helptext = (
+        "USAGE: python run_benchmarks.py [-s <sizes> -c <corpus_dir> "
+        "-b <benchmarks> -j <json_file>]"
+    )
+    try:
+        opts, _ = getopt.getopt(
+            argv, "hs:c:b:j:", ["sizes=", "corpus_dir=", "benchmarks=", "json=", "run="])
+    except getopt.GetoptError as err:
+        print(err)
+        print(helptext)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == "-h":
+            print(helptext)
+            sys.exit()
+        elif opt in ("-s", "--sizes"):
+            sizes = [int(size) for size in arg.split(",")]
+        elif opt in ("-c", "--corpus_dir"):
+            corpus_root = arg
+        elif opt in ("-b", "--benchmarks"):
+            benchmarks = arg.split(",")
+        elif opt in ("-j", "--json"):
+            json_file = arg
+        elif opt == "--run":
+            run = arg
+
+    if run:
+        # Child process: corpus_root is the corpus itself
+        print(json.dumps(run_one(run, corpus_root)))
+        return
+
+    from corpus import generate_corpus
+    temporary_root = corpus_root is None
+    if temporary_root:
+        corpus_root = tempfile.mkdtemp(prefix="fixmarc_corpus_")
+    results = []
+    try:
+        for size in sizes:
+            corpus_dir = os.path.join(corpus_root, str(size))
+            if not os.path.exists(corpus_dir):
+                print("Generating a corpus of " + str(size) + " records in " + corpus_dir)
+                generate_corpus(corpus_dir, size)
+            print("\n{} records".format(size))
+            print("{:<30} {:>10} {:>10} {:>14} {:>14}".format(
+                "benchmark", "records", "seconds", "records/sec", "peak RSS kB"))
+            for name in benchmarks:
+                result = run_in_subprocess(name, corpus_dir)
+                result["corpus_size"] = size
+                results.append(result)
+                print("{:<30} {:>10} {:>10.2f} {:>14.0f} {:>14}".format(
+                    name, result["records"], result["seconds"],
+                    result["records_per_second"] or 0, result["peak_rss_kb"]))
+    finally:
+        if temporary_root:
+            shutil.rmtree(corpus_root)
+
+    if json_file:
+        with open(json_file, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+"""
+Persistent cache for arXiv OAI responses.
+
+The raw OAI-PMH response and the parsed primary category are stored in an
+SQLite database keyed by the arXiv report number, so rerunning a correction
+(e.g. after a crash) doesn't have to query arXiv again. Categories harvested
+in bulk are stored without the response.
+
+Example usage:
+    cache = ArxivCache("arxiv_cache.db", ttl=30 * 24 * 3600)
+    cached = cache.get("1608.01541")
+    if cached is None:
+        ...
+        cache.set("1608.01541", response, "gen-ph")
+    print(cache.stats())
+
+"""
+from __future__ import print_function
+
+import sqlite3
+import time
+
+
+class ArxivCache(object):
+    """SQLite backed cache of arXiv responses keyed by report number.
+
+    :param path: path of the database file
+    :param ttl: optional time to live of an entry in seconds
+    :param max_entries: optional maximum number of entries to keep
+    """
+    def __init__(self, path, ttl=None, max_entries=None):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "report_nr TEXT PRIMARY KEY, "
+            "response BLOB, "
+            "category TEXT, "
+            "fetched REAL)"
+        )
+        self.connection.commit()
+
+    def _is_expired(self, fetched):
+        """Check if an entry fetched at `fetched` is too old."""
+        return self.ttl is not None and fetched < time.time() - self.ttl
+
+    def get(self, report_nr):
+        """Return a `(response, category)` tuple or None if not cached."""
+        row = self.connection.execute(
+            "SELECT response, category, fetched FROM responses WHERE report_nr = ?",
+            (report_nr,)
+        ).fetchone()
+        if row is None or self._is_expired(row[2]):
+            self.misses += 1
+            return None
+        self.hits += 1
+        response = bytes(row[0]) if row[0] is not None else None
+        return response, row[1]
+
+    def set(self, report_nr, response, category):
+        """Store the raw response and the parsed category of a report number."""
+        self.connection.execute(
+            "INSERT OR REPLACE INTO responses (report_nr, response, category, fetched) "
+            "VALUES (?, ?, ?, ?)",
+            (report_nr, sqlite3.Binary(response) if response is not None else None,
+             category, time.time())
+        )
+        self.connection.commit()
+
+    def set_categories(self, categories):
+        """Store many `(report_nr, category)` pairs without the responses.
+
+        Used for the categories harvested in bulk.
+        """
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO responses (report_nr, response, category, fetched) "
+            "VALUES (?, NULL, ?, ?)",
+            ((report_nr, category, now) for report_nr, category in categories)
+        )
+        self.connection.commit()
+
+    def evict(self):
+        """Remove the expired entries and the oldest ones over `max_entries`."""
+        if self.ttl is not None:
+            self.connection.execute(
+                "DELETE FROM responses WHERE fetched < ?", (time.time() - self.ttl,))
+        if self.max_entries is not None:
+            self.connection.execute(
+                "DELETE FROM responses WHERE report_nr NOT IN ("
+                "SELECT report_nr FROM responses ORDER BY fetched DESC LIMIT ?)",
+                (self.max_entries,)
+            )
+        self.connection.commit()
+
+    def stats(self):
+        """Return a short summary of the cache usage."""
+        return "arXiv cache {}: {} hits, {} misses".format(self.path, self.hits, self.misses)
+
+    def close(self, evict=True):
+        """Evict old entries and close the database."""
+        if evict:
+            self.evict()
+        self.connection.close()
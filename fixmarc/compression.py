@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+"""
+Reading and writing compressed MARCXML files.
+
+Harvested pages can be stored compressed with gzip (.xml.gz), xz (.xml.xz) or
+zstandard (.xml.zst). `open_xml_file` picks the codec from the file name and
+returns a file object that (de)compresses while reading or writing, so the
+files can be parsed incrementally without unpacking them first.
+
+gzip is always available. xz needs the lzma module (`pip install
+backports.lzma` on Python 2) and zstandard the `zstandard` package.
+
+Example usage:
+    with open_xml_file("records_00000001.xml.gz") as f:
+        for _, node in etree.iterparse(f, tag="{*}record"):
+            ...
+    with open_xml_file("records.xml.part", "wb", compression="zst") as f:
+        f.write(page)
+
+"""
+from __future__ import print_function
+
+import gzip
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compression name by file extension
+COMPRESSIONS = {
+    ".gz": "gz",
+    ".xz": "xz",
+    ".zst": "zst",
+}
+
+XML_EXTENSIONS = tuple([".xml"] + [".xml" + extension for extension in COMPRESSIONS])
+
+
+def get_compression(path):
+    """Return the compression of a file by its name, None if it is not compressed."""
+    for extension, compression in COMPRESSIONS.items():
+        if path.endswith(extension):
+            return compression
+
+
+def is_xml_file(path):
+    """Check if a file name is of a plain or compressed XML file."""
+    return path.endswith(XML_EXTENSIONS)
+
+
+def get_extension(compression):
+    """Return the file extension of XML files with the compression."""
+    if compression is None:
+        return ".xml"
+    if compression not in COMPRESSIONS.values():
+        raise ValueError("Unknown compression: " + str(compression))
+    return ".xml." + compression
+
+
+def open_xml_file(path, mode="rb", compression="auto"):
+    """Open a plain or compressed XML file in binary mode.
+
+    By default the compression is chosen by the file name, give it
+    explicitly (or None) for e.g. temporary files.
+    """
+    if compression == "auto":
+        compression = get_compression(path)
+    if compression is None:
+        return open(path, mode)
+    if compression == "gz":
+        return gzip.open(path, mode)
+    if compression == "xz":
+        if lzma is None:
+            raise ValueError("Reading and writing .xz files needs the lzma module, "
+                             "on Python 2 install backports.lzma")
+        return lzma.open(path, mode)
+    if compression == "zst":
+        if zstandard is None:
+            raise ValueError("Reading and writing .zst files needs the zstandard package")
+        return zstandard.open(path, mode)
+    raise ValueError("Unknown compression: " + str(compression))
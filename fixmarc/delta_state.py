@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+"""
+Per record state for incremental (delta) fix runs.
+
+For every fixer (and its parameters) the state database keeps the last seen
+modification timestamp (controlfield 005) of every recid, a hash of the
+record and whether a fix was emitted for it. A record whose 005 and content
+are the same as in the previous run is skipped before it is fixed, so weekly
+runs over a fresh harvest only cost as much as there are changes.
+
+The records seen during a run are first kept aside and only become the new
+state with `finish_run`, i.e. after the corrections have been written. An
+interrupted run doesn't hide records from the next one. Likewise a record
+whose fix failed must not be added, so that the next run tries it again.
+
+`add` only collects the records in memory, so the worker processes of a
+parallel run only read the database. They hand the collected rows
+(`pop_seen`) to the main process, which writes them with `save_seen`.
+Otherwise every worker would hold a write lock for a whole file and the
+others would wait for it.
+
+Example usage:
+    state = DeltaState("fix_773_state.db", "fix_773 Nucl. Instrum. Methods")
+    state.start_run()
+    for record in records:
+        seen = state.check(record)
+        if seen is None:
+            continue  # unchanged since the last run
+        ...  # on failure: continue without add
+        state.add(seen, fixed=True)
+    ... write the corrections ...
+    state.finish_run()
+    state.close()
+
+"""
+from __future__ import print_function
+
+import hashlib
+import sqlite3
+
+from lxml import etree
+
+from runstats import stats
+from utils import CONTROLFIELD, get_recid
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    fixer TEXT,
+    recid TEXT,
+    modified TEXT,
+    hash TEXT,
+    fixed INTEGER,
+    PRIMARY KEY (fixer, recid)
+);
+CREATE TABLE IF NOT EXISTS pending (
+    fixer TEXT,
+    recid TEXT,
+    modified TEXT,
+    hash TEXT,
+    fixed INTEGER,
+    PRIMARY KEY (fixer, recid)
+);
+"""
+
+
+def get_modified(record):
+    """Return the modification timestamp (controlfield 005) of a record node or None."""
+    for node in record.iterchildren(CONTROLFIELD):
+        if node.get("tag") == "005":
+            return node.text
+
+
+def get_record_hash(record):
+    """Return a hash of the contents of a record node."""
+    return hashlib.sha1(etree.tostring(record, encoding="utf-8", with_tail=False)).hexdigest()
+
+
+class DeltaState(object):
+    """SQLite state of the records a fixer has already seen.
+
+    :param path: path of the database file
+    :param fixer: name of the fixer and its parameters, the runs of
+        different fixers don't affect each other
+    """
+    def __init__(self, path, fixer):
+        self.path = path
+        self.fixer = fixer
+        self.seen = []
+        # Worker processes read the same database
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+
+    def start_run(self):
+        """Forget the records left aside by an earlier, interrupted run."""
+        self.connection.execute("DELETE FROM pending WHERE fixer = ?", (self.fixer,))
+        self.connection.commit()
+
+    def check(self, record):
+        """Check if a record node is new or has changed since the last run.
+
+        Returns None for an unchanged record, otherwise the
+        `(recid, modified, hash)` to pass to `add`. Records without a recid
+        always count as changed.
+        """
+        recid = get_recid(record)
+        modified = get_modified(record)
+        record_hash = get_record_hash(record)
+        if recid:
+            row = self.connection.execute(
+                "SELECT modified, hash FROM records WHERE fixer = ? AND recid = ?",
+                (self.fixer, recid)
+            ).fetchone()
+            if row is not None and tuple(row) == (modified, record_hash):
+                stats.incr("records_unchanged")
+                return None
+        stats.incr("records_changed")
+        return recid, modified, record_hash
+
+    def add(self, seen, fixed):
+        """Set aside a record returned by `check`, and whether it got a fix."""
+        recid, modified, record_hash = seen
+        if not recid:
+            return
+        self.seen.append((recid, modified, record_hash, int(fixed)))
+
+    def pop_seen(self):
+        """Return the `(recid, modified, hash, fixed)` rows added so far and forget them."""
+        seen = self.seen
+        self.seen = []
+        return seen
+
+    def save_seen(self, rows):
+        """Write rows from `pop_seen`, e.g. of a worker process, to the database.
+
+        Committed right away, the worker processes can't open the database
+        while a write is pending.
+        """
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO pending (fixer, recid, modified, hash, fixed) "
+            "VALUES (?, ?, ?, ?, ?)",
+            ((self.fixer,) + tuple(row) for row in rows)
+        )
+        self.connection.commit()
+
+    def finish_run(self):
+        """Make the records seen during the run the new state."""
+        self.save_seen(self.pop_seen())
+        self.connection.execute(
+            "INSERT OR REPLACE INTO records (fixer, recid, modified, hash, fixed) "
+            "SELECT fixer, recid, modified, hash, fixed FROM pending WHERE fixer = ?",
+            (self.fixer,)
+        )
+        self.connection.execute("DELETE FROM pending WHERE fixer = ?", (self.fixer,))
+        self.connection.commit()
+
+    def close(self):
+        """Save the records set aside and close the database."""
+        self.save_seen(self.pop_seen())
+        self.connection.close()
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+"""
+Check many DOIs against the DOI resolver concurrently.
+
+Every DOI is looked up with the handle API of the resolver
+(https://doi.org/api/handles/<doi>) and classified as
+    * "valid": the resolver knows the DOI,
+    * "invalid": the resolver answered that the DOI doesn't exist,
+    * "error": no answer within the timeout and the retries, or an
+      unexpected one.
+
+The lookups run in a pool of threads, so at most `workers` requests are in
+flight at a time, and go through the shared rate limiter and the pooled
+connections of `http_pool`, so with the real resolver more workers only
+help until its rate limit is reached. The valid and invalid results can be
+kept in an SQLite cache, the errors are tried again on the next run.
+
+The resolver URL can be pointed to a local stand-in for testing, it only
+has to answer GET <resolver_url><doi> with 200 for the valid DOIs and 404
+for the invalid ones.
+
+Example usage:
+    results = validate_dois(dois, workers=16, cache_file="doi_cache.db")
+    valid_dois = [doi for doi, status in results.items() if status == VALID]
+
+"""
+from __future__ import print_function
+
+import json
+import sqlite3
+import time
+
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.compat import quote
+
+from http_pool import client
+from ratelimit import limiter
+from runstats import stats
+
+RESOLVER_URL = "https://doi.org/api/handles/"
+
+VALID = "valid"
+INVALID = "invalid"
+ERROR = "error"
+
+# Seconds to wait for connecting to the resolver and for its answer
+DEFAULT_TIMEOUT = (5, 15)
+
+# The handle API answers with 1 for a found handle and 100 for an unknown one
+HANDLE_FOUND = 1
+HANDLE_NOT_FOUND = 100
+
+
+def to_text(doi):
+    """Return a DOI as unicode, the way it is stored in the cache."""
+    if isinstance(doi, bytes):
+        return doi.decode("utf-8", "replace")
+    return doi
+
+
+class DOICache(object):
+    """SQLite backed cache of DOI validation results.
+
+    :param path: path of the database file
+    :param ttl: optional time to live of an entry in seconds
+    """
+    def __init__(self, path, ttl=None):
+        self.path = path
+        self.ttl = ttl
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS dois ("
+            "doi TEXT PRIMARY KEY, "
+            "status TEXT, "
+            "checked REAL)"
+        )
+        self.connection.commit()
+
+    def get_many(self, dois):
+        """Return a dictionary of the cached statuses of the DOIs."""
+        oldest = time.time() - self.ttl if self.ttl is not None else 0
+        by_text = dict((to_text(doi), doi) for doi in dois)
+        texts = list(by_text)
+        cached = {}
+        # Stay below the SQLite limit of 999 variables
+        for i in range(0, len(texts), 500):
+            batch = texts[i:i + 500]
+            for doi, status in self.connection.execute(
+                    "SELECT doi, status FROM dois WHERE checked >= ? AND doi IN (" +
+                    ", ".join("?" * len(batch)) + ")",
+                    [oldest] + batch):
+                cached[by_text[doi]] = str(status)
+        return cached
+
+    def set(self, doi, status):
+        """Store the status of a DOI."""
+        self.connection.execute(
+            "INSERT OR REPLACE INTO dois (doi, status, checked) VALUES (?, ?, ?)",
+            (to_text(doi), status, time.time())
+        )
+
+    def close(self):
+        """Save the results and close the database."""
+        self.connection.commit()
+        self.connection.close()
+
+
+def get_handle_url(doi, resolver_url=RESOLVER_URL):
+    """Return the URL of the handle API for a DOI."""
+    if isinstance(doi, type(u"")):
+        doi = doi.encode("utf-8")
+    return resolver_url + quote(doi, safe="/")
+
+
+def classify_response(response):
+    """Return the status of a DOI by the response of the handle API."""
+    if response.status_code == 404:
+        return INVALID
+    if response.status_code != 200:
+        return ERROR
+    try:
+        response_code = json.loads(response.content).get("responseCode", HANDLE_FOUND)
+    except ValueError:
+        # A plain resolver, not the handle API
+        return VALID
+    if response_code == HANDLE_FOUND:
+        return VALID
+    if response_code == HANDLE_NOT_FOUND:
+        return INVALID
+    return ERROR
+
+
+def validate_doi(doi, resolver_url=RESOLVER_URL, timeout=DEFAULT_TIMEOUT, retries=2):
+    """Look up a DOI from the resolver. Returns VALID, INVALID or ERROR.
+
+    `retries` is the number of retries when the resolver answers 429 or
+    503, connection errors and timeouts are retried by `http_pool.client`.
+    """
+    try:
+        response = limiter.request(
+            "GET",
+            get_handle_url(doi, resolver_url),
+            retries=retries,
+            timeout=timeout
+        )
+    except requests.RequestException:
+        return ERROR
+    return classify_response(response)
+
+
+def validate_dois(dois, workers=8, cache_file=None, cache_ttl=None,
+                  resolver_url=RESOLVER_URL, timeout=DEFAULT_TIMEOUT, retries=2):
+    """Validate DOIs concurrently. Returns a dictionary of the statuses by DOI.
+
+    :param workers: number of requests in flight at a time
+    :param cache_file: optional SQLite database of earlier results
+    :param cache_ttl: time to live of the cached results in seconds
+    """
+    dois = set(dois)
+    cache = DOICache(cache_file, ttl=cache_ttl) if cache_file else None
+    results = cache.get_many(dois) if cache else {}
+    stats.incr("doi_cache_hits", len(results))
+    todo = sorted(dois - set(results))
+
+    def check(doi):
+        """Validate one DOI in a thread."""
+        return doi, validate_doi(doi, resolver_url=resolver_url,
+                                 timeout=timeout, retries=retries)
+
+    if workers > client.pool_size:
+        # Keep a connection open for every thread
+        client.configure(pool_size=workers)
+    stats.start_progress(len(todo), "DOIs")
+    pool = ThreadPool(workers) if workers > 1 and todo else None
+    try:
+        with stats.stage("validate_dois"):
+            checked = pool.imap_unordered(check, todo) if pool else (check(doi) for doi in todo)
+            for doi, status in checked:
+                results[doi] = status
+                stats.incr("dois_" + status)
+                if cache and status != ERROR:
+                    cache.set(doi, status)
+                stats.advance()
+        if pool:
+            pool.close()
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+        if cache:
+            cache.close()
+    return results
+
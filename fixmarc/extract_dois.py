@@ -10,42 +10,168 @@ input_file = "../tmp/input/isolde.csv"
 new_dois = get_dois_not_in_inspire(input_file)
 write_list_to_file(new_dois, outdir="../tmp/")
 
+# Or check against a local index of harvested records (see local_index)
+new_dois = get_dois_not_in_inspire(input_file, index=LocalIndex("inspire_index.db"))
+
+# Only extract the DOIs of a big file with 8 processes, straight to a file
+extract_dois(input_file, jobs=8, outfile="../tmp/dois.txt")
+
+# Drop the DOIs the resolver doesn't know (see doi_validator)
+new_dois = get_valid_dois(new_dois, workers=16, cache_file="doi_cache.db")
+
+Or from the command line:
+python extract_dois.py -i ../tmp/input/isolde.csv -o ../tmp/dois.txt -j 8
+python extract_dois.py -i ../tmp/input/isolde.csv -d inspire_index.db -x ../tmp/
+python extract_dois.py -i ../tmp/input/isolde.csv -x ../tmp/ --validate 16 --doi_cache doi_cache.db
+
 """
 from __future__ import absolute_import, print_function
 
 import csv
+import getopt
+import os
 import re
+import sys
+
+from multiprocessing import Pool
 from tempfile import mkstemp
 
-import requests
+from lxml import etree
+from requests.compat import quote_plus
+
+from doi_validator import ERROR, INVALID, RESOLVER_URL, VALID, validate_doi, validate_dois
+from utils import marc_fields
+
+# Keep the search URLs well below the usual 8 kB limit
+MAX_QUERY_LENGTH = 4000
+
+# The columns of the input file with DOIs in them
+DOI_COLUMNS = ("DOI", "Reference")
+
+DOI_PATTERN = re.compile(r'(\d{2}\.\d{4}.*/.*)')
+
+# Maximum size of the pieces of the input file for the worker processes
+CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def get_chunks(input_file, jobs, chunk_size=CHUNK_SIZE):
+    """Split a file to `(start, end)` byte ranges for the worker processes.
 
-from get_inspire_records import fetch_records
+    There are at least `jobs` ranges and at most `chunk_size` bytes in one.
+    """
+    size = os.path.getsize(input_file)
+    n_chunks = max(jobs, -(-size // chunk_size), 1)
+    step = -(-size // n_chunks) or 1
+    return [(start, min(start + step, size)) for start in range(0, size, step)]
 
 
-def extract_dois(input_file):
-    """Extract DOIs from a CSV file."""
-    with open(input_file) as csvfile:
-        reader = csv.DictReader(csvfile, delimiter="\t")
-        records = []
-        for record in reader:
-            # records.append(record) # If you want the whole record
-            # records.append({"DOI": record["DOI"], "Reference": record["Reference"]})
-            # take only DOI and reference columns and put them in a list,
-            # we don't care about order or anything
-            records.append(record["DOI"])
-            records.append(record["Reference"])
+def iter_lines(input_file, start, end):
+    """Yield the lines of a file that start within the byte range `start`...`end`.
 
-    # Now we have a big list with all the raw data, let's find the DOIs
+    Every line belongs to exactly one range, so the ranges can be read
+    separately. The rows must not have line breaks inside quoted fields.
+    """
+    with open(input_file, "rb") as f:
+        position = start
+        if start > 0:
+            # Skip the line that began in the previous range
+            f.seek(start - 1)
+            position += len(f.readline()) - 1
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line
+
+
+def get_columns(input_file, columns=DOI_COLUMNS):
+    """Return the indices of the columns in the header of a TSV file."""
+    with open(input_file, "rb") as f:
+        header = next(csv.reader(f, delimiter="\t"), [])
+    return [header.index(column) for column in columns if column in header]
+
+
+def extract_doi(text):
+    """Return the DOI in a string or None."""
+    doi_search_result = DOI_PATTERN.search(text)
+    # This should find them all, no need to check for DOI: or doi.dx.org/
+    if doi_search_result:
+        return clean_text(doi_search_result.group(1).split(" ", 1)[0])
+
+
+def extract_dois_from_range(input_file, start, end, columns):
+    """Extract the DOIs of the rows in a byte range of a TSV file.
+
+    Returns the DOIs in the order they first appear, without duplicates.
+    This is what the worker processes run with `jobs` > 1.
+    """
     dois = []
-    for line in records:
-        doi_search_result = re.search(r'(\d{2}\.\d{4}.*/.*)', line)
-        # This should find them all, no need to check for DOI: or doi.dx.org/
-        if doi_search_result:
-            doi = doi_search_result.group(1).split(" ", 1)[0]
-            doi = clean_text(doi)
-            dois.append(doi)
+    seen = set()
+    lines = iter_lines(input_file, start, end)
+    if start == 0:
+        # The header
+        next(lines, None)
+    for row in csv.reader(lines, delimiter="\t"):
+        # take only DOI and reference columns, we don't care about order or anything
+        for column in columns:
+            if column >= len(row):
+                continue
+            doi = extract_doi(row[column])
+            if doi is not None and doi not in seen:
+                seen.add(doi)
+                dois.append(doi)
+    return dois
+
+
+def call_extract_dois_from_range(args):
+    """Unpack the arguments of `extract_dois_from_range` for `Pool.imap`."""
+    return extract_dois_from_range(*args)
+
+
+def extract_dois(input_file, jobs=1, outfile=None, chunk_size=CHUNK_SIZE):
+    """Extract DOIs from a CSV file.
+
+    The file is read line by line and duplicates are dropped as they come,
+    so only the set of distinct DOIs is kept in memory. With `jobs` > 1 the
+    file is split to byte ranges of at most `chunk_size` bytes that are read
+    in parallel worker processes. With `outfile` every new DOI is also
+    written to the file right away, one per row, in the order they first
+    appear.
+    """
+    columns = get_columns(input_file)
+    chunks = [
+        (input_file, start, end, columns)
+        for start, end in get_chunks(input_file, jobs, chunk_size)
+    ]
+    pool = None
+    if jobs > 1:
+        pool = Pool(jobs)
+        results = pool.imap(call_extract_dois_from_range, chunks)
+    else:
+        results = (extract_dois_from_range(*chunk) for chunk in chunks)
+
+    dois = set()
+    out = open(outfile, "w") if outfile else None
+    try:
+        for chunk_dois in results:
+            for doi in chunk_dois:
+                if doi not in dois:
+                    dois.add(doi)
+                    if out:
+                        out.write(doi + "\n")
+        if pool:
+            pool.close()
+    finally:
+        if out:
+            out.close()
+        if pool:
+            pool.terminate()
+            pool.join()
 
-    return set(dois)
+    if outfile:
+        print("Wrote " + str(len(dois)) + " DOIs to file " + outfile)
+    return dois
 
 
 def clean_text(text):
@@ -61,19 +187,32 @@ def clean_text(text):
 
 def test_valid_doi(doi):
     """Test that the string is a valid DOI."""
-    # FIXME: here come some strange errors:
-    # requests.exceptions.ConnectionError: ('Connection aborted.',
-    # BadStatusLine("''",))
-    req = requests.post(url="http://www.dx.doi.org/", data={"hdl": doi})
-    if req.status_code == 200:
+    if validate_doi(doi) == VALID:
         return True
     else:
         print(doi + " is not a valid DOI!")
         return False
 
 
+def get_valid_dois(dois, workers=8, cache_file=None, resolver_url=RESOLVER_URL):
+    """Return the DOIs sorted, without the ones the resolver doesn't know.
+
+    The DOIs are validated concurrently with `doi_validator.validate_dois`,
+    the ones that couldn't be checked are kept.
+    """
+    results = validate_dois(dois, workers=workers, cache_file=cache_file,
+                            resolver_url=resolver_url)
+    counts = dict((status, 0) for status in (VALID, INVALID, ERROR))
+    for status in results.values():
+        counts[status] += 1
+    print("Validated " + str(len(results)) + " DOIs: " + str(counts[VALID]) + " valid, " +
+          str(counts[INVALID]) + " invalid, " + str(counts[ERROR]) + " couldn't be checked")
+    return sorted(doi for doi, status in results.items() if status != INVALID)
+
+
 def check_doi_in_inspire(doi):
     """Check if we have a record with a certain DOI in INSPIRE already."""
+    from get_inspire_records import fetch_records
     return bool(
         fetch_records(
             inspire_pattern="doi:" + doi,
@@ -82,17 +221,64 @@ def check_doi_in_inspire(doi):
     )
 
 
-def get_dois_not_in_inspire(input_file):
-    """Return DOIs that are not in INSPIRE yet."""
-    dois = extract_dois(input_file)
-    new_dois = []
+def get_doi_queries(dois, max_length=MAX_QUERY_LENGTH):
+    """Pack DOIs into OR-combined INSPIRE queries.
+
+    Each query is at most `max_length` characters when URL encoded.
+    """
+    query = ""
     for doi in dois:
-        if not check_doi_in_inspire(doi):
-            # import time; time.sleep(10)  # Don't annoy dx.doi.org too much
-            # if test_valid_doi(doi):
-            new_dois.append(doi)
+        term = 'doi:"{}"'.format(doi)
+        candidate = query + " or " + term if query else term
+        if query and len(quote_plus(candidate)) > max_length:
+            yield query
+            candidate = term
+        query = candidate
+    if query:
+        yield query
+
+
+def get_record_dois(records_string):
+    """Get the DOIs (MARC 0247) of all the records in an XML string."""
+    dois = set()
+    collection = etree.fromstring(records_string)
+    for record in collection.iter("{*}record"):
+        for m024 in marc_fields(record, ("024",))["024"]:
+            if m024.get("2", "").lower() == "doi" and "a" in m024:
+                dois.add(m024["a"].lower())
+    return dois
+
+
+def check_dois_in_inspire(dois, max_length=MAX_QUERY_LENGTH):
+    """Return the DOIs that already have a record in INSPIRE.
+
+    Instead of one search per DOI, the DOIs are searched in batches and
+    the found ones are read from the 0247 fields of the returned records.
+    """
+    from get_inspire_records import fetch_records
+    found = set()
+    for query in get_doi_queries(sorted(dois), max_length=max_length):
+        pages = fetch_records(inspire_pattern=query, list_size=250) or []
+        for records in pages:
+            found.update(get_record_dois(records))
+
+    return set(doi for doi in dois if doi.lower() in found)
 
-    return new_dois
+
+def get_dois_not_in_inspire(input_file, index=None, jobs=1):
+    """Return DOIs that are not in INSPIRE yet.
+
+    With a `local_index.LocalIndex` the DOIs are checked against the
+    locally harvested records instead of searching INSPIRE. `jobs` is the
+    number of processes extracting the DOIs.
+    """
+    dois = extract_dois(input_file, jobs=jobs)
+    if index:
+        new_dois = dois - index.find_dois(dois)
+    else:
+        new_dois = dois - check_dois_in_inspire(dois)
+
+    return sorted(new_dois)
 
 
 def write_list_to_file(list_of_text, outdir="/tmp/"):
@@ -102,3 +288,71 @@ def write_list_to_file(list_of_text, outdir="/tmp/"):
         for line in list_of_text:
             filee.write(line + "\n")
     print("Wrote " + str(len(list_of_text)) + " new DOIs to file " + outfile)
+
+
+def main(argv=None):
+    """Extract the DOIs of a file, or only the ones not in INSPIRE yet."""
+    if argv is None:
+        argv = sys.argv
+
+    input_file = ""
+    outfile = ""
+    outdir = ""
+    database = ""
+    jobs = 1
+    validate = 0
+    doi_cache = None
+    resolver_url = RESOLVER_URL
+    helptext = (
+        "USAGE: python extract_dois.py -i <input_file> [-o <outfile> -j <jobs>]\n"
+        "       python extract_dois.py -i <input_file> -x <outdir> [-d <index_database> -j <jobs> "
+        "--validate <workers> --doi_cache <cache_file> --resolver <resolver_url>]"
+    )
+    try:
+        opts, _ = getopt.getopt(
+            argv, "hi:o:x:d:j:", ["help", "input=", "outfile=", "outdir=", "database=", "jobs=",
+                                  "validate=", "doi_cache=", "resolver="])
+    except getopt.GetoptError as err:
+        print(err)
+        print(helptext)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print(helptext)
+            sys.exit()
+        elif opt in ("-i", "--input"):
+            input_file = arg
+        elif opt in ("-o", "--outfile"):
+            outfile = arg
+        elif opt in ("-x", "--outdir"):
+            outdir = arg
+        elif opt in ("-d", "--database"):
+            database = arg
+        elif opt in ("-j", "--jobs"):
+            jobs = int(arg)
+        elif opt == "--validate":
+            validate = int(arg)
+        elif opt == "--doi_cache":
+            doi_cache = arg
+        elif opt == "--resolver":
+            resolver_url = arg
+    if not input_file or not (outfile or outdir):
+        print(helptext)
+        sys.exit(2)
+
+    if outfile:
+        extract_dois(input_file, jobs=jobs, outfile=outfile)
+    else:
+        index = None
+        if database:
+            from local_index import LocalIndex
+            index = LocalIndex(database)
+        new_dois = get_dois_not_in_inspire(input_file, index=index, jobs=jobs)
+        if validate:
+            new_dois = get_valid_dois(new_dois, workers=validate, cache_file=doi_cache,
+                                      resolver_url=resolver_url)
+        write_list_to_file(new_dois, outdir)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -44,6 +44,16 @@ Example usage:
 
     python fix_773.py -c 'Nucl.Instrum.Meth.' -w 'Nucl. Instrum. Methods' -i "../tmp/inspire_xmls"
 
+    python fix_773.py -c 'Nucl.Instrum.Meth.' -w 'Nucl. Instrum. Methods' -i "../tmp/inspire_xmls" -j 8
+
+    python fix_773.py -c 'Nucl.Instrum.Meth.' -w 'Nucl. Instrum. Methods' -i "../tmp/inspire_xmls" --progress 10 --report report.json
+
+    # Weekly runs: only fix the records that changed since the last run
+    python fix_773.py -c 'Nucl.Instrum.Meth.' -w 'Nucl. Instrum. Methods' -i "../tmp/inspire_xmls" --state fix_773_state.db
+
+    # All the journal names of a tab separated mapping file in one pass
+    python fix_773.py -f journal_names.tsv -i "../tmp/inspire_xmls"
+
 
 
 
@@ -56,6 +66,8 @@ NOTE: This also assumes the title in pubinfo is wrong.
 """
 from __future__ import print_function
 
+import io
+import json
 import os
 import sys
 
@@ -67,68 +79,183 @@ from tempfile import mkstemp
 
 from lxml import etree
 
-from get_inspire_records import fetch_records
-from utils import (
-    get_inspire_collections,
-    marc_to_dict,
-    load_xml_strings,
-    load_xml_files,
-    write_corrected_marcxml,
-)
+from pipeline import Fixer, Pipeline
+from runstats import stats
+from utils import get_inspire_files
 
 
 def find_local_files(directory):
     """Return the contents of a directory."""
     return [os.path.join(directory, f) for f in os.listdir(directory)]
 
-def split_773__x(marc_773, wrong_xname, search_pattern, correct_name):
-    """Extract information from MARC 773__x."""
-    xfield = marc_773.pop("x", "")
+def split_773__x(marc_773, search_pattern, correct_names):
+    """Extract information from MARC 773__x.
+
+    `search_pattern` is from `get_wrong_name_pattern` and `correct_names`
+    maps the wrong names it finds to the correct ones. The field is left
+    as it is if none of the wrong names is found in 773__x.
+
+    Returns True if the field was split.
+    """
+    xfield = marc_773.get("x", "")
     # Let's do some cleaning
     xfield = xfield.replace(",", "")
     xfield = xfield.replace("pp.", "")
-    if wrong_xname in xfield:
-        vol, year, pagerange = search_pattern.search(xfield).groups()
-        pagerange = "pp." + pagerange
-        marc_773["c"] = pagerange
-        marc_773["v"] = vol
-        marc_773["y"] = year.strip("()")
-        marc_773["p"] = correct_name
+    match = search_pattern.search(xfield)
+    if not match:
+        return False
+    wrong_xname, vol, year, pagerange = match.groups()
+    marc_773.pop("x")
+    pagerange = "pp." + pagerange
+    marc_773["c"] = pagerange
+    marc_773["v"] = vol
+    marc_773["y"] = year.strip("()")
+    marc_773["p"] = correct_names[wrong_xname]
+    return True
+
+
+def get_names_regex(names):
+    """Build a regex that matches any of the names.
+
+    The names are put to a trie, and the regex follows it: the alternatives
+    branch only where the names differ, so a common prefix is checked once
+    however many names there are. Of names that are prefixes of each other
+    the longest one is tried first.
+    """
+    trie = {}
+    for name in names:
+        node = trie
+        for char in name:
+            node = node.setdefault(char, {})
+        # End of a name
+        node[""] = {}
+
+    def node_regex(node):
+        """Return the regex of the names below a trie node."""
+        branches = [
+            re.escape(char) + node_regex(child)
+            for char, child in sorted(node.items()) if char
+        ]
+        if not branches:
+            return ""
+        if len(branches) == 1 and "" not in node:
+            return branches[0]
+        regex = "(?:" + "|".join(branches) + ")"
+        if "" in node:
+            regex += "?"
+        return regex
+
+    return node_regex(trie)
+
+
+def get_wrong_name_pattern(wrong_xnames):
+    """Prepare a regex pattern for finding any of the wrong names from 773_x.
+
+    The first group of a match is the wrong name found. The names are
+    without the trailing dot, which may or may not be there in 773__x.
+    """
+    if isinstance(wrong_xnames, basestring):
+        wrong_xnames = [wrong_xnames]
+    return re.compile(
+        "(" + get_names_regex(wrong_xnames) + r')\.?\s(.*)\s\((\d*)\)\s(\w+-\w+).*',
+        re.UNICODE
+    )
 
-    return marc_773
+
+def load_journal_mapping(mapping_file):
+    """Read a mapping file of wrong and correct journal names.
+
+    Every line has a wrong name as in 773__x and the correct name, separated
+    by a tab. Empty lines and lines starting with # are skipped.
+    """
+    mapping = {}
+    with io.open(mapping_file, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            names = [name.strip() for name in line.split("\t")]
+            if len(names) != 2 or not all(names):
+                raise ValueError("{}:{}: expected '<wrong name><tab><correct name>', got '{}'".format(
+                    mapping_file, line_number, line))
+            wrong_xname, correct_name = names
+            wrong_xname = wrong_xname.rstrip(".")
+            if mapping.get(wrong_xname, correct_name) != correct_name:
+                raise ValueError("{}:{}: '{}' is mapped to both '{}' and '{}'".format(
+                    mapping_file, line_number, wrong_xname, mapping[wrong_xname], correct_name))
+            mapping[wrong_xname] = correct_name
+    return mapping
+
+
+class Fix773(Fixer):
+    """Split the pubinfo in 773__x with a wrong journal name to 773 subfields.
+
+    :param mapping: dictionary of the correct journal names by the wrong ones
+    """
+    name = "fix_773"
+    tags = ("773",)
+
+    def __init__(self, mapping):
+        self.mapping = dict(
+            (wrong_xname.rstrip("."), correct_name)
+            for wrong_xname, correct_name in mapping.items()
+        )
+        self.wrong_name_pattern = get_wrong_name_pattern(list(self.mapping))
+
+    def key(self):
+        if len(self.mapping) == 1:
+            # Same as before there were mapping files
+            return "fix_773 " + json.dumps(list(self.mapping.items())[0])
+        return "fix_773 " + json.dumps(sorted(self.mapping.items()))
+
+    def fix(self, fields):
+        """Fix the 773 fields with an x subfield."""
+        fixed = False
+        for m773 in fields["773"]:
+            # NOTE: assuming only one 773 field!
+            if "x" in m773 and split_773__x(m773, self.wrong_name_pattern, self.mapping):
+                fixed = True
+        if fixed:
+            return {"773": fields["773"]}
 
 
 def create_corrected_marcs(wrong_xname, correct_name, correct_outdir="",
-                           inspire_pattern="", inspire_outdir="", indir=""):
-    """Get all the necessary data and build the final MARC records here."""
-    # Prepare a regex pattern for finding the wrong name from 773_x
-    wrong_xname = wrong_xname.rstrip(".")
-    wrong_name_pattern = re.compile(wrong_xname + r'\s(.*)\s\((\d*)\)\s(\w+-\w+).*')
-
-    collections = []
-    if inspire_outdir:
-        collections = get_inspire_collections(inspire_pattern=inspire_pattern, outdir=inspire_outdir)
-    elif indir:
-        collections = get_inspire_collections(indir=indir)
-
-    # Go through all the inspire xml records, find 035 and 037 fields,
+                           inspire_pattern="", inspire_outdir="", indir="",
+                           max_records=None, max_bytes=None, write_jobs=1,
+                           jobs=1, state_file=None, mapping=None):
+    """Get all the necessary data and build the final MARC records here.
+
+    `mapping` is an optional dictionary of more wrong and correct journal
+    names (see `load_journal_mapping`), all fixed in the same pass.
+
+    With `jobs` > 1 the XML files are parsed and fixed in parallel worker
+    processes. The output is in the same order as without them.
+
+    `state_file` is an optional SQLite database of the records seen by the
+    earlier runs (see `delta_state`). The records that haven't changed since
+    are skipped.
+    """
+    inspire_xml_paths = get_inspire_files(
+        inspire_pattern=inspire_pattern,
+        inspire_outdir=inspire_outdir,
+        indir=indir
+    )
+
+    # Go through all the inspire xml records, find the 773 fields,
     # process accordingly, and finally write new MARCXML files.
     # These files should later be uploaded with batchupload correct.
-    fixed_records = []
-    for collection in collections:
-        for record in collection.xpath("//*[local-name()='record']"):
-            recids = record.xpath("./*[local-name()='controlfield'][@tag='001']/text()")
-            if recids:
-                recid = recids[0]
-            marc_773s = marc_to_dict(record, "773")
-            for m773 in marc_773s:
-                # NOTE: assuming only one 773 field!
-                if "x" in m773["773"]:
-                    m773 = split_773__x(
-                        m773, wrong_xname, wrong_name_pattern, correct_name)
-                    fixed_records.append(([m773], recid))
-
-    write_corrected_marcxml(fixed_records, correct_outdir)
+    mapping = dict(mapping or {})
+    if wrong_xname and correct_name:
+        mapping[wrong_xname] = correct_name
+    pipeline = Pipeline([Fix773(mapping)], state_file=state_file)
+    pipeline.run(
+        inspire_xml_paths,
+        correct_outdir,
+        max_records=max_records,
+        max_bytes=max_bytes,
+        write_jobs=write_jobs,
+        jobs=jobs
+    )
 
 
 def main(argv=None):
@@ -144,23 +271,31 @@ def main(argv=None):
     indir = ''
     correct_name = ''
     wrong_xname = ''
+    mapping_file = ''
     inspire_pattern = ''
-
+    max_records = None
+    max_bytes = None
+    write_jobs = 1
+    jobs = 1
+    report_file = None
+    state_file = None
 
     helpshort = (
-        'USAGE: python fix_773.py -c <correct_name> '
-        '-w <wrong_name> [-p <pattern> -o <inspire_outdir> -x <correct_outdir> -i <indir>]\n\n'
+        'USAGE: python fix_773.py [-c <correct_name> -w <wrong_name> | -f <mapping_file>] '
+        '[-p <pattern> -o <inspire_outdir> -x <correct_outdir> -i <indir>]\n\n'
         'For more help use --morehelp'
     )
 
     helplong = (
-        'USAGE: python fix_773.py -c <correct_name> '
-        '-w <wrong_name> [-p <pattern> -o <inspire_outdir> -x <correct_outdir> -i <indir>]\n\n'
+        'USAGE: python fix_773.py [-c <correct_name> -w <wrong_name> | -f <mapping_file>] '
+        '[-p <pattern> -o <inspire_outdir> -x <correct_outdir> -i <indir>]\n\n'
 
-        'Mandatory arguments:\n'
+        'Mandatory arguments, the names or a mapping file or both:\n'
         '  {:<25}'.format("-c --correct_name") + "the correct name, e.g. \'Nucl.Instrum.Meth.\'\n" +
         '  {:<25}'.format("-w --wrong_name") +
-        "the current wrong name in 773__x you want to change, e.g. \'Nucl. Instrum. Methods\'\n\n" +
+        "the current wrong name in 773__x you want to change, e.g. \'Nucl. Instrum. Methods\'\n" +
+        '  {:<25}'.format("-f --mapping_file") +
+        "file of wrong and correct names separated by a tab, one pair per line\n\n" +
 
         'Choose one of these two: \n'
         '  {:<25}'.format("-p --pattern") +
@@ -172,16 +307,32 @@ def main(argv=None):
         '  {:<25}'.format("-i --inspire_outdir") +
         "output directory if you want to save the queried INSPIRE XMLs locally, default: \'inspire_xmls'\n" +
         '  {:<25}'.format("-x --correct_outdir") +
-        "output directory where you want to save the newly created XML files, default: \'correct'\n"
+        "output directory where you want to save the newly created XML files, default: \'correct'\n" +
+        '  {:<25}'.format("--max_records") +
+        "split the output to files of at most this many records and write a manifest\n" +
+        '  {:<25}'.format("--max_bytes") +
+        "split the output to files of at most this many bytes and write a manifest\n" +
+        '  {:<25}'.format("--write_jobs") +
+        "number of output files to write in parallel when splitting, default: 1\n" +
+        '  {:<25}'.format("-j --jobs") +
+        "number of processes for parsing and fixing the XML files, default: 1\n" +
+        '  {:<25}'.format("--progress") +
+        "print the progress with an ETA every this many seconds\n" +
+        '  {:<25}'.format("--report") +
+        "write the timings and counters of the run to this JSON file\n" +
+        '  {:<25}'.format("--state") +
+        "database of the records seen by earlier runs, unchanged records are skipped\n"
     )
 
     # Parse arguments
     try:
         opts, _ = getopt.getopt(
             argv,
-            "hmc:w:p:o:x:i:",
-            ["help", "morehelp", "correct_name=", "wrong_name=", "pattern=",
-             "inspire_outdir=", "correct_outdir=", "indir="]
+            "hmc:w:f:p:o:x:i:j:",
+            ["help", "morehelp", "correct_name=", "wrong_name=", "mapping_file=", "pattern=",
+             "inspire_outdir=", "correct_outdir=", "indir=",
+             "max_records=", "max_bytes=", "write_jobs=", "jobs=",
+             "progress=", "report=", "state="]
             )
     except getopt.GetoptError as err:
         print(err)
@@ -198,6 +349,8 @@ def main(argv=None):
             correct_name = arg
         elif opt in ("-w", "--wrong_name"):
             wrong_xname = arg
+        elif opt in ("-f", "--mapping_file"):
+            mapping_file = arg
         elif opt in ("-p", "--pattern"):
             inspire_pattern = arg
         elif opt in ("-o", "--inspire_outdir"):
@@ -209,12 +362,26 @@ def main(argv=None):
         elif opt in ("-i", "--indir"):
             # For using previously fetched and saved local files
             indir = os.path.join(arg, '')
+        elif opt == "--max_records":
+            max_records = int(arg)
+        elif opt == "--max_bytes":
+            max_bytes = int(arg)
+        elif opt == "--write_jobs":
+            write_jobs = int(arg)
+        elif opt in ("-j", "--jobs"):
+            jobs = int(arg)
+        elif opt == "--progress":
+            stats.progress_interval = float(arg)
+        elif opt == "--report":
+            report_file = arg
+        elif opt == "--state":
+            state_file = arg
     if not argv:
         print(helpshort)
         sys.exit()
-    if not (correct_name and wrong_xname):
+    if not (correct_name and wrong_xname or mapping_file):
         print(helpshort)
-        print("\nPlease give the correct name and the name to be fixed.")
+        print("\nPlease give the correct name and the name to be fixed, or a mapping file.")
         sys.exit()
     if not (inspire_pattern or indir):
         print(helpshort)
@@ -227,8 +394,16 @@ def main(argv=None):
         inspire_pattern=inspire_pattern,
         inspire_outdir=inspire_outdir,
         correct_outdir=correct_outdir,
-        indir=indir
+        indir=indir,
+        max_records=max_records,
+        max_bytes=max_bytes,
+        write_jobs=write_jobs,
+        jobs=jobs,
+        state_file=state_file,
+        mapping=load_journal_mapping(mapping_file) if mapping_file else None
     )
+    if report_file:
+        stats.write_report(report_file)
 
 
 if __name__ == "__main__":
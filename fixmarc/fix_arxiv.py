@@ -49,6 +49,16 @@ What this script does:
 Example usage:
     python fix_arxiv.py -p '037__9:arxiv - 037__c:**' -o 'tmp/from_inspire'
     python fix_arxiv.py -i 'tmp/from_inspire' -c 'tmp/correct'
+    python fix_arxiv.py -i 'tmp/from_inspire' -c 'tmp/correct' --cache_file 'tmp/arxiv_cache.db'
+
+    # Harvest the categories of a whole month in bulk first
+    python fix_arxiv.py -i 'tmp/from_inspire' --bulk --from 2016-08-01 --until 2016-08-31
+
+    # Print the progress every 10 seconds and write timings and counters to a file
+    python fix_arxiv.py -i 'tmp/from_inspire' --progress 10 --report 'tmp/report.json'
+
+    # Weekly runs: only fix the records that changed since the last run
+    python fix_arxiv.py -i 'tmp/from_inspire' --state 'tmp/fix_arxiv_state.db'
 
 Have fun.
 
@@ -60,15 +70,21 @@ import getopt
 import os
 import sys
 
-import requests
+from tempfile import mkstemp
+
 from furl import furl
 from lxml import etree
+from requests.compat import urlparse
+
+from arxiv_cache import ArxivCache
+from marc import DataField
+from pipeline import Fixer, FixError, Pipeline
+from ratelimit import limiter
+from runstats import stats
+from utils import get_inspire_files, marc_fields
+
 
-from utils import (
-    get_inspire_collections,
-    marc_to_dict,
-    write_corrected_marcxml,
-)
+ARXIV_BASE_URL = "http://export.arxiv.org/oai2"
 
 
 def get_arxiv_report_nr(text):
@@ -77,16 +93,14 @@ def get_arxiv_report_nr(text):
 
 def get_arxiv_record(report_nr):
     """Query the arxiv OAI API with the report number. Return XML string."""
-    arxiv_base_url = "http://export.arxiv.org/oai2"
     params = {
         "verb": "GetRecord",
         "identifier": "oai:arXiv.org:{}".format(report_nr),
         "metadataPrefix": "arXiv",
     }
-    url = furl(arxiv_base_url).add(params).url
+    url = furl(ARXIV_BASE_URL).add(params).url
     print("Querying the arXiv API, report_nr " + report_nr)
-    import time; time.sleep(5)
-    arxiv_response = requests.get(url)
+    arxiv_response = limiter.request("GET", url)
     if not arxiv_response.ok:
         # FIXME: there could be an exception
         return None
@@ -94,102 +108,277 @@ def get_arxiv_record(report_nr):
     return arxiv_response.content
 
 
-def get_arxiv_category(report_nr):
-    """Get the arxiv category from querying the arxiv API."""
-    arxiv_record = etree.fromstring(get_arxiv_record(report_nr))
+def get_primary_category(categories):
+    """Get the primary category from an arxiv categories string."""
+    primary_cat = categories.split()[0]
+    return primary_cat.replace("physics:", "").strip()
+
+
+def parse_arxiv_category(arxiv_record):
+    """Get the primary arxiv category from an arxiv OAI response."""
+    arxiv_record = etree.fromstring(arxiv_record)
     categories_node = arxiv_record.xpath(
         "//*[local-name()='record']//*[local-name()='categories']"
     )
     if not categories_node:
         return None
 
-    categories = categories_node[0].text
-    primary_cat = categories.split()[0]
+    return get_primary_category(categories_node[0].text)
 
-    return primary_cat.replace("physics:", "").strip()
+
+def harvest_arxiv_categories(cache, from_date=None, until_date=None, set_spec=None):
+    """Harvest arxiv metadata with OAI ListRecords into the cache.
+
+    Every page of results (1000 records) is one request, instead of one
+    GetRecord request per report number. The harvest can be restricted
+    with a date range (YYYY-MM-DD) and an OAI set, e.g. 'physics:hep-th'.
+    Returns the number of report numbers stored.
+    """
+    params = {
+        "verb": "ListRecords",
+        "metadataPrefix": "arXiv",
+    }
+    if from_date:
+        params["from"] = from_date
+    if until_date:
+        params["until"] = until_date
+    if set_spec:
+        params["set"] = set_spec
+
+    n_harvested = 0
+    while True:
+        url = furl(ARXIV_BASE_URL).add(params).url
+        print("Harvesting the arXiv API, " + str(n_harvested) + " records so far")
+        # arXiv uses 503 with Retry-After for flow control during harvests,
+        # so be more patient than usual
+        arxiv_response = limiter.request("GET", url, retries=10)
+        arxiv_response.raise_for_status()
+
+        response = etree.fromstring(arxiv_response.content)
+        categories = []
+        for metadata in response.iterfind(".//{*}metadata/{*}arXiv"):
+            report_nr = metadata.findtext("{*}id")
+            cats = metadata.findtext("{*}categories")
+            if report_nr and cats:
+                categories.append((report_nr.lower(), get_primary_category(cats)))
+        cache.set_categories(categories)
+        n_harvested += len(categories)
+
+        token = response.findtext(".//{*}resumptionToken")
+        if not token:
+            break
+        # The other arguments are not allowed with a resumption token
+        params = {
+            "verb": "ListRecords",
+            "resumptionToken": token,
+        }
+
+    print("Harvested the arXiv categories of " + str(n_harvested) + " records")
+    return n_harvested
+
+
+def get_arxiv_category(report_nr, cache=None):
+    """Get the arxiv category from querying the arxiv API.
+
+    With an `ArxivCache` the API is only queried for report numbers that
+    are not in the cache yet.
+    """
+    if cache:
+        cached = cache.get(report_nr)
+        if cached:
+            stats.incr("arxiv_cache_hits")
+            return cached[1]
+        stats.incr("arxiv_cache_misses")
+
+    stats.incr("arxiv_lookups")
+    arxiv_record = get_arxiv_record(report_nr)
+    primary_cat = parse_arxiv_category(arxiv_record)
+    if cache:
+        cache.set(report_nr, arxiv_record, primary_cat)
+
+    return primary_cat
+
+
+def get_arxiv_marc_037(marc_037s):
+    """Return the 037 field with the arxiv report_nr, or None."""
+    for m37 in marc_037s:
+        if "a" in m37 and "9" in m37:
+            if "arxiv" in m37["9"].lower():
+                return m37
 
 
-def get_fixed_arxiv_marc_fields(record):
-    """Check if MARC 035 and 037 fields need fixing and return them.
+def check_correct_marc_035_exists(marc_035s):
+    """Check if the 035 field with arxiv report_nr exists already."""
+    for m35 in marc_035s:
+        if "9" in m35 and "arxiv" in m35["9"].lower():
+            return True
+
+
+def fix_arxiv_marc_fields(marc_035s, marc_037s, cache=None):
+    """Fix the lists of MARC 035 and 037 fields in place.
 
     035: check if the correct field already exists, and if not, create it.
     037: find the correct existing field, modify it and add it back to the list.
-    """
-    def pop_correct_marc_037(marc_037s):
-        """Pop the correct 037 field for modifying."""
-        new_marc_037 = {}
-        for index, m37 in enumerate(marc_037s):
-            m37 = m37["037"]
-            if "a" in m37 and "9" in m37:
-                if "arxiv" in m37["9"].lower():
-                    new_marc_037 = marc_037s.pop(index)
-                    return new_marc_037
-        return new_marc_037
-
-    def check_correct_marc_035_exists(marc_035s):
-        """Check if the 035 field with arxiv report_nr exists already."""
-        for index, m35 in enumerate(marc_035s):
-            if "9" in m35 and "arxiv" in m35["9"].lower():
-                return True
-
-    marc_035s = marc_to_dict(record, "035")
-    marc_037s = marc_to_dict(record, "037")
 
+    Raises `FixError` and leaves the fields as they are if the arXiv
+    category can't be found, so a later run tries the record again.
+    """
     # Modify 037
-    new_marc_037 = pop_correct_marc_037(marc_037s)
-    report_no = get_arxiv_report_nr(new_marc_037["037"]["a"])
+    new_marc_037 = get_arxiv_marc_037(marc_037s)
+    report_no = get_arxiv_report_nr(new_marc_037["a"])
     if not report_no:
-        import ipdb; ipdb.set_trace()
+        raise FixError("no arxiv report_nr in " + repr(new_marc_037["a"]))
     try:
-        new_marc_037["037"]["c"] = get_arxiv_category(report_no)
-        print("arxiv category: " + new_marc_037["037"]["c"])
+        category = get_arxiv_category(report_no, cache=cache)
     except Exception as err:
-        # manually intervene if something strange happens
-        import ipdb; ipdb.set_trace()
+        # This can run in a worker process, no stopping for a debugger
+        raise FixError("failed to get the arxiv category of " + report_no + ": " + str(err))
+    if not category:
+        raise FixError("no arxiv category for " + report_no)
+    marc_037s.remove(new_marc_037)
+    new_marc_037["c"] = category
+    print("arxiv category: " + new_marc_037["c"])
     # FIXME: report_nr == arxiv:submit... check that this is fixed
     # FIXME: report_nr == '12012.zip' this doesn't exists in arxiv, just remove the report_nr
     marc_037s.append(new_marc_037)
 
     # Check if 035 exists and create it if necessary
     if not check_correct_marc_035_exists(marc_035s):
-        new_marc_035 = {
-            "035":
-                {
-                    "a": "oai:arXiv.org:{}".format(report_no),
-                    "9": "arXiv",
-                }
-        }
+        new_marc_035 = DataField("035", subfields=[
+            ("a", "oai:arXiv.org:{}".format(report_no)),
+            ("9", "arXiv"),
+        ])
         marc_035s.append(new_marc_035)
 
 
+def get_fixed_arxiv_marc_fields(record, cache=None):
+    """Check if MARC 035 and 037 fields need fixing and return them."""
+    fields = marc_fields(record, ("035", "037"))
+    fix_arxiv_marc_fields(fields["035"], fields["037"], cache=cache)
+
     # We can put them all in a single list:
-    return marc_035s + marc_037s
+    return fields["035"] + fields["037"]
+
+
+def share_rate_limit(jobs):
+    """Split the arXiv rate limit between `jobs` worker processes."""
+    host = urlparse(ARXIV_BASE_URL).hostname
+    rate = limiter.rates.get(host)
+    if rate:
+        limiter.set_rate(host, rate / jobs)
+
+
+class FixArxiv(Fixer):
+    """Add the primary arXiv category to 037 and the arXiv 035 if it's missing.
+
+    :param cache_file: optional SQLite database for caching the arXiv responses
+    :param cache_ttl: time to live of the cache entries in seconds
+    """
+    name = "fix_arxiv"
+    tags = ("035", "037")
+
+    def __init__(self, cache_file=None, cache_ttl=None):
+        self.cache_file = cache_file
+        self.cache_ttl = cache_ttl
+        self.cache = None
+
+    def __getstate__(self):
+        # The open cache stays in this process
+        state = self.__dict__.copy()
+        state["cache"] = None
+        return state
+
+    def init_worker(self, jobs):
+        share_rate_limit(jobs)
+
+    def open(self):
+        if self.cache_file:
+            self.cache = ArxivCache(self.cache_file, ttl=self.cache_ttl)
+
+    def close(self):
+        if self.cache:
+            self.cache.close(evict=False)
+            self.cache = None
+
+    def fix(self, fields):
+        """Fix the 035 and 037 fields of a record with an arXiv 037."""
+        marc_037 = get_arxiv_marc_037(fields["037"])
+        if marc_037 is None:
+            return None
+        if "c" in marc_037 and check_correct_marc_035_exists(fields["035"]):
+            # Nothing to fix
+            return None
+        fix_arxiv_marc_fields(fields["035"], fields["037"], cache=self.cache)
+        return fields
 
 
 def create_corrected_marcs(correct_outdir="", inspire_pattern="",
-                           inspire_outdir="", indir=""):
-    """Get all the necessary data and build the final MARC records here."""
-    collections = []
-    if inspire_outdir:
-        collections = get_inspire_collections(
-            inspire_pattern=inspire_pattern, inspire_outdir=inspire_outdir
+                           inspire_outdir="", indir="", max_records=None,
+                           max_bytes=None, write_jobs=1, cache_file=None,
+                           cache_ttl=None, bulk=False, from_date=None,
+                           until_date=None, set_spec=None, jobs=1, state_file=None):
+    """Get all the necessary data and build the final MARC records here.
+
+    `cache_file` is an optional SQLite database for caching the arXiv
+    responses between runs, `cache_ttl` its entries' time to live in seconds.
+    With `bulk` the arXiv categories are first harvested with ListRecords
+    (see `harvest_arxiv_categories`) and only the report numbers missing
+    from the harvest are queried one by one.
+
+    With `jobs` > 1 the XML files are handled in parallel worker processes,
+    which share the arXiv rate limit.
+
+    `state_file` is an optional SQLite database of the records seen by the
+    earlier runs (see `delta_state`). The records that haven't changed since
+    are skipped.
+    """
+    temporary_cache = False
+    if bulk and not cache_file:
+        # Keep the harvested categories only for this run
+        fd, cache_file = mkstemp(prefix="arxiv_cache_", suffix=".db")
+        os.close(fd)
+        temporary_cache = True
+    cache = None
+    try:
+        if cache_file:
+            cache = ArxivCache(cache_file, ttl=cache_ttl)
+        if bulk:
+            with stats.stage("arxiv_harvest"):
+                harvest_arxiv_categories(
+                    cache, from_date=from_date, until_date=until_date, set_spec=set_spec)
+
+        inspire_xml_paths = get_inspire_files(
+            inspire_pattern=inspire_pattern,
+            inspire_outdir=inspire_outdir,
+            indir=indir
         )
-    elif indir:
-        collections = get_inspire_collections(indir=indir)
 
-    # Go through all the inspire xml records, find 035 and 037 fields,
-    # process accordingly, and finally write new MARCXML files.
-    # These files should later be uploaded with batchupload correct.
-    fixed_records = []
-    for collection in collections:
-        for record in collection.xpath("//*[local-name()='record']"):
-            recids = record.xpath("./*[local-name()='controlfield'][@tag='001']/text()")
-            if recids:
-                recid = recids[0]
-            fixed_marc_record = get_fixed_arxiv_marc_fields(record)
-            fixed_records.append((fixed_marc_record, recid))
+        # Go through all the inspire xml records, find 035 and 037 fields,
+        # process accordingly, and finally write new MARCXML files.
+        # These files should later be uploaded with batchupload correct.
+        pipeline = Pipeline(
+            [FixArxiv(cache_file=cache_file, cache_ttl=cache_ttl)],
+            state_file=state_file
+        )
+        pipeline.run(
+            inspire_xml_paths,
+            correct_outdir,
+            max_records=max_records,
+            max_bytes=max_bytes,
+            write_jobs=write_jobs,
+            jobs=jobs
+        )
 
-    write_corrected_marcxml(fixed_records, correct_outdir)
+        if cache:
+            # Also the lookups of the worker processes
+            cache.hits = stats.counters.get("arxiv_cache_hits", 0)
+            cache.misses = stats.counters.get("arxiv_cache_misses", 0)
+            print(cache.stats())
+    finally:
+        if cache:
+            cache.close()
+        if temporary_cache:
+            os.remove(cache_file)
 
 
 def main(argv=None):
@@ -204,18 +393,36 @@ def main(argv=None):
     correct_outdir = ""
     indir = ""
     inspire_pattern = ""
+    max_records = None
+    max_bytes = None
+    write_jobs = 1
+    cache_file = None
+    cache_ttl = None
+    bulk = False
+    from_date = None
+    until_date = None
+    set_spec = None
+    jobs = 1
+    report_file = None
+    state_file = None
 
     helpshort = (
         "python fix_arxiv.py -p '037__9:arxiv - 037__c:**' [-o 'tmp/from_inspire'"
-        "-c 'tmp/correct' -i 'tmp/from_inspire']"
+        "-c 'tmp/correct' -i 'tmp/from_inspire' --max_records 5000 "
+        "--max_bytes 50000000 --write_jobs 4 --cache_file 'arxiv_cache.db' "
+        "--cache_ttl <days> --bulk --from YYYY-MM-DD --until YYYY-MM-DD "
+        "--set 'physics:hep-th' -j <jobs> --progress <seconds> --report <report_file> --state <state_file>]"
     )
 
     # Parse arguments
     try:
         opts, _ = getopt.getopt(
             argv,
-            "hp:o:c:i:",
-            ["help", "pattern=", "inspire_outdir=", "correct_outdir=", "indir="]
+            "hp:o:c:i:j:",
+            ["help", "pattern=", "inspire_outdir=", "correct_outdir=", "indir=",
+             "max_records=", "max_bytes=", "write_jobs=", "cache_file=",
+             "cache_ttl=", "bulk", "from=", "until=", "set=", "jobs=",
+             "progress=", "report=", "state="]
         )
     except getopt.GetoptError as err:
         print(err)
@@ -236,6 +443,32 @@ def main(argv=None):
         elif opt in ("-i", "--indir"):
             # For using previously fetched and saved local files
             indir = os.path.join(arg, "")
+        elif opt == "--max_records":
+            max_records = int(arg)
+        elif opt == "--max_bytes":
+            max_bytes = int(arg)
+        elif opt == "--write_jobs":
+            write_jobs = int(arg)
+        elif opt == "--cache_file":
+            cache_file = arg
+        elif opt == "--cache_ttl":
+            cache_ttl = float(arg) * 24 * 3600
+        elif opt == "--bulk":
+            bulk = True
+        elif opt == "--from":
+            from_date = arg
+        elif opt == "--until":
+            until_date = arg
+        elif opt == "--set":
+            set_spec = arg
+        elif opt in ("-j", "--jobs"):
+            jobs = int(arg)
+        elif opt == "--progress":
+            stats.progress_interval = float(arg)
+        elif opt == "--report":
+            report_file = arg
+        elif opt == "--state":
+            state_file = arg
     if not argv:
         print(helpshort)
         sys.exit()
@@ -248,8 +481,21 @@ def main(argv=None):
         inspire_pattern=inspire_pattern,
         inspire_outdir=inspire_outdir,
         correct_outdir=correct_outdir,
-        indir=indir
+        indir=indir,
+        max_records=max_records,
+        max_bytes=max_bytes,
+        write_jobs=write_jobs,
+        cache_file=cache_file,
+        cache_ttl=cache_ttl,
+        bulk=bulk,
+        from_date=from_date,
+        until_date=until_date,
+        set_spec=set_spec,
+        jobs=jobs,
+        state_file=state_file
     )
+    if report_file:
+        stats.write_report(report_file)
 
 if __name__ == "__main__":
     main(sys.argv[1:])
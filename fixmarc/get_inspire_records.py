@@ -14,6 +14,18 @@ to files and return a list of filepaths.
 Example usage:
     python get_inspire_records.py -p 'tc proceedings and 773__p:Nucl.Instrum.Meth.' -o 'inspire_xmls'
 
+    # Fetch 4 pages at a time, but start at most one request per second
+    python get_inspire_records.py -p 'tc proceedings' -o 'inspire_xmls' -l 250 -w 4 -m 1
+
+    # Continue where an interrupted run of the same query left off
+    python get_inspire_records.py -p 'tc proceedings' -o 'inspire_xmls' -l 250 --resume
+
+    # Print the progress every 30 seconds and write timings and counters to a file
+    python get_inspire_records.py -p 'tc proceedings' -o 'inspire_xmls' --progress 30 --report report.json
+
+    # Store the pages gzip compressed, 40 pages (10000 records) per file
+    python get_inspire_records.py -p 'tc proceedings' -o 'inspire_xmls' -l 250 -z gz --pages_per_file 40
+
 """
 
 from __future__ import print_function
@@ -22,115 +34,479 @@ import os
 import sys
 import re
 import getopt
+import json
 
+from multiprocessing.pool import ThreadPool
 from tempfile import mkstemp
 
 import getpass
+import threading
+import time
 # import logging  # FIXME: do we want fancy logging?
 
+import lxml.html
+import requests
 from lxml import etree
-
-import splinter
-from splinter.exceptions import ElementDoesNotExist
+from requests.compat import urljoin, urlparse
 
 from invenio_client import InvenioConnector
+from invenio_client.connector import InvenioConnectorAuthError
+
+from compression import get_extension, open_xml_file
+from http_pool import client
+from ratelimit import limiter
+from runstats import stats
+
+INSPIRE_URL = "https://inspirehep.net"
+
+# Keeps track of the pages already fetched when resuming harvests
+HARVEST_MANIFEST = "harvest_manifest.json"
+
+# The session cookies of the authenticated searches are kept here between runs
+SESSION_FILE = os.path.expanduser("~/.fixmarc_inspire_session.json")
+
+# Creating a connector checks the server with a request, so the connectors
+# are shared by all the searches
+_connectors = {}
+_connectors_lock = threading.Lock()
+
+
+def ask_credentials():
+    """Ask the INSPIRE user name and password on the terminal."""
+    uname = raw_input("Inspire login: ")
+    pword = getpass.getpass()
+    return uname, pword
+
+
+def get_login_form(page, url):
+    """Return `(action, fields, user_field, password_field)` of a login page.
+
+    Invenio names the fields either nickname/password or p_un/p_pw.
+    Returns None if there is no login form on the page.
+    """
+    for form in lxml.html.fromstring(page, base_url=url).forms:
+        inputs = dict((node.name, node) for node in form.inputs if node.name)
+        password_field = next(
+            (name for name in ("password", "p_pw") if name in inputs), None)
+        if password_field is None:
+            continue
+        user_field = "nickname" if "nickname" in inputs else "p_un"
+        fields = dict(form.form_values())
+        # The first submit button, like clicking it
+        for node in form.inputs:
+            if node.name and node.get("type") == "submit":
+                fields[node.name] = node.get("value", "")
+                break
+        return urljoin(url, form.action or ""), fields, user_field, password_field
+    return None
+
 
 class FixedConnector(InvenioConnector):
-    """By default InvenioConnector is using phantomjs, which doesn't work.
+    """InvenioConnector that logs in with plain HTTP requests.
+
+    InvenioConnector fills the login form with a phantomjs browser. Here
+    the form is posted with `http_pool.client` instead and the session
+    cookies are saved to `session_file`, so the next runs don't have to log
+    in again. When the session has expired the searches log in again with
+    the credentials given, or asked with `credentials()`.
 
-    Have to override the browser initialization here.
-    $ pip install splinter[zope.testbrowser]
+    :param session_file: optional JSON file for the session cookies
+    :param credentials: optional function returning `(user, password)`,
+        called when a login is needed and no password was given
     """
+    def __init__(self, url, user="", password="", session_file=None, credentials=None,
+                 **kwargs):
+        self.session_file = session_file
+        self.credentials = credentials
+        self.insecure_login = kwargs.get("insecure_login", False)
+        self.login_lock = threading.Lock()
+        super(FixedConnector, self).__init__(url, user=user, password=password, **kwargs)
+        if not self.cookies and (self.session_file or self.credentials):
+            self.cookies = self.load_session()
+            if not self.cookies:
+                self.login()
+
+    @property
+    def authenticated(self):
+        """Check if the searches are made logged in."""
+        return bool(self.user or self.session_file or self.credentials)
+
     def _init_browser(self):
-        """Overide in appropriate way to prepare a logged in browser."""
-        self.browser = splinter.Browser('zope.testbrowser')
-        self.browser.visit(self.server_url + "/youraccount/login")
-        try:
-            self.browser.fill('nickname', self.user)
-            self.browser.fill('password', self.password)
-        except ElementDoesNotExist:
-            self.browser.fill('p_un', self.user)
-            self.browser.fill('p_pw', self.password)
-        self.browser.find_by_css('input[type=submit]').click()
-
-def fetch_records(inspire_pattern, list_size, outdir=None):
+        """Log in without a browser, called by InvenioConnector with a user."""
+        self.login()
+
+    def _check_credentials(self):
+        """`login` already checked the credentials."""
+
+    def login(self):
+        """Log in with the login form and keep the session cookies.
+
+        Raises InvenioConnectorAuthError if the login didn't succeed.
+        """
+        if not self.insecure_login and not self.server_url.startswith("https://"):
+            raise InvenioConnectorAuthError(
+                "You have to use a secure URL (HTTPS) to login")
+        if not (self.user and self.password) and self.credentials:
+            self.user, self.password = self.credentials()
+        with stats.stage("login"):
+            login_url = self.server_url + "/youraccount/login"
+            response = client.request("GET", login_url)
+            response.raise_for_status()
+            form = get_login_form(response.content, response.url)
+            if form is None:
+                raise InvenioConnectorAuthError(
+                    "Couldn't find the login form at " + login_url)
+            action, fields, user_field, password_field = form
+            fields[user_field] = self.user
+            fields[password_field] = self.password
+            fields.setdefault("login_method", self.login_method)
+            response = client.request(
+                "POST", action, data=fields, cookies=response.cookies)
+        cookies = requests.cookies.RequestsCookieJar()
+        for step in response.history + [response]:
+            cookies.update(step.cookies)
+        if not cookies or get_login_form(response.content, response.url) is not None:
+            raise InvenioConnectorAuthError(
+                "It was not possible to successfully login with "
+                "the provided credentials")
+        stats.incr("inspire_logins")
+        self.cookies = cookies
+        self.save_session()
+
+    def load_session(self):
+        """Return the saved session cookies if none of them has expired, or None."""
+        if not self.session_file or not os.path.exists(self.session_file):
+            return None
+        with open(self.session_file) as f:
+            sessions = json.load(f)
+        now = time.time()
+        saved = sessions.get(self.server_url, [])
+        if not saved or any(cookie["expires"] and cookie["expires"] < now for cookie in saved):
+            return None
+        cookies = requests.cookies.RequestsCookieJar()
+        for cookie in saved:
+            cookies.set(
+                cookie["name"],
+                cookie["value"],
+                domain=cookie["domain"],
+                path=cookie["path"],
+                expires=cookie["expires"],
+                secure=cookie["secure"]
+            )
+        return cookies
+
+    def save_session(self):
+        """Save the session cookies, readable only by the user."""
+        if not self.session_file:
+            return
+        sessions = {}
+        if os.path.exists(self.session_file):
+            with open(self.session_file) as f:
+                sessions = json.load(f)
+        sessions[self.server_url] = [
+            {
+                "name": cookie.name,
+                "value": cookie.value,
+                "domain": cookie.domain,
+                "path": cookie.path,
+                "expires": cookie.expires,
+                "secure": cookie.secure,
+            }
+            for cookie in self.cookies
+        ]
+        fd = os.open(self.session_file + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(sessions, f)
+        os.rename(self.session_file + ".tmp", self.session_file)
+
+    def search(self, **kwparams):
+        """Search through the shared rate limiter. Returns the raw response.
+
+        Unlike InvenioConnector.search this doesn't keep every result in
+        memory in `cached_queries`. An expired session is renewed once.
+        """
+        cookies = self.cookies
+        response = limiter.request(
+            "GET",
+            self.server_url + "/search",
+            params=kwparams,
+            cookies=cookies
+        )
+        if 'youraccount/login' in response.url and self.authenticated:
+            with self.login_lock:
+                # Another thread may have logged in already
+                if self.cookies is cookies:
+                    print("INSPIRE session has expired, logging in again")
+                    self.login()
+            response = limiter.request(
+                "GET",
+                self.server_url + "/search",
+                params=kwparams,
+                cookies=self.cookies
+            )
+        if 'youraccount/login' in response.url:
+            # Current user not able to search collection
+            raise InvenioConnectorAuthError(
+                "You are trying to search a restricted collection. "
+                "Please authenticate yourself.")
+        response.raise_for_status()
+        return response.content
+
+
+def get_connector(inspire_pattern):
+    """Return an InvenioConnector for the query, logged in if necessary."""
+    with _connectors_lock:
+        if "*" in inspire_pattern:
+            # Have to add `wl=0` to make wildcards function properly.
+            # This requires authentication.
+            if "authenticated" not in _connectors:
+                _connectors["authenticated"] = FixedConnector(
+                    INSPIRE_URL,
+                    session_file=SESSION_FILE,
+                    credentials=ask_credentials
+                )
+            return _connectors["authenticated"]
+        if "anonymous" not in _connectors:
+            _connectors["anonymous"] = FixedConnector(INSPIRE_URL)
+        return _connectors["anonymous"]
+
+
+def get_startpoints(total_amount, list_size):
+    """Return the `jrec` value of every result page.
+
+    `jrec` is 1-based: with list_size 50 the pages start at 1, 51, 101...
+    """
+    return list(range(1, total_amount + 1, list_size))
+
+
+def load_harvest_manifest(outdir, inspire_pattern, list_size):
+    """Load the harvest manifest of `outdir` or start a new one.
+
+    The manifest tells which pages of the query are already on disk.
+    Raises ValueError if `outdir` holds a harvest of some other query.
+    """
+    manifest_file = os.path.join(outdir, HARVEST_MANIFEST)
+    if not os.path.exists(manifest_file):
+        return {
+            "query": inspire_pattern,
+            "list_size": list_size,
+            "total": None,
+            "pages": {},
+        }
+
+    with open(manifest_file, "r") as f:
+        manifest = json.load(f)
+    if manifest["query"] != inspire_pattern or manifest["list_size"] != list_size:
+        raise ValueError(
+            "{} contains a harvest of '{}' with list size {}, can't resume with "
+            "'{}' and list size {}".format(
+                outdir, manifest["query"], manifest["list_size"],
+                inspire_pattern, list_size)
+        )
+    return manifest
+
+
+def save_harvest_manifest(outdir, manifest):
+    """Write the harvest manifest atomically."""
+    manifest_file = os.path.join(outdir, HARVEST_MANIFEST)
+    with open(manifest_file + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(manifest_file + ".tmp", manifest_file)
+
+
+def fetch_records(inspire_pattern, list_size, outdir=None, workers=1,
+                  min_interval=0, resume=False, index=None, compression=None,
+                  pages_per_file=1):
     """Get records from Inspire with InvenioConnector and write to file.
 
+    The first page tells the total number of results, after which the rest
+    of the pages can be fetched in parallel with `workers` threads. Pages are
+    still written and returned in order.
+
+    With `resume` the pages get deterministic file names and are recorded in
+    a manifest in `outdir`. Running the same query again only fetches the
+    pages that are still missing.
+
+    The files can be compressed, and with `pages_per_file` > 1 the records
+    of several pages are collected to one file. Files are written under a
+    temporary name and renamed when they are complete.
+
     :param inspire_pattern: Inspire query
     :param list_size: desired result list
     :param outdir: optional output directory
+    :param workers: number of pages to fetch in parallel
+    :param min_interval: minimum number of seconds between two requests,
+        overrides the default rate limit of INSPIRE
+    :param resume: continue an interrupted harvest in `outdir`
+    :param index: optional `local_index.LocalIndex` to add the written pages to
+    :param compression: None, "gz", "xz" or "zst"
+    :param pages_per_file: number of pages to write to one file
     """
+    extension = get_extension(compression)
     if outdir and not os.path.exists(outdir):
         os.makedirs(outdir)
     files_created = []
     records_fetched = []
+    manifest = None
+    if outdir and resume:
+        manifest = load_harvest_manifest(outdir, inspire_pattern, list_size)
+
+    def get_outfile(startpoint):
+        """Return the name of the file starting with the page at `startpoint`."""
+        if manifest:
+            return os.path.join(outdir, "records_{:08d}{}".format(startpoint, extension))
+        fd, outfile = mkstemp(prefix="records" + str(startpoint) + "_", dir=outdir, suffix=extension)
+        os.close(fd)
+        return outfile
+
+    def file_written(outfile, pages):
+        """Record the `(startpoint, n_records)` pages of a finished file."""
+        if manifest:
+            for startpoint, n_records in pages:
+                manifest["pages"][str(startpoint)] = {
+                    "file": os.path.basename(outfile),
+                    "records": n_records,
+                }
+            save_harvest_manifest(outdir, manifest)
+        print("Wrote " + str(sum(n_records for _, n_records in pages)) +
+              " INSPIRE records to file " + outfile)
+        files_created.append(outfile)
+        if index:
+            index.add_file(outfile)
 
-    def write_to_file(records, startpoint):
+    def write_to_file(records, startpoint, n_records):
         """Write records to file.
 
         Should be n_records == list_size
         """
-        n_records = get_number_of_records_in_batch(records)
-        _, outfile = mkstemp(prefix="records" + str(startpoint) + "_", dir=outdir, suffix=".xml")
-        with open(outfile, "w") as f:
+        outfile = get_outfile(startpoint)
+        # Only a fully written page ends up with the final name
+        with open_xml_file(outfile + ".tmp", "wb", compression) as f:
             f.write(records)
-        print("Wrote " + str(n_records) + " INSPIRE records to file " + outfile)
-        files_created.append(outfile)
-
-    def move_to_next_startpoint(startpoint, list_size):
-        """Increment startpoint counter.
-
-        Startpoint is used when INSPIRE breaks the result list to multiple
-        batches of list_size results.
-        """
-        return startpoint + list_size + 1
-
-    if "*" in inspire_pattern:
-        # Have to add `wl=0` to make wildcards function properly.
-        # This requires authentication.
-        uname = raw_input("Inspire login: ")
-        pword = getpass.getpass()
-        inspire = FixedConnector(
-            "https://inspirehep.net",
-            user=uname,
-            password=pword
+        os.rename(outfile + ".tmp", outfile)
+        file_written(outfile, [(startpoint, n_records)])
+
+    # The file that pages are being added to with `pages_per_file` > 1
+    container = {}
+
+    def add_to_container(records, startpoint, n_records):
+        """Add the records of a page to the current file, starting a new one if needed."""
+        collection = etree.fromstring(records)
+        if not container:
+            container["outfile"] = get_outfile(startpoint)
+            container["file"] = open_xml_file(container["outfile"] + ".tmp", "wb", compression)
+            container["pages"] = []
+            namespace = collection.nsmap.get(None)
+            container["file"].write(
+                b'<?xml version="1.0" encoding="UTF-8"?>\n' +
+                (b'<collection xmlns="' + namespace.encode("utf-8") + b'">\n'
+                 if namespace else b"<collection>\n")
             )
-    else:
-        inspire = FixedConnector("https://inspirehep.net")
-
-
-    # Get the first batch
-    startpoint = 0
-    records = inspire.search(
-        p=inspire_pattern,
-        of="xm",
-        rg=list_size,
-        wl=0
-        )
-
-    # Get total number of search results
-    total_amount = get_total_number_of_records(records)
-    if not total_amount:
-        print("No records found with pattern " + inspire_pattern)  # FIXME: this is messy
-        return None
-    print("Total amount of results: " + total_amount + " with pattern " +
-          inspire_pattern) # FIXME: this is messy
-
-    # Get all the rest
-    while startpoint < int(total_amount):
-        if outdir:
-            write_to_file(records, startpoint)
+        for record in collection.iterchildren("{*}record"):
+            container["file"].write(
+                etree.tostring(record, encoding="utf-8", with_tail=False) + b"\n")
+        container["pages"].append((startpoint, n_records))
+        if len(container["pages"]) >= pages_per_file:
+            close_container()
+
+    def close_container():
+        """Finish the current file of several pages."""
+        container["file"].write(b"</collection>\n")
+        container["file"].close()
+        os.rename(container["outfile"] + ".tmp", container["outfile"])
+        file_written(container["outfile"], container["pages"])
+        container.clear()
+
+    def handle_page(records, startpoint):
+        """Write the page to disk or keep it in memory."""
+        n_records = get_number_of_records_in_batch(records)
+        stats.incr("inspire_pages_fetched")
+        stats.incr("inspire_records_fetched", n_records)
+        if outdir and pages_per_file > 1:
+            add_to_container(records, startpoint, n_records)
+        elif outdir:
+            write_to_file(records, startpoint, n_records)
         else:
             records_fetched.append(records)
-        startpoint = move_to_next_startpoint(startpoint, list_size)
-
-        records = inspire.search(
-            p=inspire_pattern,
-            of="xm",
-            rg=list_size,
-            jrec=startpoint,
-            wl=0)
 
+    if min_interval:
+        limiter.set_rate(urlparse(INSPIRE_URL).hostname, 1.0 / min_interval)
+    if workers > client.pool_size:
+        # Keep a connection open for every thread
+        client.configure(pool_size=workers)
+    connectors = []
+
+    def get_search_connector():
+        """Return the connector of the searches, created on first use."""
+        if not connectors:
+            # Don't log in before it is really needed
+            connectors.append(get_connector(inspire_pattern))
+        return connectors[0]
+
+    def search(startpoint):
+        """Fetch one page of results."""
+        connector = get_search_connector()
+        with stats.stage("fetch"):
+            return connector.search(
+                p=inspire_pattern,
+                of="xm",
+                rg=list_size,
+                jrec=startpoint,
+                wl=0)
+
+    if manifest and "1" in manifest["pages"]:
+        total_amount = str(manifest["total"])
+        print("Resuming harvest in " + outdir + ", " +
+              str(len(manifest["pages"])) + " pages already fetched")
+    else:
+        # Get the first batch
+        records = search(1)
+
+        # Get total number of search results
+        total_amount = get_total_number_of_records(records)
+        if not total_amount:
+            print("No records found with pattern " + inspire_pattern)  # FIXME: this is messy
+            return None
+        print("Total amount of results: " + total_amount + " with pattern " +
+              inspire_pattern) # FIXME: this is messy
+        if manifest:
+            manifest["total"] = int(total_amount)
+        handle_page(records, 1)
+
+    # Get all the rest. Now that we know the total amount, we know
+    # where every page starts.
+    startpoints = get_startpoints(int(total_amount), list_size)[1:]
+    if manifest:
+        startpoints = [
+            startpoint for startpoint in startpoints
+            if str(startpoint) not in manifest["pages"]
+        ]
+    stats.start_progress(len(startpoints), "pages")
+    pool = None
+    if workers > 1 and startpoints:
+        # Log in once here, not in every thread when resuming a harvest
+        get_search_connector()
+        pool = ThreadPool(workers)
+        pages = pool.imap(search, startpoints)
+    else:
+        pages = (search(startpoint) for startpoint in startpoints)
+    for startpoint in startpoints:
+        handle_page(next(pages), startpoint)
+        stats.advance()
+    if pool:
+        pool.close()
+        pool.join()
+    if container:
+        close_container()
+
+    if manifest:
+        # Return also the pages fetched by the earlier runs, every file once
+        files = []
+        for startpoint in get_startpoints(manifest["total"], list_size):
+            outfile = os.path.join(outdir, manifest["pages"][str(startpoint)]["file"])
+            if outfile not in files:
+                files.append(outfile)
+        return files
     if outdir:
         return files_created
     else:
@@ -161,15 +537,28 @@ def main(argv=None):
 
     outdir = "inspire_xmls/"
     list_size = 50
+    workers = 1
+    min_interval = 0
+    resume = False
+    compression = None
+    pages_per_file = 1
+    report_file = None
     inspire_pattern = ""
-    helptext = 'USAGE: \n\t python get_inspire_records.py -p <pattern> [-o <outdir> -r <recid_file>]'
+    helptext = (
+        'USAGE: \n\t python get_inspire_records.py -p <pattern> '
+        '[-o <outdir> -r <recid_file> -l <list_size> -w <workers> -m <min_interval> '
+        '--resume -z <gz|xz|zst> --pages_per_file <pages> --progress <seconds> '
+        '--report <report_file>]'
+    )
 
     # Parse search pattern and optional output dir from the arguments
     try:
         opts, _ = getopt.getopt(
             argv,
-            "ho:p:r:l:",
-            ["outdir=", "pattern=", "recid_file=", "list_size="]
+            "ho:p:r:l:w:m:z:",
+            ["outdir=", "pattern=", "recid_file=", "list_size=", "workers=",
+             "min_interval=", "resume", "compress=", "pages_per_file=",
+             "progress=", "report="]
         )
     except getopt.GetoptError:
         print(helptext)
@@ -181,7 +570,21 @@ def main(argv=None):
         elif opt in ("-o", "--ofile"):
             outdir = os.path.join(arg, '')
         elif opt in ("-l", "--list_size"):
-            list_size = arg  # should be int
+            list_size = int(arg)
+        elif opt in ("-w", "--workers"):
+            workers = int(arg)
+        elif opt in ("-m", "--min_interval"):
+            min_interval = float(arg)
+        elif opt == "--resume":
+            resume = True
+        elif opt in ("-z", "--compress"):
+            compression = arg
+        elif opt == "--pages_per_file":
+            pages_per_file = int(arg)
+        elif opt == "--progress":
+            stats.progress_interval = float(arg)
+        elif opt == "--report":
+            report_file = arg
         elif opt in ("-p", "--pattern"):
             inspire_pattern = arg
         elif opt in ("-r", "--recid_file"):
@@ -200,7 +603,11 @@ def main(argv=None):
 
     # Test pattern:
     # inspire_pattern = 'tc proceedings and 773__p:Nucl.Instrum.Meth.'
-    fetch_records(inspire_pattern, list_size, outdir=outdir)
+    fetch_records(inspire_pattern, list_size, outdir=outdir, workers=workers,
+                  min_interval=min_interval, resume=resume, compression=compression,
+                  pages_per_file=pages_per_file)
+    if report_file:
+        stats.write_report(report_file)
 
 
 if __name__ == "__main__":
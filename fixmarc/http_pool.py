@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+"""
+Pooled keep-alive HTTP sessions for all the outbound requests.
+
+`requests.get` and friends open a new connection (and a TLS handshake) for
+every call. `HTTPClient` keeps one `requests.Session` per host instead, so
+the connections are reused and a request after the first one costs about a
+single round trip. Connection errors and read timeouts are retried by
+urllib3, the 429 and 503 answers by `ratelimit.RateLimiter`, which makes
+its requests through the module level `client`.
+
+The number of new connections by host is recorded in `runstats.stats`, the
+report shows how many requests reused a connection.
+
+The sessions are not shared with the processes forked from this one: a
+worker process of `utils.map_xml_files` starts its own connections. Like
+with `requests.request`, the cookies a server sets are not kept for the
+next requests, pass them with `cookies=` where they are needed.
+
+Example usage:
+    from http_pool import client
+    client.configure(pool_size=4, timeout=(5, 30), retries=2)
+    response = client.request("GET", "http://export.arxiv.org/oai2", params=params)
+
+"""
+from __future__ import print_function
+
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.compat import cookielib, urlparse
+from requests.packages.urllib3.util.retry import Retry
+
+from runstats import stats
+
+# Seconds to wait for connecting and for the server to answer
+DEFAULT_TIMEOUT = (10, 120)
+
+
+class NoCookiesPolicy(cookielib.DefaultCookiePolicy):
+    """Don't store the cookies of the responses in the session."""
+    def set_ok(self, cookie, request):
+        return False
+
+
+class HTTPClient(object):
+    """Keep-alive sessions by host.
+
+    :param pool_size: maximum number of connections kept open to one host,
+        at least the number of threads making requests in parallel
+    :param timeout: default timeout of the requests in seconds, a number
+        or a `(connect, read)` tuple
+    :param retries: how many times to retry a request after a connection
+        error or a read timeout
+    :param backoff: base delay in seconds between the retries
+    """
+    def __init__(self, pool_size=10, timeout=DEFAULT_TIMEOUT, retries=3, backoff=0.5):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.sessions = {}
+        self.connections = {}
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+
+    def configure(self, pool_size=None, timeout=None, retries=None):
+        """Change the settings, the open sessions are closed."""
+        if pool_size is not None:
+            self.pool_size = pool_size
+        if timeout is not None:
+            self.timeout = timeout
+        if retries is not None:
+            self.retries = retries
+        self.close()
+
+    def new_session(self):
+        """Return a session with the pool size and retries of the client."""
+        session = requests.Session()
+        # The hosts are shared by e.g. the anonymous and the logged in searches
+        session.cookies.set_policy(NoCookiesPolicy())
+        adapter = HTTPAdapter(
+            pool_connections=2,
+            pool_maxsize=self.pool_size,
+            max_retries=Retry(
+                total=self.retries,
+                connect=self.retries,
+                read=self.retries,
+                backoff_factor=self.backoff,
+            )
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def session(self, url):
+        """Return the session of the host of `url`."""
+        host = urlparse(url).hostname
+        with self.lock:
+            if self.pid != os.getpid():
+                # The sockets belong to the parent process
+                self.sessions = {}
+                self.connections = {}
+                self.pid = os.getpid()
+            if host not in self.sessions:
+                self.sessions[host] = self.new_session()
+            return self.sessions[host]
+
+    def count_connections(self, session, url):
+        """Record the connections opened to the host of `url` since the last call."""
+        pool = session.get_adapter(url).poolmanager.connection_from_url(url)
+        with self.lock:
+            opened = pool.num_connections - self.connections.get(pool, 0)
+            self.connections[pool] = pool.num_connections
+        if opened > 0:
+            stats.record_connections(urlparse(url).hostname, opened)
+
+    def request(self, method, url, **kwargs):
+        """Make an HTTP request on the pooled session of the host."""
+        kwargs.setdefault("timeout", self.timeout)
+        session = self.session(url)
+        try:
+            return session.request(method, url, **kwargs)
+        finally:
+            self.count_connections(session, url)
+
+    def close(self):
+        """Close all the connections."""
+        with self.lock:
+            sessions = self.sessions.values()
+            self.sessions = {}
+            self.connections = {}
+        for session in sessions:
+            session.close()
+
+
+client = HTTPClient()
@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local identifier index of harvested INSPIRE records.
+
+Scans a directory of MARCXML files fetched with `get_inspire_records` and
+stores the recid, DOIs (0247), arXiv numbers (035/037) and pubinfo (773) of
+every record in an SQLite database. Files already indexed are skipped unless
+they have changed, so the index can be updated cheaply after every harvest.
+`fetch_records` can also add the pages to an index as they are written.
+
+Lookups against the index take microseconds instead of an INSPIRE search.
+
+For the records of uncompressed files the index also keeps the byte offset
+and length of the `<record>` element in its file. `iter_records` reads
+only those bytes (through mmap) and parses them, so a few records can be
+looked up or fixed again without parsing the whole harvest. The records of
+compressed files are found by streaming their files.
+
+Example usage:
+    python local_index.py -d inspire_index.db -i inspire_xmls
+    python local_index.py -d inspire_index.db --doi 10.1016/j.nima.2010.06.001
+    python local_index.py -d inspire_index.db --arxiv 1608.01541
+    python local_index.py -d inspire_index.db --recid 1475380
+    python local_index.py -d inspire_index.db --xml 1475380
+
+    index = LocalIndex("inspire_index.db")
+    index.update("inspire_xmls")
+    new_dois = dois - index.find_dois(dois)
+    for record in index.iter_records(["1475380", "1475381"]):
+        ...
+
+"""
+from __future__ import print_function
+
+import getopt
+import mmap
+import os
+import re
+import sqlite3
+import sys
+
+from lxml import etree
+
+from compression import get_compression
+from runstats import stats
+from utils import find_local_files, get_recid, iter_xml_records, marc_fields
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime REAL,
+    size INTEGER
+);
+CREATE TABLE IF NOT EXISTS records (
+    recid TEXT PRIMARY KEY,
+    path TEXT,
+    byte_offset INTEGER,
+    byte_length INTEGER
+);
+CREATE TABLE IF NOT EXISTS dois (
+    doi TEXT,
+    recid TEXT
+);
+CREATE TABLE IF NOT EXISTS arxiv (
+    report_nr TEXT,
+    recid TEXT
+);
+CREATE TABLE IF NOT EXISTS pubinfo (
+    recid TEXT,
+    journal TEXT,
+    volume TEXT,
+    year TEXT,
+    pages TEXT,
+    pubnote TEXT
+);
+CREATE INDEX IF NOT EXISTS records_path ON records (path);
+CREATE INDEX IF NOT EXISTS dois_doi ON dois (doi);
+CREATE INDEX IF NOT EXISTS dois_recid ON dois (recid);
+CREATE INDEX IF NOT EXISTS arxiv_report_nr ON arxiv (report_nr);
+CREATE INDEX IF NOT EXISTS arxiv_recid ON arxiv (recid);
+CREATE INDEX IF NOT EXISTS pubinfo_recid ON pubinfo (recid);
+"""
+
+# SQLite can't take more parameters than this in one statement
+MAX_VARIABLES = 900
+
+# The tags of a <record> element, with or without a namespace prefix
+RECORD_START_PATTERN = re.compile(br'<(?:[\w.-]+:)?record[\s>]')
+RECORD_END_PATTERN = re.compile(br'</(?:[\w.-]+:)?record\s*>')
+
+# The first element of a file and its namespace declarations
+ROOT_PATTERN = re.compile(br'<([\w.:-]+)([^>]*)>')
+NAMESPACE_PATTERN = re.compile(br'xmlns(?::[\w.-]+)?\s*=\s*(?:"[^"]*"|\'[^\']*\')')
+
+
+def normalize_arxiv(text):
+    """Normalize an arXiv identifier, e.g. 'oai:arXiv.org:1608.01541' -> '1608.01541'."""
+    text = text.strip().lower()
+    for prefix in ("oai:arxiv.org:", "arxiv:"):
+        if text.startswith(prefix):
+            text = text[len(prefix):]
+    return text.strip("/")
+
+
+def get_record_spans(xml_file):
+    """Return the `(offset, length)` of every `<record>` of a file, in order.
+
+    Returns None for compressed files, they can't be read by offset.
+    """
+    if get_compression(xml_file):
+        return None
+    if not os.path.getsize(xml_file):
+        # mmap can't map an empty file
+        return []
+    with open(xml_file, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            spans = []
+            position = 0
+            while True:
+                # Two searches are much faster than one non-greedy match
+                start = RECORD_START_PATTERN.search(data, position)
+                if start is None:
+                    break
+                end = RECORD_END_PATTERN.search(data, start.end())
+                if end is None:
+                    break
+                spans.append((start.start(), end.end() - start.start()))
+                position = end.end()
+            return spans
+        finally:
+            data.close()
+
+
+def get_namespace_declarations(data):
+    """Return the namespace declarations of the root element of a file as a string."""
+    for match in ROOT_PATTERN.finditer(data, 0, 64 * 1024):
+        if match.group(1)[:1] not in (b"?", b"!"):
+            return b" ".join(NAMESPACE_PATTERN.findall(match.group(2)))
+    return b""
+
+
+def read_records(xml_file, spans):
+    """Yield the record nodes at the `(offset, length)` spans of a file.
+
+    The records are parsed alone, within the namespace declarations of the
+    root element of the file.
+    """
+    with open(xml_file, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            wrapper = b"<collection " + get_namespace_declarations(data) + b">"
+            for offset, length in spans:
+                stats.incr("input_bytes", length)
+                with stats.stage("parse"):
+                    node = etree.fromstring(
+                        wrapper + data[offset:offset + length] + b"</collection>")[0]
+                stats.incr("records_parsed")
+                yield node
+        finally:
+            data.close()
+
+
+def get_record_identifiers(record):
+    """Get the DOIs, arXiv numbers and pubinfo of a record node."""
+    fields = marc_fields(record, ("024", "035", "037", "773"))
+    dois = set()
+    for m024 in fields["024"]:
+        if m024.get("2", "").lower() == "doi" and "a" in m024:
+            dois.add(m024["a"].lower())
+    arxiv_numbers = set()
+    for marcfield in fields["035"] + fields["037"]:
+        if "arxiv" in marcfield.get("9", "").lower() and "a" in marcfield:
+            arxiv_numbers.add(normalize_arxiv(marcfield["a"]))
+    pubinfos = []
+    for m773 in fields["773"]:
+        pubinfos.append((
+            m773.get("p"), m773.get("v"), m773.get("y"), m773.get("c"), m773.get("x")
+        ))
+    return dois, arxiv_numbers, pubinfos
+
+
+class LocalIndex(object):
+    """SQLite index of the identifiers in harvested MARCXML files."""
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(records)")]
+        if "byte_offset" not in columns:
+            # Indexed before the byte offsets were kept, index all the files again
+            self.connection.execute("ALTER TABLE records ADD COLUMN byte_offset INTEGER")
+            self.connection.execute("ALTER TABLE records ADD COLUMN byte_length INTEGER")
+            self.connection.execute("DELETE FROM files")
+        self.connection.commit()
+
+    def _remove_file(self, xml_file):
+        """Remove the records of a file from the index."""
+        recids = "SELECT recid FROM records WHERE path = ?"
+        for table in ("dois", "arxiv", "pubinfo"):
+            self.connection.execute(
+                "DELETE FROM {} WHERE recid IN ({})".format(table, recids), (xml_file,))
+        self.connection.execute("DELETE FROM records WHERE path = ?", (xml_file,))
+
+    def _is_indexed(self, xml_file):
+        """Check if a file is the same as when it was indexed."""
+        stat = os.stat(xml_file)
+        indexed = self.connection.execute(
+            "SELECT mtime, size FROM files WHERE path = ?", (xml_file,)
+        ).fetchone()
+        return indexed is not None and tuple(indexed) == (stat.st_mtime, stat.st_size)
+
+    def add_file(self, xml_file):
+        """Index the records of a MARCXML file unless it is indexed already.
+
+        Returns the number of records indexed.
+        """
+        xml_file = os.path.abspath(xml_file)
+        if self._is_indexed(xml_file):
+            return 0
+        stat = os.stat(xml_file)
+
+        self._remove_file(xml_file)
+        spans = get_record_spans(xml_file)
+        n_records = 0
+        n_parsed = 0
+        for record in iter_xml_records([xml_file]):
+            span = (None, None)
+            if spans is not None and n_parsed < len(spans):
+                span = spans[n_parsed]
+            n_parsed += 1
+            recid = get_recid(record)
+            if not recid:
+                continue
+            dois, arxiv_numbers, pubinfos = get_record_identifiers(record)
+            # The same record can come again in a later harvest
+            for table in ("dois", "arxiv", "pubinfo"):
+                self.connection.execute(
+                    "DELETE FROM {} WHERE recid = ?".format(table), (recid,))
+            self.connection.execute(
+                "INSERT OR REPLACE INTO records (recid, path, byte_offset, byte_length) "
+                "VALUES (?, ?, ?, ?)",
+                (recid, xml_file) + span)
+            self.connection.executemany(
+                "INSERT INTO dois (doi, recid) VALUES (?, ?)",
+                ((doi, recid) for doi in dois))
+            self.connection.executemany(
+                "INSERT INTO arxiv (report_nr, recid) VALUES (?, ?)",
+                ((report_nr, recid) for report_nr in arxiv_numbers))
+            self.connection.executemany(
+                "INSERT INTO pubinfo (recid, journal, volume, year, pages, pubnote) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                ((recid,) + pubinfo for pubinfo in pubinfos))
+            n_records += 1
+        if spans is not None and len(spans) != n_parsed:
+            # The scan didn't find the same records as the parser, don't trust it
+            print("Couldn't find the byte offsets of the records in " + xml_file)
+            self.connection.execute(
+                "UPDATE records SET byte_offset = NULL, byte_length = NULL WHERE path = ?",
+                (xml_file,))
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files (path, mtime, size) VALUES (?, ?, ?)",
+            (xml_file, stat.st_mtime, stat.st_size))
+        self.connection.commit()
+        return n_records
+
+    def update(self, directory):
+        """Index the new and changed files of a directory.
+
+        Returns the number of records indexed.
+        """
+        n_records = 0
+        for xml_file in find_local_files(directory):
+            n_records += self.add_file(xml_file)
+        print("Indexed " + str(n_records) + " records from " + directory)
+        return n_records
+
+    def _find(self, table, column, values):
+        """Return the values of `column` in `table` that are in `values`."""
+        values = list(values)
+        found = set()
+        for start in range(0, len(values), MAX_VARIABLES):
+            chunk = values[start:start + MAX_VARIABLES]
+            rows = self.connection.execute(
+                "SELECT DISTINCT {column} FROM {table} WHERE {column} IN ({marks})".format(
+                    column=column, table=table, marks=", ".join("?" * len(chunk))),
+                chunk
+            )
+            found.update(row[0] for row in rows)
+        return found
+
+    def find_dois(self, dois):
+        """Return the DOIs that have a record in the index."""
+        found = self._find("dois", "doi", set(doi.lower() for doi in dois))
+        return set(doi for doi in dois if doi.lower() in found)
+
+    def recids_for_doi(self, doi):
+        """Return the recids of the records with a DOI."""
+        rows = self.connection.execute(
+            "SELECT recid FROM dois WHERE doi = ?", (doi.lower(),))
+        return [row[0] for row in rows]
+
+    def recids_for_arxiv(self, report_nr):
+        """Return the recids of the records with an arXiv number."""
+        rows = self.connection.execute(
+            "SELECT recid FROM arxiv WHERE report_nr = ?", (normalize_arxiv(report_nr),))
+        return [row[0] for row in rows]
+
+    def locate(self, recids):
+        """Return the indexed recids by file.
+
+        The values are lists of `(offset, length, recid)` tuples in file
+        order, the offsets are None for the files without them.
+        """
+        recids = list(set(recids))
+        files = {}
+        for start in range(0, len(recids), MAX_VARIABLES):
+            chunk = recids[start:start + MAX_VARIABLES]
+            rows = self.connection.execute(
+                "SELECT path, byte_offset, byte_length, recid FROM records "
+                "WHERE recid IN ({})".format(", ".join("?" * len(chunk))),
+                chunk
+            )
+            for path, offset, length, recid in rows:
+                files.setdefault(path, []).append((offset, length, recid))
+        for located in files.values():
+            located.sort()
+        return files
+
+    def iter_records(self, recids):
+        """Yield the record nodes of the recids, file by file.
+
+        Only the bytes of the records are read and parsed. The records of
+        files without byte offsets, or changed since they were indexed, are
+        picked while streaming the file. The recids that are not in the index
+        are left out.
+        """
+        for path, located in sorted(self.locate(recids).items()):
+            spans = [(offset, length) for offset, length, _ in located if offset is not None]
+            if len(spans) == len(located) and self._is_indexed(path):
+                for record in read_records(path, spans):
+                    yield record
+                continue
+            wanted = set(recid for _, _, recid in located)
+            for record in iter_xml_records([path]):
+                if get_recid(record) in wanted:
+                    yield record
+
+    def get_record(self, recid):
+        """Return the indexed information of a recid, or None."""
+        row = self.connection.execute(
+            "SELECT path FROM records WHERE recid = ?", (recid,)).fetchone()
+        if row is None:
+            return None
+        return {
+            "recid": recid,
+            "path": row[0],
+            "dois": [r[0] for r in self.connection.execute(
+                "SELECT doi FROM dois WHERE recid = ?", (recid,))],
+            "arxiv": [r[0] for r in self.connection.execute(
+                "SELECT report_nr FROM arxiv WHERE recid = ?", (recid,))],
+            "pubinfo": [dict(zip(("p", "v", "y", "c", "x"), r)) for r in self.connection.execute(
+                "SELECT journal, volume, year, pages, pubnote FROM pubinfo WHERE recid = ?",
+                (recid,))],
+        }
+
+    def close(self):
+        """Close the database."""
+        self.connection.close()
+
+
+def main(argv=None):
+    """Build or update the index and/or look up identifiers from it."""
+    if argv is None:
+        argv = sys.argv
+
+    database = ""
+    indir = ""
+    lookups = []
+    helptext = (
+        "USAGE: python local_index.py -d <database> [-i <indir> "
+        "--doi <doi> --arxiv <report_nr> --recid <recid> --xml <recid>]"
+    )
+
+    try:
+        opts, _ = getopt.getopt(
+            argv,
+            "hd:i:",
+            ["help", "database=", "indir=", "doi=", "arxiv=", "recid=", "xml="]
+        )
+    except getopt.GetoptError as err:
+        print(err)
+        print(helptext)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print(helptext)
+            sys.exit()
+        elif opt in ("-d", "--database"):
+            database = arg
+        elif opt in ("-i", "--indir"):
+            indir = arg
+        elif opt in ("--doi", "--arxiv", "--recid", "--xml"):
+            lookups.append((opt, arg))
+    if not database:
+        print(helptext)
+        sys.exit(2)
+
+    index = LocalIndex(database)
+    if indir:
+        index.update(indir)
+    for opt, arg in lookups:
+        if opt == "--doi":
+            print(arg + ": " + ", ".join(index.recids_for_doi(arg)))
+        elif opt == "--arxiv":
+            print(arg + ": " + ", ".join(index.recids_for_arxiv(arg)))
+        elif opt == "--xml":
+            for record in index.iter_records([arg]):
+                print(etree.tostring(record, encoding="utf-8", with_tail=False))
+        else:
+            print(index.get_record(arg))
+    index.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
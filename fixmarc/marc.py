@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compact model of MARC datafields.
+
+A `DataField` keeps the tag, the indicators and the subfields as an ordered
+list of `(code, value)` pairs, so repeated subfield codes and the subfield
+order survive a round trip from MARCXML and back. It uses `__slots__`, which
+makes it a lot smaller than the old `{tag: {code: value}}` dictionaries.
+
+Subfields can be accessed like in a dictionary: `field["a"]` and
+`field.get("a")` return the first value with the code, `field["a"] = value`
+replaces the first one (or appends a new subfield) and `field.pop("x")`
+removes the first one.
+
+Example usage:
+    field = DataField("035", subfields=[("a", "oai:arXiv.org:1608.01541"), ("9", "arXiv")])
+    if "9" in field and field["9"].lower() == "arxiv":
+        field["a"] = "oai:arXiv.org:1608.01542"
+    node = field.to_node()
+
+"""
+from __future__ import print_function
+
+from lxml import etree
+
+SUBFIELD = "{*}subfield"
+
+
+class DataField(object):
+    """A MARC datafield with ordered `(code, value)` subfield pairs."""
+    __slots__ = ("tag", "ind1", "ind2", "subfields")
+
+    def __init__(self, tag, ind1=" ", ind2=" ", subfields=None):
+        self.tag = tag
+        self.ind1 = ind1
+        self.ind2 = ind2
+        self.subfields = list(subfields) if subfields else []
+
+    @classmethod
+    def from_node(cls, node):
+        """Create a datafield from a MARCXML datafield node.
+
+        Subfields without a code or a value are left out.
+        """
+        subfields = []
+        for subfield in node.iterchildren(SUBFIELD):
+            code = subfield.get("code")
+            value = subfield.text
+            if code is None or value is None:
+                # There might be empty subfields
+                continue
+            subfields.append((code, value))
+        return cls(node.get("tag"), node.get("ind1", " "), node.get("ind2", " "), subfields)
+
+    def to_node(self):
+        """Return the datafield as a MARCXML node."""
+        node = etree.Element("datafield")
+        # Set one by one to keep the attribute order stable
+        node.set("tag", self.tag)
+        node.set("ind1", self.ind1)
+        node.set("ind2", self.ind2)
+        for code, value in self.subfields:
+            subfield = etree.SubElement(node, "subfield", code=code)
+            subfield.text = value
+        return node
+
+    def to_dict(self):
+        """Return the datafield in the old `{tag: {code: value}}` format.
+
+        Of repeated codes only the last value is kept.
+        """
+        return {self.tag: dict(self.subfields)}
+
+    def copy(self):
+        """Return a copy that can be modified without touching this one."""
+        return DataField(self.tag, self.ind1, self.ind2, self.subfields)
+
+    def get(self, code, default=None):
+        """Return the value of the first subfield with the code."""
+        for subfield_code, value in self.subfields:
+            if subfield_code == code:
+                return value
+        return default
+
+    def get_all(self, code):
+        """Return the values of all the subfields with the code."""
+        return [value for subfield_code, value in self.subfields if subfield_code == code]
+
+    def pop(self, code, default=None):
+        """Remove the first subfield with the code and return its value."""
+        for index, (subfield_code, value) in enumerate(self.subfields):
+            if subfield_code == code:
+                del self.subfields[index]
+                return value
+        return default
+
+    def __getitem__(self, code):
+        for subfield_code, value in self.subfields:
+            if subfield_code == code:
+                return value
+        raise KeyError(code)
+
+    def __setitem__(self, code, value):
+        for index, (subfield_code, _) in enumerate(self.subfields):
+            if subfield_code == code:
+                self.subfields[index] = (code, value)
+                return
+        self.subfields.append((code, value))
+
+    def __contains__(self, code):
+        return any(subfield_code == code for subfield_code, _ in self.subfields)
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, DataField) and
+            (self.tag, self.ind1, self.ind2, self.subfields) ==
+            (other.tag, other.ind1, other.ind2, other.subfields)
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __reduce__(self):
+        # Keeps the pickles small when passing fields between processes
+        return DataField, (self.tag, self.ind1, self.ind2, self.subfields)
+
+    def __repr__(self):
+        return "DataField({!r}, {!r}, {!r}, {!r})".format(
+            self.tag, self.ind1, self.ind2, self.subfields)
@@ -0,0 +1,435 @@
+# -*- coding: utf-8 -*-
+
+"""
+Run several fixes over INSPIRE records in a single pass.
+
+Every fixer says which MARC tags it needs. The pipeline extracts all of
+those tags once per record, lets the fixers change them one after another
+and writes one corrected record per recid with all the changed tags. So
+fixing both the 773 pubinfo and the arXiv 035/037 fields parses the harvest
+only once, and the corrections end up in the same output file.
+
+The fixers are subclasses of `Fixer`, e.g. `fix_773.Fix773` and
+`fix_arxiv.FixArxiv`. A fixer gets the datafields of its tags and returns
+the tags it changed, with all their fields, as the batchupload correct mode
+replaces whole tags. It may modify the fields of the tags it returns in
+place. A later fixer sees the changes of the earlier ones. A fixer that
+can't fix a record right now, e.g. because a lookup failed, raises
+`FixError`. The record is then left out of the output and of the delta
+state, so the next run tries it again.
+
+Example usage:
+    python pipeline.py -i inspire_xmls -x correct -c 'Nucl.Instrum.Meth.' -w 'Nucl. Instrum. Methods' --arxiv
+    python pipeline.py -i inspire_xmls -x correct -c 'Nucl.Instrum.Meth.' -w 'Nucl. Instrum. Methods' --arxiv --cache_file arxiv_cache.db -j 4
+    python pipeline.py -i inspire_xmls -x correct -f journal_names.tsv --arxiv
+
+    # Fix again only the records listed in recids.txt, read by offset (see local_index)
+    python pipeline.py --index inspire_index.db --recids recids.txt -x correct -f journal_names.tsv
+
+    pipeline = Pipeline([Fix773({"Nucl. Instrum. Methods": "Nucl.Instrum.Meth."}), FixArxiv()])
+    pipeline.run(get_inspire_files(indir="inspire_xmls"), "correct")
+
+"""
+from __future__ import print_function
+
+import getopt
+import os
+import sys
+import time
+
+from functools import partial
+
+from delta_state import DeltaState
+from runstats import stats
+from utils import (
+    get_inspire_files,
+    get_recid,
+    iter_xml_records,
+    map_xml_files,
+    marc_fields,
+    write_corrected_marcxml,
+    write_corrected_marcxml_shards,
+)
+
+
+class FixError(Exception):
+    """Raised by a fixer that couldn't fix a record, the record is tried again on the next run."""
+
+
+class Fixer(object):
+    """Base class of the fixes run by `Pipeline`.
+
+    Fixers are pickled to the worker processes, so keep only parameters in
+    the attributes and open files and databases in `open`.
+    """
+    # Short name used in the stats
+    name = "fixer"
+    # The MARC tags the fixer reads and changes
+    tags = ()
+
+    def key(self):
+        """Return the name of the fix with its parameters, for the delta state."""
+        return self.name
+
+    def init_worker(self, jobs):
+        """Prepare a worker process, when there are `jobs` of them."""
+
+    def open(self):
+        """Open the resources needed for fixing, once per XML file."""
+
+    def close(self):
+        """Close what `open` opened."""
+
+    def fix(self, fields):
+        """Fix the `{tag: [DataField]}` fields of a record.
+
+        Returns a dictionary of the changed tags and their fields, or None
+        if nothing needed fixing. Raises `FixError` if the record needs a
+        fix that failed, without changing the fields.
+        """
+        raise NotImplementedError
+
+
+def init_fixers(fixers, jobs):
+    """Prepare the fixers in a worker process."""
+    for fixer in fixers:
+        fixer.init_worker(jobs)
+
+
+def fix_xml_file(xml_file, pipeline):
+    """Return the fixed records of one XML file as a list, and the rows of the delta state.
+
+    This is what the worker processes run with `jobs` > 1. The rows of the
+    records seen are written by the main process, see `DeltaState.save_seen`.
+    """
+    pipeline.open()
+    try:
+        fixed_records = list(pipeline.iter_fixed_records(iter_xml_records([xml_file])))
+        seen = pipeline.state.pop_seen() if pipeline.state else []
+        return fixed_records, seen
+    finally:
+        pipeline.close()
+
+
+class Pipeline(object):
+    """Apply a list of fixers to records, extracting their fields once.
+
+    :param fixers: list of `Fixer` objects, applied in this order
+    :param state_file: optional SQLite database of the records seen by the
+        earlier runs (see `delta_state`), unchanged records are skipped
+    """
+    def __init__(self, fixers, state_file=None):
+        self.fixers = list(fixers)
+        self.state_file = state_file
+        self.tags = sorted(set(tag for fixer in self.fixers for tag in fixer.tags))
+        self.state = None
+
+    def key(self):
+        """Return the name of the fixes for the delta state."""
+        return " + ".join(fixer.key() for fixer in self.fixers)
+
+    def open(self):
+        """Open the resources of the fixers and the delta state."""
+        for fixer in self.fixers:
+            fixer.open()
+        if self.state_file:
+            self.state = DeltaState(self.state_file, self.key())
+
+    def close(self):
+        """Close the resources of the fixers and the delta state."""
+        for fixer in self.fixers:
+            fixer.close()
+        if self.state:
+            self.state.close()
+            self.state = None
+
+    def __getstate__(self):
+        # The open delta state stays in this process
+        state = self.__dict__.copy()
+        state["state"] = None
+        return state
+
+    def fix_record(self, record):
+        """Return the changed fields of a record node, or None if nothing changed.
+
+        Raises `FixError` if one of the fixers failed.
+        """
+        fields = marc_fields(record, self.tags)
+        changed = set()
+        for fixer in self.fixers:
+            start = time.time()
+            try:
+                fixed = fixer.fix(dict((tag, fields[tag]) for tag in fixer.tags))
+            except FixError:
+                stats.incr(fixer.name + "_records_failed")
+                raise
+            finally:
+                stats.add_time(fixer.name, time.time() - start)
+            if fixed:
+                fields.update(fixed)
+                changed.update(fixed)
+                stats.incr(fixer.name + "_records_fixed")
+        if not changed:
+            return None
+        return [field for tag in sorted(changed) for field in fields[tag]]
+
+    def stream_fixed_records(self, records):
+        """Open the pipeline and yield the fixed records one at a time.
+
+        The rows of the delta state are saved when the pipeline is closed,
+        after the last record.
+        """
+        self.open()
+        try:
+            for fixed_record in self.iter_fixed_records(records):
+                yield fixed_record
+        finally:
+            self.close()
+
+    def iter_fixed_files(self, inspire_xml_paths):
+        """Yield the fixed records of the XML files, fixed in this process."""
+        stats.start_progress(len(inspire_xml_paths), "files")
+        for xml_file in inspire_xml_paths:
+            for fixed_record in self.stream_fixed_records(iter_xml_records([xml_file])):
+                yield fixed_record
+            stats.advance()
+
+    def iter_indexed_records(self, index, recids):
+        """Yield the fixed records of the recids, read through a `local_index.LocalIndex`."""
+        init_fixers(self.fixers, 1)
+        for fixed_record in self.stream_fixed_records(index.iter_records(recids)):
+            yield fixed_record
+
+    def map_fixed_files(self, inspire_xml_paths, jobs, state=None):
+        """Yield the fixed records of the XML files, fixed in `jobs` worker processes.
+
+        The rows of the delta state returned by the workers are saved to `state`.
+        """
+        fixed_files = map_xml_files(
+            partial(fix_xml_file, pipeline=self),
+            inspire_xml_paths,
+            jobs=jobs,
+            initializer=init_fixers,
+            initargs=(self.fixers, jobs)
+        )
+        for fixed_file, seen in fixed_files:
+            if state:
+                state.save_seen(seen)
+            for fixed_record in fixed_file:
+                yield fixed_record
+
+    def iter_fixed_records(self, records):
+        """Yield `(fields, recid)` tuples of the records that got fixed.
+
+        The records a fixer failed on are skipped and not added to the
+        delta state.
+        """
+        for record in records:
+            if self.state:
+                seen = self.state.check(record)
+                if seen is None:
+                    continue
+            try:
+                fixed_fields = self.fix_record(record)
+            except FixError as err:
+                print("Failed to fix record " + str(get_recid(record)) + ": " + str(err))
+                stats.incr("records_failed")
+                continue
+            if self.state:
+                self.state.add(seen, fixed=fixed_fields is not None)
+            if fixed_fields is None:
+                stats.incr("records_skipped")
+                continue
+            stats.incr("records_fixed")
+            yield fixed_fields, get_recid(record)
+
+    def run(self, inspire_xml_paths, correct_outdir="", max_records=None,
+            max_bytes=None, write_jobs=1, jobs=1, index=None, recids=None):
+        """Fix the records of the XML files and write the corrections.
+
+        With `jobs` > 1 the XML files are parsed and fixed in parallel worker
+        processes. The output is in the same order as without them. With
+        `max_records` or `max_bytes` the output is split to several files
+        with a manifest, see `utils.write_corrected_marcxml_shards`.
+
+        With a `local_index.LocalIndex` and a list of `recids` only those
+        records are read from the harvest and fixed, instead of the XML files.
+
+        Returns the output file, or the manifest of the split output.
+        """
+        state = None
+        if self.state_file:
+            state = DeltaState(self.state_file, self.key())
+            state.start_run()
+
+        if index is not None and recids is not None:
+            fixed_records = self.iter_indexed_records(index, recids)
+        elif jobs <= 1:
+            fixed_records = self.iter_fixed_files(inspire_xml_paths)
+        else:
+            fixed_records = self.map_fixed_files(inspire_xml_paths, jobs, state)
+        if max_records or max_bytes:
+            outfile = write_corrected_marcxml_shards(
+                fixed_records,
+                correct_outdir,
+                max_records=max_records,
+                max_bytes=max_bytes,
+                write_jobs=write_jobs
+            )
+        else:
+            outfile = write_corrected_marcxml(fixed_records, correct_outdir)
+
+        if state:
+            # Only now that the corrections are on disk
+            state.finish_run()
+            state.close()
+            print("Skipped " + str(stats.counters.get("records_unchanged", 0)) +
+                  " records unchanged since the last run")
+        return outfile
+
+
+def main(argv=None):
+    """Run the 773 and/or arXiv fixes over INSPIRE records in one pass."""
+    # The fixers import this module
+    from fix_773 import Fix773, load_journal_mapping
+
+    if argv is None:
+        argv = sys.argv
+
+    inspire_outdir = ""
+    correct_outdir = ""
+    indir = ""
+    inspire_pattern = ""
+    correct_name = ""
+    wrong_xname = ""
+    mapping_file = ""
+    arxiv = False
+    cache_file = None
+    cache_ttl = None
+    max_records = None
+    max_bytes = None
+    write_jobs = 1
+    jobs = 1
+    state_file = None
+    report_file = None
+    index_file = None
+    recid_file = None
+    helptext = (
+        "USAGE: python pipeline.py [-p <pattern> -o <inspire_outdir> | -i <indir>] "
+        "[-x <correct_outdir> -c <correct_name> -w <wrong_name> -f <mapping_file> --arxiv "
+        "--cache_file <cache_file> --cache_ttl <days> --max_records <records> "
+        "--max_bytes <bytes> --write_jobs <jobs> -j <jobs> --state <state_file> "
+        "--progress <seconds> --report <report_file> --index <index_database> "
+        "--recids <recid_file>]"
+    )
+
+    try:
+        opts, _ = getopt.getopt(
+            argv,
+            "hp:o:x:i:c:w:f:j:",
+            ["help", "pattern=", "inspire_outdir=", "correct_outdir=", "indir=",
+             "correct_name=", "wrong_name=", "mapping_file=", "arxiv", "cache_file=", "cache_ttl=",
+             "max_records=", "max_bytes=", "write_jobs=", "jobs=", "state=",
+             "progress=", "report=", "index=", "recids="]
+        )
+    except getopt.GetoptError as err:
+        print(err)
+        print(helptext)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print(helptext)
+            sys.exit()
+        elif opt in ("-p", "--pattern"):
+            inspire_pattern = arg
+        elif opt in ("-o", "--inspire_outdir"):
+            inspire_outdir = os.path.join(arg, "")
+        elif opt in ("-x", "--correct_outdir"):
+            correct_outdir = os.path.join(arg, "")
+        elif opt in ("-i", "--indir"):
+            indir = os.path.join(arg, "")
+        elif opt in ("-c", "--correct_name"):
+            correct_name = arg
+        elif opt in ("-w", "--wrong_name"):
+            wrong_xname = arg
+        elif opt in ("-f", "--mapping_file"):
+            mapping_file = arg
+        elif opt == "--arxiv":
+            arxiv = True
+        elif opt == "--cache_file":
+            cache_file = arg
+        elif opt == "--cache_ttl":
+            cache_ttl = float(arg) * 24 * 3600
+        elif opt == "--max_records":
+            max_records = int(arg)
+        elif opt == "--max_bytes":
+            max_bytes = int(arg)
+        elif opt == "--write_jobs":
+            write_jobs = int(arg)
+        elif opt in ("-j", "--jobs"):
+            jobs = int(arg)
+        elif opt == "--state":
+            state_file = arg
+        elif opt == "--progress":
+            stats.progress_interval = float(arg)
+        elif opt == "--report":
+            report_file = arg
+        elif opt == "--index":
+            index_file = arg
+        elif opt == "--recids":
+            recid_file = arg
+
+    fixers = []
+    mapping = load_journal_mapping(mapping_file) if mapping_file else {}
+    if correct_name and wrong_xname:
+        mapping[wrong_xname] = correct_name
+    if mapping:
+        fixers.append(Fix773(mapping))
+    if arxiv:
+        from fix_arxiv import FixArxiv
+        fixers.append(FixArxiv(cache_file=cache_file, cache_ttl=cache_ttl))
+    if not fixers:
+        print(helptext)
+        print("\nPlease give the names or a mapping file for the 773 fix and/or --arxiv.")
+        sys.exit(2)
+    if bool(index_file) != bool(recid_file):
+        print(helptext)
+        print("\nPlease give both the index database and the recid file")
+        sys.exit(2)
+    if not (inspire_pattern or indir or index_file):
+        print(helptext)
+        print("\nPlease give INSPIRE search pattern or the path to local files")
+        sys.exit(2)
+
+    index = None
+    recids = None
+    inspire_xml_paths = []
+    if index_file:
+        from local_index import LocalIndex
+        index = LocalIndex(index_file)
+        with open(recid_file) as f:
+            recids = f.read().split()
+    else:
+        inspire_xml_paths = get_inspire_files(
+            inspire_pattern=inspire_pattern,
+            inspire_outdir=inspire_outdir,
+            indir=indir
+        )
+    Pipeline(fixers, state_file=state_file).run(
+        inspire_xml_paths,
+        correct_outdir,
+        max_records=max_records,
+        max_bytes=max_bytes,
+        write_jobs=write_jobs,
+        jobs=jobs,
+        index=index,
+        recids=recids
+    )
+    if index:
+        index.close()
+    if report_file:
+        stats.write_report(report_file)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
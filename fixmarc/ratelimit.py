@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+"""
+Rate limiting for all the outbound HTTP requests.
+
+Every host gets a token bucket: `rate` requests per second on average with
+bursts of at most `burst` requests. Requests made through `RateLimiter.request`
+wait for a token, and are retried with exponential backoff when the server
+answers 429 or 503. A `Retry-After` header pauses the whole host, not only the
+request that got it. The requests are made on the pooled keep-alive
+sessions of `http_pool.client`.
+
+The module level `limiter` is shared by fix_arxiv, extract_dois and
+get_inspire_records. The requests and the time spent waiting for a token are
+recorded in `runstats.stats`.
+
+Example usage:
+    from ratelimit import limiter
+    limiter.set_rate("export.arxiv.org", 1 / 3.0)
+    response = limiter.request("GET", "http://export.arxiv.org/oai2", params=params)
+
+"""
+from __future__ import print_function
+
+import threading
+import time
+
+from email.utils import mktime_tz, parsedate_tz
+
+import requests
+from requests.compat import urlparse
+
+from http_pool import client
+from runstats import stats
+
+# Status codes that mean "slow down and try again later"
+RETRY_STATUS_CODES = (429, 503)
+
+
+class TokenBucket(object):
+    """Thread safe token bucket.
+
+    :param rate: tokens added per second, None for no limit
+    :param burst: maximum number of tokens in the bucket
+    """
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.time()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        """Add the tokens accumulated since the last call."""
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self):
+        """Take a token, sleeping until one is available."""
+        while True:
+            with self.lock:
+                now = time.time()
+                self._refill(now)
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                elif not self.rate:
+                    return
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        """Don't hand out tokens for the next `seconds` seconds."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+
+
+def parse_retry_after(value):
+    """Return the number of seconds a `Retry-After` header asks to wait.
+
+    The header is either a number of seconds or an HTTP date.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    parsed = parsedate_tz(value)
+    if parsed:
+        return max(0, mktime_tz(parsed) - time.time())
+
+
+class RateLimiter(object):
+    """Token buckets per host with retries on 429 and 503.
+
+    :param rates: dictionary of requests per second by host name
+    :param default_rate: requests per second for the other hosts, None for no limit
+    :param burst: bucket size of every host
+    :param retries: how many times to retry a request that got 429 or 503
+    :param backoff: base delay in seconds of the exponential backoff
+    """
+    def __init__(self, rates=None, default_rate=None, burst=1, retries=3, backoff=2.0):
+        self.rates = dict(rates or {})
+        self.default_rate = default_rate
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def set_rate(self, host, rate):
+        """Change the allowed requests per second of a host."""
+        with self.lock:
+            self.rates[host] = rate
+            self.buckets.pop(host, None)
+
+    def bucket(self, url):
+        """Return the token bucket of the host of `url`."""
+        host = urlparse(url).hostname
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(
+                    self.rates.get(host, self.default_rate), self.burst)
+            return self.buckets[host]
+
+    def acquire(self, url):
+        """Wait until a request to `url` is allowed."""
+        self.bucket(url).acquire()
+
+    def request(self, method, url, retries=None, **kwargs):
+        """Make an HTTP request with `http_pool.client` within the host's rate limit.
+
+        The response of the last attempt is returned, also when it is still
+        429 or 503.
+        """
+        if retries is None:
+            retries = self.retries
+        host = urlparse(url).hostname
+        bucket = self.bucket(url)
+        attempt = 0
+        while True:
+            with stats.stage("rate_limit_wait"):
+                bucket.acquire()
+            start = time.time()
+            try:
+                response = client.request(method, url, **kwargs)
+            except requests.RequestException:
+                stats.record_request(host, time.time() - start, "error")
+                raise
+            stats.record_request(
+                host, time.time() - start, response.status_code, len(response.content))
+            if response.status_code not in RETRY_STATUS_CODES or attempt >= retries:
+                return response
+            stats.incr("http_retries")
+            delay = parse_retry_after(response.headers.get("Retry-After"))
+            if delay is None:
+                delay = self.backoff * 2 ** attempt
+            print("Got " + str(response.status_code) + " from " + url +
+                  ", retrying in " + str(int(delay)) + " seconds")
+            bucket.pause(delay)
+            attempt += 1
+
+
+# arXiv asks for no more than one request every three seconds
+limiter = RateLimiter(rates={
+    "export.arxiv.org": 1 / 3.0,
+    "inspirehep.net": 2.0,
+    "www.dx.doi.org": 5.0,
+    "doi.org": 5.0,
+})
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+"""
+Timings and counters of a run.
+
+The module level `stats` is shared by get_inspire_records, utils, fix_773,
+fix_arxiv and ratelimit. It keeps
+    * the wall time spent in every stage (fetch, parse, fix, write...),
+    * counters, like the records parsed, fixed and skipped or the cache hits,
+    * the number, latencies, status codes and size of the HTTP requests by
+      host (recorded by `ratelimit.RateLimiter.request`), and the number of
+      connections opened for them (recorded by `http_pool.HTTPClient`).
+
+`write_report` dumps all of it to a JSON file at the end of a run. With a
+`progress_interval` a progress line with an ETA is printed at most every
+that many seconds.
+
+Stages can overlap: e.g. the "fix" stage of fix_arxiv includes the arXiv
+requests. The worker processes of `utils.map_xml_files` send their stats
+back with the results, so with several jobs the stage times are summed over
+the processes and can add up to more than the wall time of the run.
+
+Example usage:
+    from runstats import stats
+    with stats.stage("parse"):
+        ...
+    stats.incr("records_fixed")
+    stats.write_report("report.json")
+
+"""
+from __future__ import print_function
+
+import json
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+def percentile(sorted_values, fraction):
+    """Return the value that `fraction` of the sorted values are below of."""
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def format_seconds(seconds):
+    """Format seconds as H:MM:SS."""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{}:{:02d}:{:02d}".format(hours, minutes, seconds)
+
+
+class RunStats(object):
+    """Thread safe stage timings, counters and request statistics."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.progress_interval = None
+        self.progress = None
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded so far."""
+        with self.lock:
+            self.started = time.time()
+            self.stages = {}
+            self.counters = {}
+            self.requests = {}
+            self.progress = None
+
+    def add_time(self, stage, seconds, calls=1):
+        """Add `seconds` spent in `calls` calls to a stage."""
+        with self.lock:
+            timing = self.stages.setdefault(stage, [0.0, 0])
+            timing[0] += seconds
+            timing[1] += calls
+
+    @contextmanager
+    def stage(self, name):
+        """Time the block as a call of stage `name`."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def incr(self, counter, n=1):
+        """Increase a counter."""
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def record_request(self, host, seconds, status, n_bytes=0):
+        """Record an HTTP request, `status` is the status code or 'error'."""
+        with self.lock:
+            host_stats = self.requests.setdefault(
+                host, {"latencies": [], "status": {}, "bytes": 0, "connections": 0})
+            host_stats["latencies"].append(seconds)
+            status = str(status)
+            host_stats["status"][status] = host_stats["status"].get(status, 0) + 1
+            host_stats["bytes"] += n_bytes
+
+    def record_connections(self, host, n=1):
+        """Record `n` new connections opened to a host."""
+        with self.lock:
+            host_stats = self.requests.setdefault(
+                host, {"latencies": [], "status": {}, "bytes": 0, "connections": 0})
+            host_stats["connections"] += n
+
+    def pop(self):
+        """Return the raw stats recorded so far and start over.
+
+        The result can be pickled and passed to `merge` in another process.
+        """
+        with self.lock:
+            raw = {
+                "stages": self.stages,
+                "counters": self.counters,
+                "requests": self.requests,
+            }
+            self.stages = {}
+            self.counters = {}
+            self.requests = {}
+        return raw
+
+    def merge(self, raw):
+        """Add the raw stats of e.g. a worker process to these."""
+        with self.lock:
+            for name, (seconds, calls) in raw["stages"].items():
+                timing = self.stages.setdefault(name, [0.0, 0])
+                timing[0] += seconds
+                timing[1] += calls
+            for counter, n in raw["counters"].items():
+                self.counters[counter] = self.counters.get(counter, 0) + n
+            for host, other in raw["requests"].items():
+                host_stats = self.requests.setdefault(
+                    host, {"latencies": [], "status": {}, "bytes": 0, "connections": 0})
+                host_stats["latencies"].extend(other["latencies"])
+                for status, n in other["status"].items():
+                    host_stats["status"][status] = host_stats["status"].get(status, 0) + n
+                host_stats["bytes"] += other["bytes"]
+                host_stats["connections"] += other["connections"]
+
+    def start_progress(self, total, unit):
+        """Start reporting the progress of `total` units of work, e.g. files."""
+        with self.lock:
+            now = time.time()
+            self.progress = {"total": total, "done": 0, "unit": unit,
+                             "start": now, "printed": now}
+
+    def advance(self, n=1):
+        """Mark `n` units of work done and print the progress if it is time."""
+        with self.lock:
+            progress = self.progress
+            if not progress:
+                return
+            progress["done"] += n
+            now = time.time()
+            finished = progress["done"] >= progress["total"]
+            if not self.progress_interval or (
+                    not finished and now - progress["printed"] < self.progress_interval):
+                return
+            progress["printed"] = now
+            elapsed = now - progress["start"]
+            line = "Progress: {}/{} {}".format(progress["done"], progress["total"], progress["unit"])
+            if "records_parsed" in self.counters:
+                line += ", " + str(self.counters["records_parsed"]) + " records parsed"
+            line += ", elapsed " + format_seconds(elapsed)
+            if not finished:
+                remaining = elapsed / progress["done"] * (progress["total"] - progress["done"])
+                line += ", ETA " + format_seconds(remaining)
+        print(line)
+
+    def report(self):
+        """Return everything recorded as a JSON serializable dictionary."""
+        with self.lock:
+            requests = {}
+            for host, host_stats in self.requests.items():
+                latencies = sorted(host_stats["latencies"])
+                requests[host] = {
+                    "count": len(latencies),
+                    "bytes": host_stats["bytes"],
+                    "status": dict(host_stats["status"]),
+                    "seconds": sum(latencies),
+                    "latency_mean": sum(latencies) / len(latencies) if latencies else None,
+                    "latency_p50": percentile(latencies, 0.5),
+                    "latency_p95": percentile(latencies, 0.95),
+                    "latency_max": latencies[-1] if latencies else None,
+                    "connections_opened": host_stats["connections"],
+                    "connections_reused": max(0, len(latencies) - host_stats["connections"]),
+                }
+            return {
+                "command": " ".join(sys.argv),
+                "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+                "seconds": time.time() - self.started,
+                "stages": dict(
+                    (name, {"seconds": seconds, "calls": calls})
+                    for name, (seconds, calls) in self.stages.items()
+                ),
+                "counters": dict(self.counters),
+                "requests": requests,
+            }
+
+    def write_report(self, report_file):
+        """Write the report to a JSON file."""
+        with open(report_file, "w") as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+        print("Wrote run report to file " + report_file)
+
+
+stats = RunStats()
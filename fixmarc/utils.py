@@ -1,23 +1,56 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 
+import hashlib
+import json
 import os
+import time
 
+from functools import partial
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 from tempfile import mkstemp
 
 from lxml import etree
 
-from get_inspire_records import fetch_records
+from compression import is_xml_file, open_xml_file
+from marc import DataField
+from runstats import stats
 
+# Namespace agnostic tag names for iterating over MARCXML nodes
+CONTROLFIELD = "{*}controlfield"
+DATAFIELD = "{*}datafield"
 
-def load_xml_files(inspire_xml_paths):
-    """Load existing XML files to etree objects."""
-    collections = []
+
+def iter_xml_records(inspire_xml_paths):
+    """Yield MARCXML record nodes one at a time from a list of files.
+
+    The files are parsed incrementally with iterparse and every record is
+    cleared after it has been handed out, so only one record is kept in
+    memory at a time. Do not hold on to the yielded nodes. Compressed files
+    are decompressed on the fly.
+
+    The parsing time is recorded as the "parse" stage of `runstats.stats`.
+    """
     for xml_file in inspire_xml_paths:
-        with open(xml_file, "r") as f:
-            collections.append(etree.parse(f))
-    return collections
+        stats.incr("input_bytes", os.path.getsize(xml_file))
+        with open_xml_file(xml_file) as f:
+            records = etree.iterparse(f, events=("end",), tag="{*}record")
+            while True:
+                # Time only the parsing, not what is done with the records
+                start = time.time()
+                try:
+                    _, node = next(records)
+                except StopIteration:
+                    break
+                stats.add_time("parse", time.time() - start)
+                stats.incr("records_parsed")
+                yield node
+                node.clear()
+                # Drop the already processed siblings from the root as well
+                while node.getprevious() is not None:
+                    del node.getparent()[0]
 
 
 def load_xml_strings(inspire_xml_strings):
@@ -28,70 +61,263 @@ def load_xml_strings(inspire_xml_strings):
     return collections
 
 
+def marc_fields(record, tags):
+    """Collect MARCXML datafields with the given tags in a single pass.
+
+    Returns a dictionary with a list of `marc.DataField` objects for every
+    requested tag, in the order the fields appear in the record.
+    """
+    fields = dict((tag, []) for tag in tags)
+    for node in record.iterchildren(DATAFIELD):
+        tag = node.get("tag")
+        if tag in fields:
+            fields[tag].append(DataField.from_node(node))
+
+    return fields
+
+
 def marc_to_dict(node, tag):
-    """Convert MARCXML nodes with a given code to a list of dictionaries."""
-    marc_nodes = node.xpath("./*[local-name()='datafield'][@tag='"+ tag +"']")
-    marc_dicts = []
-    for node in marc_nodes:
-        marcdict = {}
-        subfields = node.xpath("./*[local-name()='subfield']")
-        for subfield in subfields:
-            try:
-                # There might be empty subfields
-                dkey = subfield.xpath("@code")[0]
-                dvalue = subfield.xpath("text()")[0]
-            except IndexError:
-                continue
-            marcdict[dkey] = dvalue
-        marc_dicts.append({tag: marcdict})
-
-    return marc_dicts
+    """Convert MARCXML nodes with a given code to a list of dictionaries.
+
+    The old `{tag: {code: value}}` format, see `marc_fields` for the
+    lossless one.
+    """
+    return [field.to_dict() for field in marc_fields(node, (tag,))[tag]]
+
 
 def find_local_files(directory):
-    """Return the contents of a directory."""
-    return [os.path.join(directory, f) for f in os.listdir(directory)]
+    """Return the plain and compressed XML files of a directory in name order.
 
+    Other files, like the harvest manifest or unfinished pages, are left out.
+    """
+    return [
+        os.path.join(directory, f) for f in sorted(os.listdir(directory))
+        if is_xml_file(f)
+    ]
 
-def get_inspire_collections(inspire_pattern=None, inspire_outdir=None, indir=None):
-    """Get the Inspire record collections. One per XML file."""
-    collections = []
+
+def get_inspire_files(inspire_pattern=None, inspire_outdir=None, indir=None):
+    """Return the paths of the Inspire XML files, fetching them first if needed."""
+    inspire_xml_paths = []
     if inspire_outdir:
-        # Fetch and save to disk
-        inspire_xml_paths = fetch_records(inspire_pattern, 50, outdir=inspire_outdir)
-        collections = load_xml_files(inspire_xml_paths)
+        # Fetch and save to disk. The network stack is imported only here,
+        # so the runs on local files don't load it.
+        from get_inspire_records import fetch_records
+        inspire_xml_paths = fetch_records(inspire_pattern, 50, outdir=inspire_outdir) or []
     elif indir:
         # Load the previously saved files
         inspire_xml_paths = find_local_files(indir)
-        collections = load_xml_files(inspire_xml_paths)
 
-    return collections
+    return inspire_xml_paths
+
+
+def init_worker(initializer=None, initargs=()):
+    """Start the stats of a worker process from scratch and run `initializer`."""
+    # The worker got a copy of the stats of the main process when forked
+    stats.reset()
+    if initializer:
+        initializer(*initargs)
+
+
+def call_with_stats(func, xml_file):
+    """Call `func` in a worker process and return the result with the worker's stats."""
+    result = func(xml_file)
+    return result, stats.pop()
+
+
+def map_xml_files(func, inspire_xml_paths, jobs=1, initializer=None, initargs=()):
+    """Call `func` for every XML file and yield the results in file order.
+
+    With `jobs` > 1 the files are distributed over a pool of worker
+    processes, so `func` and its results have to be picklable (e.g. a module
+    level function or a functools.partial of one). `initializer` is run
+    once in every worker process. The `runstats.stats` of the workers are
+    merged into the ones of this process.
+    """
+    stats.start_progress(len(inspire_xml_paths), "files")
+    if jobs <= 1:
+        for xml_file in inspire_xml_paths:
+            result = func(xml_file)
+            stats.advance()
+            yield result
+        return
+
+    pool = Pool(jobs, init_worker, (initializer, initargs))
+    try:
+        for result, worker_stats in pool.imap(partial(call_with_stats, func), inspire_xml_paths):
+            stats.merge(worker_stats)
+            stats.advance()
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def get_recid(record):
+    """Return the recid (controlfield 001) of a record node or None."""
+    for node in record.iterchildren(CONTROLFIELD):
+        if node.get("tag") == "001":
+            return node.text
+
+
+def marc_record_to_node(fields, recid=None):
+    """Build a MARCXML record node from a list of `marc.DataField` objects."""
+    record = etree.Element("record")
+    if recid:
+        controlfield = etree.SubElement(record, "controlfield", tag="001")
+        controlfield.text = recid
+    for field in fields:
+        record.append(field.to_node())
+    return record
 
 
 def write_corrected_marcxml(fixed_records, correct_outdir, recid=None):
-    """Write corrected MARC fields to a MARCXML file."""
+    """Write corrected MARC fields to a MARCXML file.
+
+    `fixed_records` can be any iterable of `(fields, recid)` tuples, e.g. a
+    generator. Records are serialized and written out one at a time, so the
+    whole collection is never kept in memory.
+    """
     if not correct_outdir:
         correct_outdir = "/tmp/"
     if not os.path.exists(correct_outdir):
         os.makedirs(correct_outdir)
 
-    _, outfile = mkstemp(prefix="correct" + "_",
-                         dir=correct_outdir,
-                         suffix=".xml")
-    with open(outfile, "w") as f:
-        line = '<collection>\n'
-        for record, recid in fixed_records:
-            line += '<record>\n'
-            if recid:
-                line += '  <controlfield tag="001">{}</controlfield>\n'.format(recid)
-            for marcfield in record:
-                marctag = marcfield.keys()[0]
-                line += '  <datafield tag="{}" ind1=" " ind2=" ">\n'.format(marctag)
-                for code in sorted(marcfield[marctag]):
-                    line += '    <subfield code="{}">{}</subfield>\n'.format(code, marcfield[marctag][code])
-                line += '  </datafield>\n'
-            line += '</record>\n'
-        line += '</collection>\n'
-        f.write(line)
-
-    no_of_records = len(fixed_records)
+    fd, outfile = mkstemp(prefix="correct" + "_",
+                          dir=correct_outdir,
+                          suffix=".xml")
+    no_of_records = 0
+    write_time = 0
+    with os.fdopen(fd, "wb") as f:
+        with etree.xmlfile(f, encoding="utf-8") as xf:
+            with xf.element("collection"):
+                xf.write("\n")
+                for record, recid in fixed_records:
+                    # Time only the writing, not the fixing in `fixed_records`
+                    start = time.time()
+                    xf.write(marc_record_to_node(record, recid), pretty_print=True)
+                    write_time += time.time() - start
+                    no_of_records += 1
+        f.write(b"\n")
+    stats.add_time("write", write_time, no_of_records)
+    stats.incr("records_written", no_of_records)
+    stats.incr("output_bytes", os.path.getsize(outfile))
+
     print("Wrote " + str(no_of_records) + " correct records to file " + outfile)
+    return outfile
+
+
+def write_marcxml_shard(outfile, serialized_records, recids):
+    """Write already serialized records to a shard file.
+
+    Returns the manifest entry of the shard.
+    """
+    checksum = hashlib.sha256()
+    size = 0
+    with stats.stage("write"):
+        with open(outfile, "wb") as f:
+            for chunk in [b"<collection>\n"] + serialized_records + [b"</collection>\n"]:
+                f.write(chunk)
+                checksum.update(chunk)
+                size += len(chunk)
+    stats.incr("records_written", len(serialized_records))
+    stats.incr("output_bytes", size)
+
+    numeric_recids = [int(recid) for recid in recids if recid and recid.isdigit()]
+    print("Wrote " + str(len(serialized_records)) + " correct records to file " + outfile)
+    return {
+        "file": os.path.basename(outfile),
+        "records": len(serialized_records),
+        "bytes": size,
+        "recid_min": min(numeric_recids) if numeric_recids else None,
+        "recid_max": max(numeric_recids) if numeric_recids else None,
+        "sha256": checksum.hexdigest(),
+    }
+
+
+def write_corrected_marcxml_shards(fixed_records, correct_outdir, max_records=None,
+                                   max_bytes=None, write_jobs=1):
+    """Write corrected MARC fields to several MARCXML files and a manifest.
+
+    A new shard is started after `max_records` records, or before a shard
+    would grow over `max_bytes` bytes. With `write_jobs` > 1 the finished
+    shards are written and checksummed in a thread pool while the next one
+    is being filled. The JSON manifest lists the shards with their record
+    counts, recid ranges and SHA-256 checksums, so they can be uploaded and
+    retried one by one. Returns the path of the manifest.
+    """
+    if not correct_outdir:
+        correct_outdir = "/tmp/"
+    if not os.path.exists(correct_outdir):
+        os.makedirs(correct_outdir)
+
+    # Reserve a unique name for the manifest, the shards are named after it
+    fd, manifest_file = mkstemp(prefix="correct_" + time.strftime("%Y%m%d%H%M%S") + "_",
+                                dir=correct_outdir,
+                                suffix="_manifest.json")
+    os.close(fd)
+    prefix = manifest_file[:-len("manifest.json")]
+    pool = ThreadPool(write_jobs) if write_jobs > 1 else None
+    results = []
+    # Size of the <collection> wrapper
+    empty_size = len(b"<collection>\n</collection>\n")
+
+    def flush_shard(serialized_records, recids):
+        """Hand a full shard over for writing."""
+        outfile = "{}{:04d}.xml".format(prefix, len(results) + 1)
+        if pool:
+            # Don't let the unwritten shards pile up in memory
+            waiting = [result for result in results if not result.ready()]
+            if len(waiting) >= write_jobs:
+                waiting[0].wait()
+            results.append(pool.apply_async(
+                write_marcxml_shard, (outfile, serialized_records, recids)))
+        else:
+            results.append(write_marcxml_shard(outfile, serialized_records, recids))
+
+    serialized_records = []
+    recids = []
+    shard_size = empty_size
+    for record, recid in fixed_records:
+        start = time.time()
+        serialized = etree.tostring(
+            marc_record_to_node(record, recid),
+            encoding="utf-8",
+            xml_declaration=False,
+            pretty_print=True,
+        )
+        stats.add_time("serialize", time.time() - start)
+        full = (
+            serialized_records and
+            (max_records and len(serialized_records) >= max_records or
+             max_bytes and shard_size + len(serialized) > max_bytes)
+        )
+        if full:
+            flush_shard(serialized_records, recids)
+            serialized_records = []
+            recids = []
+            shard_size = empty_size
+        serialized_records.append(serialized)
+        recids.append(recid)
+        shard_size += len(serialized)
+    if serialized_records:
+        flush_shard(serialized_records, recids)
+
+    if pool:
+        pool.close()
+        pool.join()
+        shards = [result.get() for result in results]
+    else:
+        shards = results
+
+    manifest = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "records": sum(shard["records"] for shard in shards),
+        "shards": shards,
+    }
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    print("Wrote manifest of " + str(len(shards)) + " shards to file " + manifest_file)
+    return manifest_file
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fixmarc"))
+
+import compression
+from compression import get_compression, get_extension, is_xml_file, open_xml_file
+from utils import find_local_files, iter_xml_records
+
+PAGE = (
+    b'<?xml version="1.0" encoding="UTF-8"?>\n'
+    b'<collection xmlns="http://www.loc.gov/MARC21/slim">\n'
+    b'<record><controlfield tag="001">1</controlfield></record>\n'
+    b'<record><controlfield tag="001">2</controlfield></record>\n'
+    b'</collection>\n'
+)
+
+
+class TestOpenXmlFile(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def round_trip(self, compression_name):
+        path = os.path.join(self.tmpdir, "records" + get_extension(compression_name))
+        with open_xml_file(path, "wb") as f:
+            f.write(PAGE)
+        self.assertEqual(get_compression(path), compression_name)
+        self.assertTrue(is_xml_file(path))
+        with open_xml_file(path) as f:
+            self.assertEqual(f.read(), PAGE)
+        self.assertEqual(len(list(iter_xml_records([path]))), 2)
+        return path
+
+    def test_plain(self):
+        self.round_trip(None)
+
+    def test_gz(self):
+        path = self.round_trip("gz")
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(2), b"\x1f\x8b")
+
+    @unittest.skipUnless(compression.lzma, "needs the lzma module")
+    def test_xz(self):
+        self.round_trip("xz")
+
+    @unittest.skipUnless(compression.zstandard, "needs the zstandard package")
+    def test_zst(self):
+        self.round_trip("zst")
+
+    @unittest.skipIf(compression.lzma and compression.zstandard, "all the codecs are installed")
+    def test_missing_codec(self):
+        for name, module in (("xz", compression.lzma), ("zst", compression.zstandard)):
+            if module is None:
+                path = os.path.join(self.tmpdir, "records" + get_extension(name))
+                self.assertRaises(ValueError, open_xml_file, path, "wb")
+
+    def test_explicit_compression(self):
+        # E.g. the temporary files of a harvest have no XML extension
+        path = os.path.join(self.tmpdir, "records.xml.part")
+        with open_xml_file(path, "wb", compression="gz") as f:
+            f.write(PAGE)
+        with open_xml_file(path, compression="gz") as f:
+            self.assertEqual(f.read(), PAGE)
+
+    def test_unknown_compression(self):
+        self.assertRaises(ValueError, get_extension, "bz2")
+        self.assertRaises(ValueError, open_xml_file,
+                          os.path.join(self.tmpdir, "records.xml"), "wb", "bz2")
+
+
+class TestFindLocalFiles(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_only_xml_files_in_name_order(self):
+        names = [
+            "records_00000002.xml.gz", "records_00000001.xml", "records_00000003.xml.zst",
+            "records_00000004.xml.xz", "harvest_manifest.json", "records_00000005.xml.tmp",
+            "records_00000006.xml.part", "notes.txt", "records.gz",
+        ]
+        for name in names:
+            open(os.path.join(self.tmpdir, name), "wb").close()
+        self.assertEqual(find_local_files(self.tmpdir), [
+            os.path.join(self.tmpdir, name) for name in (
+                "records_00000001.xml", "records_00000002.xml.gz",
+                "records_00000003.xml.zst", "records_00000004.xml.xz")
+        ])
+
+    def test_is_xml_file(self):
+        for name in ("a.xml", "a.xml.gz", "a.xml.xz", "a.xml.zst"):
+            self.assertTrue(is_xml_file(name), name)
+        for name in ("a.json", "a.gz", "a.xml.tmp", "a.xml.bz2", "xml"):
+            self.assertFalse(is_xml_file(name), name)
+
+
+if __name__ == "__main__":
+    unittest.main()
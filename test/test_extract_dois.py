@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fixmarc"))
+
+from extract_dois import extract_doi, extract_dois, get_chunks, iter_lines
+
+ROWS = [
+    ["Title", "DOI", "Reference"],
+    ["First", "10.1016/j.nima.2008.01.001", ""],
+    ["Second", "", "see https://doi.org/10.1103/PhysRevLett.52.954 for more"],
+    ["Third", "doi:10.1088/1742-6596/110/1/012001.", "10.1016/j.nima.2008.01.001"],
+    ["No DOI at all, but a rather long title to span several small chunks", "", ""],
+    ["Short", "10.1140/epjc/s10052-012-2012-9", "10.1007/JHEP01(2012)001"],
+    ["Last", "10.1103/PhysRevD.86.010001", "no newline after this row"],
+]
+
+
+def sequential_dois(input_file):
+    """The DOIs of the file in the order they first appear, read in one go."""
+    dois = []
+    with open(input_file, "rb") as f:
+        rows = csv.reader(f, delimiter="\t")
+        next(rows)
+        for row in rows:
+            for column in (1, 2):
+                doi = extract_doi(row[column])
+                if doi is not None and doi not in dois:
+                    dois.append(doi)
+    return dois
+
+
+class TestExtractDois(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.input_file = os.path.join(self.tmpdir, "input.tsv")
+        with open(self.input_file, "wb") as f:
+            f.write("\n".join("\t".join(row) for row in ROWS))
+        self.expected = sequential_dois(self.input_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_every_line_is_in_one_range(self):
+        with open(self.input_file, "rb") as f:
+            lines = f.readlines()
+        for jobs in (1, 2, 3):
+            for chunk_size in (1, 3, 17, 50, 1024):
+                ranges = get_chunks(self.input_file, jobs, chunk_size)
+                read = [line for start, end in ranges
+                        for line in iter_lines(self.input_file, start, end)]
+                self.assertEqual(read, lines, (jobs, chunk_size))
+
+    def test_same_dois_as_sequential(self):
+        self.assertEqual(len(self.expected), 6)
+        for jobs in (1, 2, 4):
+            for chunk_size in (1, 3, 17, 50, 1024):
+                outfile = os.path.join(self.tmpdir, "dois_{}_{}.txt".format(jobs, chunk_size))
+                dois = extract_dois(self.input_file, jobs=jobs, outfile=outfile,
+                                    chunk_size=chunk_size)
+                self.assertEqual(dois, set(self.expected), (jobs, chunk_size))
+                with open(outfile) as f:
+                    self.assertEqual(f.read().splitlines(), self.expected, (jobs, chunk_size))
+
+    def test_empty_file(self):
+        input_file = os.path.join(self.tmpdir, "empty.tsv")
+        open(input_file, "wb").close()
+        self.assertEqual(extract_dois(input_file, jobs=2), set())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fixmarc"))
+
+from fix_773 import Fix773, get_wrong_name_pattern, split_773__x
+from marc import DataField
+
+
+class TestSplit773x(unittest.TestCase):
+    def setUp(self):
+        self.mapping = {"Nucl. Instrum. Methods": "Nucl.Instrum.Meth."}
+        self.pattern = get_wrong_name_pattern(list(self.mapping))
+
+    def test_matching_x_is_split(self):
+        m773 = DataField("773", subfields=[("x", "Nucl. Instrum. Methods A 591 (2008) 10-20.")])
+        self.assertTrue(split_773__x(m773, self.pattern, self.mapping))
+        self.assertNotIn("x", m773)
+        self.assertEqual(m773["p"], "Nucl.Instrum.Meth.")
+        self.assertEqual(m773["v"], "A 591")
+        self.assertEqual(m773["y"], "2008")
+        self.assertEqual(m773["c"], "pp.10-20")
+
+    def test_non_matching_x_is_kept(self):
+        subfields = [("x", "Phys. Rev. Lett. B706 (1984) 954-972.")]
+        m773 = DataField("773", subfields=subfields)
+        self.assertFalse(split_773__x(m773, self.pattern, self.mapping))
+        self.assertEqual(m773.subfields, subfields)
+
+
+class TestFix773(unittest.TestCase):
+    def setUp(self):
+        self.fixer = Fix773({"Nucl. Instrum. Methods": "Nucl.Instrum.Meth."})
+
+    def test_matching_record_is_fixed(self):
+        m773 = DataField("773", subfields=[("x", "Nucl. Instrum. Methods A 591 (2008) 10-20.")])
+        fixed = self.fixer.fix({"773": [m773]})
+        self.assertEqual(fixed, {"773": [m773]})
+        self.assertEqual(m773["p"], "Nucl.Instrum.Meth.")
+
+    def test_non_matching_record_is_not_fixed(self):
+        subfields = [("x", "Phys. Rev. Lett. B706 (1984) 954-972.")]
+        m773 = DataField("773", subfields=subfields)
+        self.assertIsNone(self.fixer.fix({"773": [m773]}))
+        self.assertEqual(m773.subfields, subfields)
+
+
+if __name__ == "__main__":
+    unittest.main()
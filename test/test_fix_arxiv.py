@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fixmarc"))
+
+from lxml import etree
+
+import fix_arxiv
+from fix_arxiv import FixArxiv
+from marc import DataField
+from pipeline import FixError, Pipeline
+from runstats import stats
+
+RECORD = (
+    '<record><controlfield tag="001">{recid}</controlfield>'
+    '<controlfield tag="005">20240101000000.0</controlfield>'
+    '<datafield tag="037" ind1=" " ind2=" ">'
+    '<subfield code="a">arXiv:1201.000{recid}</subfield><subfield code="9">arXiv</subfield>'
+    '</datafield></record>'
+)
+
+
+def fail(report_nr, cache=None):
+    raise ValueError("no answer")
+
+
+class TestFixArxiv(unittest.TestCase):
+    def setUp(self):
+        self.get_arxiv_category = fix_arxiv.get_arxiv_category
+
+    def tearDown(self):
+        fix_arxiv.get_arxiv_category = self.get_arxiv_category
+
+    def fields(self, report_nr="arXiv:1201.0001"):
+        return {
+            "035": [],
+            "037": [DataField("037", subfields=[("a", report_nr), ("9", "arXiv")])],
+        }
+
+    def test_category_is_added(self):
+        fix_arxiv.get_arxiv_category = lambda report_nr, cache=None: "hep-ph"
+        fixed = FixArxiv().fix(self.fields())
+        self.assertEqual(fixed["037"][0]["c"], "hep-ph")
+        self.assertEqual(fixed["035"][0]["a"], "oai:arXiv.org:1201.0001")
+
+    def test_failed_lookup_raises(self):
+        fix_arxiv.get_arxiv_category = fail
+        fields = self.fields()
+        subfields = list(fields["037"][0].subfields)
+        self.assertRaises(FixError, FixArxiv().fix, fields)
+        self.assertEqual(fields["035"], [])
+        self.assertEqual(fields["037"][0].subfields, subfields)
+
+    def test_missing_category_raises(self):
+        fix_arxiv.get_arxiv_category = lambda report_nr, cache=None: None
+        self.assertRaises(FixError, FixArxiv().fix, self.fields())
+
+    def test_empty_report_nr_raises(self):
+        self.assertRaises(FixError, FixArxiv().fix, self.fields(report_nr="arXiv:"))
+
+
+class TestFixArxivDeltaRun(unittest.TestCase):
+    def setUp(self):
+        self.get_arxiv_category = fix_arxiv.get_arxiv_category
+        self.tmpdir = tempfile.mkdtemp()
+        self.xml_file = os.path.join(self.tmpdir, "records.xml")
+        with open(self.xml_file, "w") as f:
+            f.write("<collection>" +
+                    "".join(RECORD.format(recid=recid) for recid in range(1, 4)) +
+                    "</collection>")
+        self.state_file = os.path.join(self.tmpdir, "state.db")
+
+    def tearDown(self):
+        fix_arxiv.get_arxiv_category = self.get_arxiv_category
+        shutil.rmtree(self.tmpdir)
+
+    def run_pipeline(self):
+        stats.reset()
+        pipeline = Pipeline([FixArxiv()], state_file=self.state_file)
+        outfile = pipeline.run([self.xml_file], os.path.join(self.tmpdir, "correct"))
+        return len(etree.parse(outfile).getroot().findall("record"))
+
+    def test_failed_lookups_are_retried(self):
+        fix_arxiv.get_arxiv_category = fail
+        self.assertEqual(self.run_pipeline(), 0)
+        self.assertEqual(stats.counters["fix_arxiv_records_failed"], 3)
+
+        fix_arxiv.get_arxiv_category = lambda report_nr, cache=None: "hep-ph"
+        self.assertEqual(self.run_pipeline(), 3)
+        self.assertEqual(stats.counters.get("records_unchanged", 0), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
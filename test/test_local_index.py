@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fixmarc"))
+
+from local_index import LocalIndex, get_record_spans
+from utils import get_recid, marc_fields
+
+MARC_NS = "http://www.loc.gov/MARC21/slim"
+
+RECORD = (
+    '<{p}record><{p}controlfield tag="001">{recid}</{p}controlfield>'
+    '<{p}datafield tag="024" ind1="7" ind2=" ">'
+    '<{p}subfield code="a">10.1000/test.{recid}</{p}subfield><{p}subfield code="2">DOI</{p}subfield>'
+    '</{p}datafield></{p}record>\n'
+)
+
+
+def collection(recids, prefix="", before=""):
+    """Return a MARCXML collection of the recids, with an optional namespace prefix."""
+    if prefix:
+        root = '<{0}:collection xmlns:{0}="{1}">\n'.format(prefix, MARC_NS)
+        end = '</{}:collection>\n'.format(prefix)
+        prefix += ":"
+    else:
+        root = '<collection xmlns="{}">\n'.format(MARC_NS)
+        end = "</collection>\n"
+    records = "".join(RECORD.format(p=prefix, recid=recid) for recid in recids)
+    return '<?xml version="1.0" encoding="UTF-8"?>\n' + root + before + records + end
+
+
+def describe(records):
+    """The tag, recid and DOI of the records, read while they are iterated."""
+    return [(record.tag, get_recid(record), marc_fields(record, ("024",))["024"][0]["a"])
+            for record in records]
+
+
+class TestLocalIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.index = LocalIndex(os.path.join(self.tmpdir, "index.db"))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        with (gzip.open(path, "wb") if name.endswith(".gz") else open(path, "wb")) as f:
+            f.write(data.encode("utf-8"))
+        return path
+
+    def offsets(self, path):
+        return [row for row in self.index.connection.execute(
+            "SELECT byte_offset, byte_length FROM records WHERE path = ? ORDER BY recid",
+            (os.path.abspath(path),))]
+
+    def check_round_trip(self, path, recids):
+        self.assertEqual(self.index.add_file(path), len(recids))
+        self.assertEqual(
+            describe(self.index.iter_records(recids[::-1] + ["404"])),
+            [("{%s}record" % MARC_NS, recid, "10.1000/test." + recid) for recid in recids])
+
+    def test_plain_file(self):
+        path = self.write("records.xml", collection(["1", "2", "3"]))
+        self.check_round_trip(path, ["1", "2", "3"])
+        self.assertTrue(all(offset is not None for offset, _ in self.offsets(path)))
+
+    def test_prefixed_namespace(self):
+        path = self.write("records.xml", collection(["1", "2"], prefix="marc"))
+        self.assertEqual(len(get_record_spans(path)), 2)
+        self.check_round_trip(path, ["1", "2"])
+        self.assertTrue(all(offset is not None for offset, _ in self.offsets(path)))
+
+    def test_gzip_file(self):
+        path = self.write("records.xml.gz", collection(["1", "2"]))
+        self.assertIsNone(get_record_spans(path))
+        self.check_round_trip(path, ["1", "2"])
+        self.assertEqual(self.offsets(path), [(None, None), (None, None)])
+
+    def test_scan_disagrees_with_parser(self):
+        # The scan also finds the record in the comment
+        path = self.write("records.xml", collection(
+            ["1", "2"], before="<!-- <record>old</record> -->\n"))
+        self.assertEqual(len(get_record_spans(path)), 3)
+        self.check_round_trip(path, ["1", "2"])
+        self.assertEqual(self.offsets(path), [(None, None), (None, None)])
+
+    def test_changed_file_is_streamed(self):
+        path = self.write("records.xml", collection(["1", "2"]))
+        self.index.add_file(path)
+        # Shift the records, the indexed offsets are wrong now
+        self.write("records.xml", collection(["0", "1", "2"]))
+        os.utime(path, (0, 0))
+        self.assertEqual(describe(self.index.iter_records(["2"])),
+                         [("{%s}record" % MARC_NS, "2", "10.1000/test.2")])
+
+    def test_update_skips_indexed_files(self):
+        self.write("records.xml", collection(["1", "2"]))
+        self.write("records.xml.gz", collection(["3"]))
+        self.write("harvest_manifest.json", "{}")
+        self.assertEqual(self.index.update(self.tmpdir), 3)
+        self.assertEqual(self.index.update(self.tmpdir), 0)
+        self.assertEqual(self.index.find_dois(["10.1000/TEST.3", "10.1000/test.4"]),
+                         set(["10.1000/TEST.3"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fixmarc"))
+
+from lxml import etree
+
+from pipeline import Fixer, FixError, Pipeline
+from runstats import stats
+
+RECORD = (
+    '<record><controlfield tag="001">{recid}</controlfield>'
+    '<controlfield tag="005">20240101000000.0</controlfield>'
+    '<datafield tag="773" ind1=" " ind2=" "><subfield code="x">Journal {recid}</subfield></datafield>'
+    '</record>'
+)
+
+
+class FlakyFixer(Fixer):
+    """Moves 773__x to 773__p, or fails while `failing` is set."""
+    name = "flaky"
+    tags = ("773",)
+    failing = False
+
+    def fix(self, fields):
+        if self.failing:
+            raise FixError("lookup failed")
+        for m773 in fields["773"]:
+            m773["p"] = m773.pop("x")
+        return fields
+
+
+def count_records(xml_file):
+    return len(etree.parse(xml_file).getroot().findall("record"))
+
+
+class TestDeltaRun(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.xml_file = os.path.join(self.tmpdir, "records.xml")
+        with open(self.xml_file, "w") as f:
+            f.write("<collection>" +
+                    "".join(RECORD.format(recid=recid) for recid in range(1, 6)) +
+                    "</collection>")
+        self.state_file = os.path.join(self.tmpdir, "state.db")
+        self.outdir = os.path.join(self.tmpdir, "correct")
+        stats.reset()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_pipeline(self, failing, jobs=1):
+        stats.reset()
+        fixer = FlakyFixer()
+        fixer.failing = failing
+        pipeline = Pipeline([fixer], state_file=self.state_file)
+        return pipeline.run([self.xml_file], self.outdir, jobs=jobs)
+
+    def test_failed_records_are_retried(self):
+        outfile = self.run_pipeline(failing=True)
+        self.assertEqual(count_records(outfile), 0)
+        self.assertEqual(stats.counters["records_failed"], 5)
+        self.assertEqual(stats.counters["flaky_records_failed"], 5)
+
+        outfile = self.run_pipeline(failing=False)
+        self.assertEqual(count_records(outfile), 5)
+        self.assertEqual(stats.counters.get("records_unchanged", 0), 0)
+
+        outfile = self.run_pipeline(failing=False)
+        self.assertEqual(count_records(outfile), 0)
+        self.assertEqual(stats.counters["records_unchanged"], 5)
+
+    def test_failed_records_are_retried_with_jobs(self):
+        self.run_pipeline(failing=True, jobs=2)
+        outfile = self.run_pipeline(failing=False, jobs=2)
+        self.assertEqual(count_records(outfile), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
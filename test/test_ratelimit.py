@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import unittest
+
+from email.utils import formatdate
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fixmarc"))
+
+import ratelimit
+from ratelimit import RateLimiter, TokenBucket, parse_retry_after
+from runstats import stats
+
+
+class FakeClock(object):
+    """Stands in for the time module, sleeping only moves the clock."""
+    def __init__(self, now=1000000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = b""
+
+
+class FakeClient(object):
+    """Answers with the given responses in order and records when it was called."""
+    def __init__(self, clock, responses):
+        self.clock = clock
+        self.responses = list(responses)
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append(self.clock.now)
+        return self.responses.pop(0)
+
+
+class FakeClockTestCase(unittest.TestCase):
+    def setUp(self):
+        self.time = ratelimit.time
+        self.client = ratelimit.client
+        self.clock = ratelimit.time = FakeClock()
+        stats.reset()
+
+    def tearDown(self):
+        ratelimit.time = self.time
+        ratelimit.client = self.client
+
+    def elapsed(self, start):
+        return self.clock.now - start
+
+
+class TestTokenBucket(FakeClockTestCase):
+    def test_rate(self):
+        bucket = TokenBucket(rate=2.0)
+        start = self.clock.now
+        times = []
+        for _ in range(5):
+            bucket.acquire()
+            times.append(self.elapsed(start))
+        self.assertEqual(times, [0, 0.5, 1.0, 1.5, 2.0])
+
+    def test_burst(self):
+        bucket = TokenBucket(rate=1.0, burst=3)
+        start = self.clock.now
+        times = []
+        for _ in range(5):
+            bucket.acquire()
+            times.append(self.elapsed(start))
+        self.assertEqual(times, [0, 0, 0, 1.0, 2.0])
+
+    def test_no_limit(self):
+        bucket = TokenBucket()
+        start = self.clock.now
+        for _ in range(100):
+            bucket.acquire()
+        self.assertEqual(self.elapsed(start), 0)
+
+    def test_pause(self):
+        bucket = TokenBucket()
+        start = self.clock.now
+        bucket.pause(10)
+        bucket.pause(5)
+        bucket.acquire()
+        self.assertEqual(self.elapsed(start), 10)
+
+
+class TestParseRetryAfter(FakeClockTestCase):
+    def test_seconds(self):
+        self.assertEqual(parse_retry_after("120"), 120)
+        self.assertEqual(parse_retry_after(" 7 "), 7)
+
+    def test_http_date(self):
+        self.assertEqual(parse_retry_after(formatdate(self.clock.now + 30, usegmt=True)), 30)
+
+    def test_date_in_the_past(self):
+        self.assertEqual(parse_retry_after(formatdate(self.clock.now - 30, usegmt=True)), 0)
+
+    def test_missing_or_invalid(self):
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after(""))
+        self.assertIsNone(parse_retry_after("soon"))
+
+
+class TestRateLimiter(FakeClockTestCase):
+    def fake_client(self, *responses):
+        ratelimit.client = FakeClient(self.clock, responses)
+        return ratelimit.client
+
+    def test_requests_are_paced(self):
+        client = self.fake_client(*[FakeResponse(200)] * 3)
+        limiter = RateLimiter(rates={"example.org": 0.5})
+        start = self.clock.now
+        for _ in range(3):
+            self.assertEqual(limiter.request("GET", "http://example.org/").status_code, 200)
+        self.assertEqual([call - start for call in client.calls], [0, 2.0, 4.0])
+
+    def test_retry_after_and_backoff(self):
+        client = self.fake_client(
+            FakeResponse(429, {"Retry-After": "5"}),
+            FakeResponse(503),
+            FakeResponse(200),
+        )
+        limiter = RateLimiter(backoff=2.0)
+        start = self.clock.now
+        response = limiter.request("GET", "http://example.org/")
+        self.assertEqual(response.status_code, 200)
+        # Retry-After first, then the backoff of the second attempt
+        self.assertEqual([call - start for call in client.calls], [0, 5, 9])
+        self.assertEqual(stats.counters["http_retries"], 2)
+
+    def test_retry_after_pauses_the_host(self):
+        self.fake_client(FakeResponse(429, {"Retry-After": "30"}), FakeResponse(200))
+        limiter = RateLimiter(retries=1)
+        start = self.clock.now
+        self.assertEqual(limiter.request("GET", "http://example.org/a").status_code, 200)
+        # The pause is on the bucket of the host, shared by all its requests
+        self.assertEqual(limiter.bucket("http://example.org/b").paused_until, start + 30)
+        start = self.clock.now
+        limiter.acquire("http://example.com/")
+        self.assertEqual(self.elapsed(start), 0)
+
+    def test_last_response_after_the_retries(self):
+        client = self.fake_client(*[FakeResponse(503)] * 3)
+        limiter = RateLimiter(retries=2, backoff=1.0)
+        self.assertEqual(limiter.request("GET", "http://example.org/").status_code, 503)
+        self.assertEqual(len(client.calls), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
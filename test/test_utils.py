@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fixmarc"))
+
+from marc import DataField
+from utils import write_corrected_marcxml_shards
+
+
+class TestWriteCorrectedMarcxmlShards(unittest.TestCase):
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def records(self):
+        return [([DataField("773", subfields=[("p", "Nucl.Instrum.Meth.")])], str(recid))
+                for recid in range(1, 6)]
+
+    def test_runs_in_the_same_second_dont_collide(self):
+        first = write_corrected_marcxml_shards(self.records(), self.outdir, max_records=2)
+        second = write_corrected_marcxml_shards(self.records(), self.outdir, max_records=2)
+        self.assertNotEqual(first, second)
+        shard_files = set()
+        for manifest_file in (first, second):
+            with open(manifest_file) as f:
+                manifest = json.load(f)
+            self.assertEqual(manifest["records"], 5)
+            shard_files.update(shard["file"] for shard in manifest["shards"])
+        self.assertEqual(len(shard_files), 6)
+        self.assertEqual(len(os.listdir(self.outdir)), 8)
+
+
+if __name__ == "__main__":
+    unittest.main()